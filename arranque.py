@@ -0,0 +1,70 @@
+# Arranque de los scripts de carga: imports pesados, conexión y cache de clientes en segundo plano
+import sys
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Hilos para el arranque: imports, conexión, cache de clientes y lectura del archivo
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='arranque')
+_pandas_future = None
+
+# --- Copy-on-write de pandas ---
+# Las selecciones y filtros no copian datos hasta que se modifican, así que no hace falta .copy(). Desde pandas 3.0
+# siempre está activo; con versiones anteriores se activa al importar pandas en la precarga, y todo lo que usa
+# pandas (los pasos en segundo plano y el hilo principal, con esperar_pandas) espera a que esté activo.
+def activar_copy_on_write():
+    """Importa pandas y, si es anterior a 3.0, activa copy-on-write."""
+    import pandas as pd
+    if int(pd.__version__.split('.')[0]) < 3:
+        pd.set_option("mode.copy_on_write", True)
+
+def esperar_pandas():
+    """Espera a que la precarga importe pandas con copy-on-write; sin precarga lo hace aquí, en el primer uso."""
+    if _pandas_future is None:
+        activar_copy_on_write()
+    else:
+        _pandas_future.result()
+
+def _con_pandas(funcion, *args, **kwargs):
+    esperar_pandas()
+    return funcion(*args, **kwargs)
+
+def en_segundo_plano(funcion, *args, **kwargs):
+    """Ejecuta la función en un hilo de arranque, con pandas ya importado y configurado, y devuelve un Future."""
+    return _executor.submit(_con_pandas, funcion, *args, **kwargs)
+
+def precargar_modulos(*nombres_modulos):
+    """Importa en segundo plano los módulos pesados (pandas, sqlalchemy, ...) mientras el usuario elige el archivo."""
+    global _pandas_future
+    if 'pandas' in nombres_modulos:
+        _pandas_future = _executor.submit(activar_copy_on_write)
+    otros = [nombre for nombre in nombres_modulos if nombre != 'pandas']
+    return _executor.submit(lambda: [importlib.import_module(nombre) for nombre in otros])
+
+def _conectar(connection_string):
+    """Crea el engine de SQLAlchemy y prueba la conexión."""
+    from sqlalchemy import create_engine, text
+    engine = create_engine(connection_string)
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    return engine
+
+def conectar_en_segundo_plano(connection_string):
+    """Abre la conexión a SQL Server en segundo plano (no usa pandas, no lo espera). Devuelve un Future con el engine."""
+    return _executor.submit(_conectar, connection_string)
+
+def _revalidar_clientes(engine_future):
+    from clientes_cache import revalidar_cache
+    return revalidar_cache(engine_future.result())
+
+def revalidar_clientes_en_segundo_plano(engine_future):
+    """En cuanto la conexión esté lista, revalida el cache local de Clientes. Devuelve un Future."""
+    return en_segundo_plano(_revalidar_clientes, engine_future)
+
+def esperar(future, mensaje_error):
+    """Espera el resultado de un paso en segundo plano; si falló, muestra el error y termina el programa."""
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"{mensaje_error}: {e}")
+        print(f"Tipo de error: {type(e).__name__}")
+        sys.exit(1)
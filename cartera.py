@@ -1,15 +1,15 @@
 # Librerias usadas
-import pandas as pd
-import numpy as np
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import ProgrammingError, IntegrityError, SQLAlchemyError
-import pyodbc
+# Los módulos pesados (pandas, numpy, sqlalchemy) se importan en segundo plano mientras se elige el archivo.
 import os
 import sys
-import re
-from tkinter import Tk, filedialog
+import uuid
 from dotenv import load_dotenv
 from datetime import date # <--- IMPORTANTE: Asegúrate que esta línea esté al inicio
+from arranque import (precargar_modulos, conectar_en_segundo_plano, revalidar_clientes_en_segundo_plano,
+                      en_segundo_plano, esperar, esperar_pandas)
+import metricas
+
+precargar_modulos('pandas', 'numpy', 'sqlalchemy')
 
 def get_env_path():
     """Obtiene la ruta correcta del archivo .env."""
@@ -35,27 +35,33 @@ SERVER_AND_PORT = f"{SERVER_NAME}:{PORT}"
 # --- Configuración de Tablas en la Base de Datos ---
 TABLE_NAME = 'Cartera' # Nombre de tu tabla de destino
 CLIENTES_TABLE_NAME = 'Clientes' # Nombre de tu tabla de clientes
+ANTIGUEDAD_TABLE_NAME = 'Cartera_Antiguedad' # Resumen de antigüedad por snapshot
+ID_CARGA = uuid.uuid4().hex # Identificador de esta ejecución
 
 connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
-engine = create_engine(connection_string)
 
-try:
-    # --- 1. Crear el motor de SQLAlchemy ---
-    engine = create_engine(connection_string)
-    with engine.connect() as connection:
-        connection.execute(text("SELECT 1"))
-    print(f"Conexión a SQL Server '{DATABASE_NAME}' en '{SERVER_NAME}' establecida.")
-except SQLAlchemyError as e:
-    print(f"Error de conexión a la base de datos: {e}")
-    exit()
+# --- 1. Crear el motor de SQLAlchemy (en segundo plano) ---
+# Mientras el usuario elige el archivo se abre la conexión y se revalida el cache de Clientes.
+engine_future = conectar_en_segundo_plano(connection_string)
+clientes_future = revalidar_clientes_en_segundo_plano(engine_future)
+
+def cargar_archivo(input_file_path):
+    """Lee el CSV de cartera según su contrato (6 filas de encabezado y una de totales al final).
+    El CSV puede venir dentro de un .zip o un .gz; se descomprime a medida que se lee."""
+    from contratos import leer_con_contrato
+    # 'P.O. No. ' y 'Age ' no forman parte del contrato, así que nunca se materializan
+    df = leer_con_contrato(input_file_path, 'cartera')
+    print(f"Archivo '{input_file_path}' cargado exitosamente.")
+    return df
 
 # --- Lógica para seleccionar archivo ---
+from tkinter import Tk, filedialog
 root = Tk()
 root.withdraw()
 print("Por favor, selecciona el archivo 'cartera.csv'...")
 file_path = filedialog.askopenfilename(
     title="Selecciona el archivo 'cartera.csv'",
-    filetypes=[("Archivos CSV", "*.csv")]
+    filetypes=[("Archivos CSV o comprimidos", "*.csv *.zip *.gz"), ("Archivos CSV", "*.csv"), ("Archivos comprimidos", "*.zip *.gz")]
 )
 
 if not file_path:
@@ -63,10 +69,25 @@ if not file_path:
     exit()
 
 input_file_path = file_path
+metricas.iniciar('cartera', ID_CARGA)
+
+# La lectura del archivo corre en paralelo con la conexión y el cache de Clientes
+archivo_future = en_segundo_plano(cargar_archivo, input_file_path)
+
+esperar_pandas()
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError, IntegrityError, SQLAlchemyError
+from clientes_cache import obtener_clientes, clean_customer_name
+from parquet_sink import escribir_parquet
+from snapshot import reemplazar_snapshot, MODO_SNAPSHOT
+from cuarentena import guardar_en_cuarentena
+from reglas_remapeo import cargar_reglas, aplicar_reglas
+from conciliacion import ErrorConciliacion, verificar_total_pie, ganchos_conciliacion
+from transformaciones import zona_entera, resumir_antiguedad, preparar_snapshot_cartera
 
 try:
-    df = pd.read_csv(input_file_path, skipfooter=1, skiprows=6, engine='python')
-    print(f"Archivo '{input_file_path}' cargado exitosamente.")
+    df = archivo_future.result()
 except FileNotFoundError:
     print(f"Error: El archivo de entrada no se encontró en '{input_file_path}'")
     sys.exit(1)
@@ -74,58 +95,40 @@ except Exception as e:
     print(f"Ocurrió un error inesperado al cargar el archivo: {e}")
     sys.exit(1)
 
-column_renames = {
-    'Zones for Financial Reporting ': 'zona_csv_original',
-    'Customer:Project ': 'nombre_cliente',
-    'Transaction Type ': 'tipo_transaccion',
-    'Date ': 'fecha_facturacion',
-    'Document Number ': 'document_number',
-    'Due Date ': 'fecha_pago',
-    'Open Balance ': 'open_balance'
-}
-
-df = df.rename(columns=column_renames)
-print(f"\nColumnas disponibles después de renombrar: {df.columns.tolist()}")
-df = df.drop(columns=['P.O. No. ', 'Age '], errors='ignore')
-
-# Función de limpieza robusta para nombres de cliente
-def clean_customer_name(name):
-    if pd.isna(name):
-        return None
-    name = str(name).strip().lower()
-    name = re.sub(r'[^a-z0-9\s]', '', name)
-    name = re.sub(r'\s+', ' ', name).strip()
-    return name
+metricas.contar(TABLE_NAME, 'leidas', len(df))
 
-# --- LÓGICA ESPECIAL PARA WALMART Y AMAZON ---
-condicion_1 = (df['zona_csv_original'].str.strip() == 'Walmart') & (df['nombre_cliente'].str.strip() == 'Ecommerce')
-condicion_2 = (df['zona_csv_original'].str.strip() == 'Amazon') & (df['nombre_cliente'].str.strip() == 'Ecommerce')
+# --- Conciliación contra el pie del reporte ---
+try:
+    verificar_total_pie(df, 'open_balance', TABLE_NAME)
+except ErrorConciliacion as e:
+    metricas.registrar_error(TABLE_NAME, e)
+    sys.exit(1)
 
-df['zona_csv_original'] = np.where(condicion_1, 'E-Commerce', df['zona_csv_original'])
-df['nombre_cliente'] = np.where(condicion_1, 'Walmart Ecommerce', df['nombre_cliente'])
+engine = esperar(engine_future, "Error de conexión a la base de datos")
+print(f"Conexión a SQL Server '{DATABASE_NAME}' en '{SERVER_NAME}' establecida.")
 
-df['zona_csv_original'] = np.where(condicion_2, 'E-Commerce', df['zona_csv_original'])
-df['nombre_cliente'] = np.where(condicion_2, 'Amazon', df['nombre_cliente'])
+print(f"\nColumnas disponibles después de renombrar: {df.columns.tolist()}")
 
-df['nombre_cliente'] = df['nombre_cliente'].replace({'- no customer/project -': 'Sin Nombre'})
+# --- Reglas de remapeo de zona y cliente (Walmart/Amazon Ecommerce, '- no customer/project -', ...) ---
+# Las reglas están en reglas_remapeo.json o en la tabla Reglas_Remapeo: un caso nuevo no requiere cambiar el código.
+aplicar_reglas(df, cargar_reglas('cartera', engine), columna_zona='zona_csv_original', columna_nombre='nombre_cliente')
 
 # --- Mapeo de clientes con la Base de Datos ---
 try:
-    with engine.connect() as connection:
-        clientes_db_query = text(f"SELECT id_cliente, nombre_cliente, id_zone FROM {CLIENTES_TABLE_NAME};")
-        clientes_db = pd.read_sql_query(clientes_db_query, connection)
+    # Los clientes vienen del cache local, que ya incluye el nombre normalizado
+    clientes_db = obtener_clientes(engine, df['nombre_cliente'].unique(), cache=esperar(clientes_future, "Error al revalidar el cache de Clientes"))
     
     df['nombre_cliente_cleaned'] = df['nombre_cliente'].apply(clean_customer_name)
-    clientes_db['nombre_cliente_cleaned'] = clientes_db['nombre_cliente'].apply(clean_customer_name)
     
     df = pd.merge(df, clientes_db[['id_cliente', 'id_zone', 'nombre_cliente_cleaned']], 
                   on='nombre_cliente_cleaned', how='left', suffixes=('_csv', '_db'))
     
-    df['id_zone'] = df['id_zone'].fillna(df['zona_csv_original'])
+    df['id_zone'] = df['id_zone'].fillna(df['zona_csv_original']).map(zona_entera).astype(object)
     
     unmapped_clientes = df[df['id_cliente'].isna()]['nombre_cliente'].unique()
     if len(unmapped_clientes) > 0:
-        print(f"Advertencia: Los siguientes clientes no se encontraron en la tabla Clientes y se omitirán: {', '.join(unmapped_clientes)}")
+        print(f"Advertencia: Los siguientes clientes no se encontraron en la tabla Clientes y sus filas se guardan en la cuarentena: {', '.join(unmapped_clientes)}")
+        metricas.clientes_no_mapeados(unmapped_clientes)
     else:
         print("Todos los clientes del archivo fueron encontrados.")
     
@@ -137,65 +140,103 @@ except SQLAlchemyError as e:
     print("Asegúrate de que la tabla 'Clientes' existe y las columnas son correctas.")
     sys.exit(1)
 
-# --- Proceso de limpieza de open_balance ---
-if 'open_balance' in df.columns:
-    print("Limpiando y convirtiendo 'open_balance'...")
-    df['open_balance'] = df['open_balance'].astype(str).str.replace('(', '-', regex=False)
-    df['open_balance'] = df['open_balance'].astype(str).str.replace(')', '', regex=False)
-    df['open_balance'] = df['open_balance'].astype(str).str.replace('$', '', regex=False)
-    df['open_balance'] = df['open_balance'].astype(str).str.replace(',', '', regex=False)
-    df['open_balance'] = df['open_balance'].astype(str).str.strip()
-    df['open_balance'] = pd.to_numeric(df['open_balance'], errors='coerce')
-    df['open_balance'] = df['open_balance'].fillna(0)
-    print("'open_balance' procesado exitosamente.")
-else:
-    print("La columna 'open_balance' no se encontró.")
-
 # --- Preparación final para la inserción ---
-# Usaremos todos los datos del CSV que fueron mapeados correctamente.
-df_to_insert = df.dropna(subset=['id_cliente']).copy()
-
-# Convertimos a entero DESPUÉS de eliminar los NaN para evitar errores.
-df_to_insert['id_cliente'] = df_to_insert['id_cliente'].astype(int)
+# Usaremos todos los datos del CSV que fueron mapeados correctamente. Las filas sin cliente siguen el mismo
+# camino (columnas, antigüedad, fechas) y se apartan antes de insertar para guardarlas en la cuarentena.
+sin_cliente = df['id_cliente'].isna()
 
 print(f"\nTotal de filas en el DataFrame de origen: {len(df)}")
-print(f"Filas a insertar (snapshot diario completo): {len(df_to_insert)}")
-
-# Se eliminan las columnas que ya no son necesarias para la tabla final
-columns_to_drop = ['nombre_cliente', 'nombre_cliente_cleaned', 'zona_csv_original']
-df_to_insert = df_to_insert.drop(columns=columns_to_drop, errors='ignore')
-
-# Se formatean las columnas de fecha al formato YYYY-MM-DD
-if 'fecha_facturacion' in df_to_insert.columns:
-    df_to_insert['fecha_facturacion'] = pd.to_datetime(df_to_insert['fecha_facturacion'], errors='coerce').dt.strftime('%Y-%m-%d')
-if 'fecha_pago' in df_to_insert.columns:
-    df_to_insert['fecha_pago'] = pd.to_datetime(df_to_insert['fecha_pago'], errors='coerce').dt.strftime('%Y-%m-%d')
+print(f"Filas a insertar (snapshot diario completo): {(~sin_cliente).sum()}")
+metricas.contar(TABLE_NAME, 'mapeadas', (~sin_cliente).sum())
+# El snapshot se carga completo: no hay deduplicación contra la tabla
+metricas.contar(TABLE_NAME, 'deduplicadas', (~sin_cliente).sum())
+
+# --- Antigüedad de saldos calculada contra la fecha de carga, fechas y cuarentena (ver transformaciones.py) ---
+FECHA_CARGA = date.today()
+df_to_insert, df_cuarentena = preparar_snapshot_cartera(df, FECHA_CARGA)
+print("Días vencidos y rango de antigüedad calculados.")
+
+def asegurar_columnas_antiguedad(connection):
+    """Agrega a la tabla de cartera las columnas de antigüedad si todavía no existen."""
+    connection.execute(text(f"""
+        IF COL_LENGTH(N'{TABLE_NAME}', N'dias_vencido') IS NULL
+            ALTER TABLE {TABLE_NAME} ADD dias_vencido INT NULL;
+        IF COL_LENGTH(N'{TABLE_NAME}', N'rango_antiguedad') IS NULL
+            ALTER TABLE {TABLE_NAME} ADD rango_antiguedad NVARCHAR(10) NULL;
+    """))
+
+def guardar_resumen_antiguedad(connection, df_resumen):
+    """Reemplaza el resumen de antigüedad del día (una nueva corrida del mismo día no lo duplica)."""
+    connection.execute(text(f"""
+        IF OBJECT_ID(N'{ANTIGUEDAD_TABLE_NAME}', N'U') IS NULL
+            CREATE TABLE {ANTIGUEDAD_TABLE_NAME} (
+                FechaCarga DATE NOT NULL,
+                id_zone NVARCHAR(100) NOT NULL,
+                id_cliente INT NOT NULL,
+                rango_antiguedad NVARCHAR(10) NOT NULL,
+                documentos INT NOT NULL,
+                open_balance DECIMAL(19, 4) NOT NULL,
+                dias_vencido_max INT NULL,
+                CONSTRAINT PK_{ANTIGUEDAD_TABLE_NAME} PRIMARY KEY (FechaCarga, id_zone, id_cliente, rango_antiguedad)
+            );
+    """))
+    connection.execute(text(f"DELETE FROM {ANTIGUEDAD_TABLE_NAME} WHERE FechaCarga = :fecha_carga;"), {'fecha_carga': FECHA_CARGA})
+    df_resumen.to_sql(ANTIGUEDAD_TABLE_NAME, con=connection, if_exists='append', index=False)
+
+def guardar_cuarentena(connection):
+    # La cuarentena del día se reemplaza junto con el snapshot (una nueva corrida no la duplica)
+    guardar_en_cuarentena(connection, df_cuarentena, TABLE_NAME, input_file_path, ID_CARGA, fecha_carga=FECHA_CARGA)
 
 # --- Insertar en SQL Server ---
 if len(df_to_insert) == 0:
     print(f"No hay nuevos registros para insertar en la tabla '{TABLE_NAME}'. Proceso completado.")
+    with engine.begin() as connection:
+        guardar_cuarentena(connection)
 else:
     # AÑADIMOS LA FECHA DE CARGA A TODO EL LOTE
-    df_to_insert['FechaCarga'] = date.today()
+    df_to_insert['FechaCarga'] = FECHA_CARGA
     
     print(f"\nIniciando inserción por lotes en la tabla '{TABLE_NAME}'...")
-    BATCH_SIZE = 1000
-    rows_inserted_count = 0
+
+    def actualizar_resumen_antiguedad(connection):
+        # El resumen de antigüedad se escribe en la misma transacción que el snapshot
+        df_antiguedad = resumir_antiguedad(df_to_insert, FECHA_CARGA)
+        guardar_resumen_antiguedad(connection, df_antiguedad)
+        print(f"Resumen de antigüedad '{ANTIGUEDAD_TABLE_NAME}' actualizado: {len(df_antiguedad)} filas.")
+
+    # Conciliación por zona con un solo agregado sobre la FechaCarga, en la misma transacción que el snapshot.
+    # En modo 'agregar' la fecha puede tener filas de una corrida anterior: se compara la diferencia.
+    antes_conciliacion, verificar_conciliacion = ganchos_conciliacion(
+        TABLE_NAME, df_to_insert, 'open_balance', 'id_zone', "WHERE t.FechaCarga = :fecha", {'fecha': FECHA_CARGA},
+        incremental=MODO_SNAPSHOT == 'agregar')
+
+    def antes_del_snapshot(connection):
+        asegurar_columnas_antiguedad(connection)
+        antes_conciliacion(connection)
+
+    def despues_del_snapshot(connection):
+        verificar_conciliacion(connection)
+        actualizar_resumen_antiguedad(connection)
+        guardar_cuarentena(connection)
+
     try:
-        with engine.connect() as connection_insert_records:
-            with connection_insert_records.begin():
-                for i in range(0, len(df_to_insert), BATCH_SIZE):
-                    batch_df = df_to_insert.iloc[i: i + BATCH_SIZE].copy()
-                    
-                    # Asegúrate de que las columnas coinciden con la tabla de destino
-                    # Esto es importante si la tabla SQL tiene un orden específico
-                    # Por ahora, to_sql manejará el mapeo por nombre de columna
-                    
-                    batch_df.to_sql(TABLE_NAME, con=connection_insert_records, if_exists='append', index=False, chunksize=None)
-                    rows_inserted_count += len(batch_df)
-                    print(f"Lote insertado exitosamente: filas {i} a {min(i + BATCH_SIZE, len(df_to_insert))}")
+        # to_sql mapea las columnas por nombre, así que el orden de la tabla de destino no importa
+        # El snapshot del día y su resumen de antigüedad reemplazan, en una sola transacción, a los de una corrida anterior
+        rows_inserted_count = reemplazar_snapshot(engine, df_to_insert, TABLE_NAME, 'FechaCarga', FECHA_CARGA,
+                                                  antes=antes_del_snapshot, despues=despues_del_snapshot, id_carga=ID_CARGA)
         print(f"\nProceso de carga de '{TABLE_NAME}' finalizado. Total de filas insertadas: {rows_inserted_count}.")
+        # Copia del snapshot en Parquet, particionada por FechaCarga
+        escribir_parquet(df_to_insert, TABLE_NAME, ID_CARGA, columnas_particion=['FechaCarga'], reemplazar=True)
+    except ErrorConciliacion as e:
+        # La transacción se revirtió: el snapshot anterior del día queda intacto
+        metricas.registrar_error(TABLE_NAME, e)
+        metricas.finalizar(exitosa=False)
+        sys.exit(1)
     except (ProgrammingError, IntegrityError) as err:
         print(f"Error al insertar lote. Mensaje: {err}")
+        metricas.finalizar(exitosa=False)
     except Exception as e:
-        print(f"Ocurrió un error inesperado durante la inserción: {e}")
\ No newline at end of file
+        print(f"Ocurrió un error inesperado durante la inserción: {e}")
+        metricas.finalizar(exitosa=False)
+
+metricas.finalizar()
\ No newline at end of file
@@ -0,0 +1,161 @@
+# Cache local de la dimensión Clientes
+import os
+import re
+import sqlite3
+import threading
+import pandas as pd
+from sqlalchemy import text
+
+# --- Configuración del Cache ---
+CLIENTES_TABLE_NAME = 'Clientes'
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+CLIENTES_COLUMNS = ['id_cliente', 'nombre_cliente', 'id_zone', 'nombre_cliente_cleaned']
+
+# Último estado del cache por archivo (clientes, completo, firma), para no releer el SQLite en cada bloque
+_cache_en_memoria = {}
+# Las cargas que corren en paralelo (ej. tablas del WOR) comparten el cache y el archivo SQLite
+_cache_lock = threading.Lock()
+
+# Función de limpieza robusta para nombres de cliente
+def clean_customer_name(name):
+    if pd.isna(name):
+        return None
+    name = str(name).strip().lower()
+    name = re.sub(r'[^a-z0-9\s]', '', name)
+    name = re.sub(r'\s+', ' ', name).strip()
+    return name
+
+def _normalizar_nombres(nombres):
+    """Convierte los nombres del archivo a minúsculas y sin espacios, sin duplicados."""
+    serie = pd.Series(list(nombres), dtype=object).dropna().astype(str)
+    return set(serie.str.lower().str.strip()) - {''}
+
+def _ruta_cache(engine):
+    """Obtiene la ruta del archivo de cache para el servidor y base de datos del engine."""
+    servidor = re.sub(r'[^A-Za-z0-9_.-]', '_', str(engine.url.host or 'local'))
+    base_datos = re.sub(r'[^A-Za-z0-9_.-]', '_', str(engine.url.database or 'default'))
+    return os.path.join(CACHE_DIR, f"clientes_{servidor}_{base_datos}.sqlite")
+
+def _firma_clientes(connection):
+    """Consulta barata que cambia cada vez que cambia el contenido de la tabla Clientes."""
+    firma_query = text(
+        f"SELECT COUNT_BIG(*) AS total, "
+        f"CHECKSUM_AGG(BINARY_CHECKSUM(id_cliente, nombre_cliente, id_zone)) AS checksum "
+        f"FROM {CLIENTES_TABLE_NAME};"
+    )
+    row = connection.execute(firma_query).one()
+    return f"{row.total}:{row.checksum}"
+
+def _leer_cache(ruta):
+    """Lee los clientes y metadatos guardados localmente. Devuelve (clientes, firma, completo)."""
+    vacio = pd.DataFrame(columns=CLIENTES_COLUMNS)
+    if not os.path.exists(ruta):
+        return vacio, None, False
+    try:
+        with sqlite3.connect(ruta) as sqlite_conn:
+            metadatos = dict(sqlite_conn.execute("SELECT clave, valor FROM metadatos").fetchall())
+            clientes = pd.read_sql_query("SELECT * FROM clientes", sqlite_conn)
+        return clientes, metadatos.get('firma'), metadatos.get('completo') == '1'
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        print(f"Advertencia: No se pudo leer el cache de clientes '{ruta}'. Se reconstruirá. Error: {e}")
+        return vacio, None, False
+
+def _guardar_cache(ruta, clientes, firma, completo):
+    """Reemplaza el contenido del cache local."""
+    os.makedirs(os.path.dirname(ruta) or '.', exist_ok=True)
+    try:
+        with sqlite3.connect(ruta) as sqlite_conn:
+            clientes[CLIENTES_COLUMNS].to_sql('clientes', sqlite_conn, if_exists='replace', index=False)
+            sqlite_conn.execute("CREATE TABLE IF NOT EXISTS metadatos (clave TEXT PRIMARY KEY, valor TEXT)")
+            sqlite_conn.executemany(
+                "INSERT OR REPLACE INTO metadatos (clave, valor) VALUES (?, ?)",
+                [('firma', firma), ('completo', '1' if completo else '0')]
+            )
+    except sqlite3.Error as e:
+        print(f"Advertencia: No se pudo guardar el cache de clientes '{ruta}'. Error: {e}")
+
+def _preparar_clientes(clientes):
+    """Agrega el nombre normalizado a los clientes leídos de la base de datos."""
+    clientes = clientes[['id_cliente', 'nombre_cliente', 'id_zone']]
+    clientes['nombre_cliente_cleaned'] = clientes['nombre_cliente'].apply(clean_customer_name)
+    return clientes
+
+def _consultar_por_nombres(connection, nombres):
+    """Trae solo los clientes cuyo nombre aparece en el archivo, mediante un semi-join con una tabla temporal."""
+    # Con la columna calculada nombre_cliente_clave (ver esquema.py) la búsqueda es un seek sobre su índice
+    tiene_clave = connection.execute(
+        text(f"SELECT COL_LENGTH(N'{CLIENTES_TABLE_NAME}', N'nombre_cliente_clave');")
+    ).scalar() is not None
+    clave = "c.nombre_cliente_clave" if tiene_clave else "LOWER(LTRIM(RTRIM(c.nombre_cliente)))"
+    connection.execute(text("CREATE TABLE #nombres_archivo (nombre NVARCHAR(450) COLLATE DATABASE_DEFAULT PRIMARY KEY);"))
+    try:
+        connection.execute(
+            text("INSERT INTO #nombres_archivo (nombre) VALUES (:nombre);"),
+            [{'nombre': nombre[:450]} for nombre in sorted(nombres)]
+        )
+        semi_join_query = text(
+            f"SELECT c.id_cliente, c.nombre_cliente, c.id_zone FROM {CLIENTES_TABLE_NAME} c "
+            f"WHERE EXISTS (SELECT 1 FROM #nombres_archivo n WHERE n.nombre = {clave});"
+        )
+        return pd.read_sql_query(semi_join_query, connection)
+    finally:
+        connection.execute(text("DROP TABLE #nombres_archivo;"))
+
+def revalidar_cache(engine):
+    """
+    Compara la firma de la tabla Clientes con la guardada en el cache local.
+    Si cambió, descarta el cache. Devuelve (clientes, completo, firma).
+    """
+    ruta = _ruta_cache(engine)
+    clientes, firma_cache, completo = _leer_cache(ruta)
+    with engine.connect() as connection:
+        firma_actual = _firma_clientes(connection)
+    if firma_cache != firma_actual:
+        if firma_cache is not None:
+            print("La tabla Clientes cambió desde la última carga. Se invalida el cache local de clientes.")
+        clientes, completo = pd.DataFrame(columns=CLIENTES_COLUMNS), False
+        _guardar_cache(ruta, clientes, firma_actual, completo)
+    return clientes, completo, firma_actual
+
+def obtener_clientes(engine, nombres, cache=None):
+    """
+    Devuelve los clientes (id_cliente, nombre_cliente, id_zone, nombre_cliente_cleaned) necesarios
+    para mapear los nombres del archivo. Solo consulta la base de datos por los nombres que no están
+    en el cache local; si aun así quedan nombres sin resolver, descarga la tabla completa una única vez.
+    Dentro de la misma ejecución (ej. carga por bloques) se reutilizan los clientes ya resueltos.
+    """
+    with _cache_lock:
+        return _obtener_clientes(engine, nombres, cache)
+
+def _obtener_clientes(engine, nombres, cache):
+    ruta = _ruta_cache(engine)
+    if ruta in _cache_en_memoria:
+        clientes, completo, firma = _cache_en_memoria[ruta]
+    else:
+        clientes, completo, firma = cache if cache is not None else revalidar_cache(engine)
+        _cache_en_memoria[ruta] = (clientes, completo, firma)
+    nombres_archivo = _normalizar_nombres(nombres)
+    nombres_cache = set(clientes['nombre_cliente'].dropna().astype(str).str.lower().str.strip())
+    faltantes = nombres_archivo - nombres_cache
+
+    if not faltantes or completo:
+        print(f"Clientes obtenidos del cache local ({len(clientes)} en cache).")
+        return clientes
+
+    with engine.connect() as connection:
+        encontrados = _preparar_clientes(_consultar_por_nombres(connection, faltantes))
+        clientes = pd.concat([clientes, encontrados], ignore_index=True)
+        clientes = clientes.drop_duplicates(subset=['id_cliente'], keep='last')
+        print(f"Se consultaron {len(faltantes)} nombres nuevos en '{CLIENTES_TABLE_NAME}'; se encontraron {len(encontrados)}.")
+
+        # Los nombres que aún no resuelven pueden diferir solo en puntuación; se descarga la dimensión completa
+        cleaned_archivo = {clean_customer_name(nombre) for nombre in nombres_archivo}
+        if not cleaned_archivo <= set(clientes['nombre_cliente_cleaned'].dropna()):
+            clientes_query = text(f"SELECT id_cliente, nombre_cliente, id_zone FROM {CLIENTES_TABLE_NAME};")
+            clientes = _preparar_clientes(pd.read_sql_query(clientes_query, connection))
+            completo = True
+            print(f"Se descargó la tabla '{CLIENTES_TABLE_NAME}' completa ({len(clientes)} clientes) al cache local.")
+
+    _guardar_cache(ruta, clientes, firma, completo)
+    _cache_en_memoria[ruta] = (clientes, completo, firma)
+    return clientes
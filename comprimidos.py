@@ -0,0 +1,73 @@
+# Lectura directa de reportes comprimidos (.zip / .gz): se descomprimen a medida que se leen, sin extraerlos a disco
+import os
+import re
+import io
+import gzip
+import struct
+import zipfile
+import functools
+import contextlib
+
+EXTENSIONES_COMPRIMIDAS = ('.zip', '.gz')
+
+def extension_reporte(nombre):
+    """Extensión del reporte sin la compresión: 'ventas.csv.gz' -> '.csv'."""
+    base = nombre[:-3] if nombre.lower().endswith('.gz') else nombre
+    return os.path.splitext(base)[1].lower()
+
+def _miembros_zip(archivo_zip, extensiones, patron):
+    """Reportes del zip con extensión soportada. Si hay varios, solo los cuyo nombre coincide con el patrón del reporte."""
+    miembros = [
+        miembro for miembro in archivo_zip.infolist()
+        if not miembro.is_dir() and '__MACOSX' not in miembro.filename
+        and not os.path.basename(miembro.filename).startswith(('.', '~$'))
+        and extension_reporte(miembro.filename) in extensiones
+    ]
+    if len(miembros) > 1 and patron:
+        miembros = [miembro for miembro in miembros if re.search(patron, os.path.basename(miembro.filename), re.IGNORECASE)]
+    return miembros
+
+@contextlib.contextmanager
+def _abrir_miembro_zip(ruta, nombre):
+    with zipfile.ZipFile(ruta) as archivo_zip, archivo_zip.open(nombre) as miembro:
+        if nombre.lower().endswith('.gz'):
+            with gzip.GzipFile(fileobj=miembro) as descomprimido:
+                yield descomprimido
+        else:
+            yield miembro
+
+def fuentes_reporte(ruta, extensiones, patron=None):
+    """
+    Devuelve [(nombre, abrir)] con los reportes que contiene la ruta: el archivo mismo, el contenido de un
+    .gz o los reportes de un .zip (que puede traer varios). 'abrir()' es un context manager que entrega la
+    ruta si el archivo no está comprimido, o un stream binario que se descomprime a medida que se lee.
+    """
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension == '.zip':
+        with zipfile.ZipFile(ruta) as archivo_zip:
+            miembros = _miembros_zip(archivo_zip, extensiones, patron)
+            todos = [miembro.filename for miembro in archivo_zip.infolist() if not miembro.is_dir()]
+        if not miembros:
+            raise ValueError(f"El archivo '{os.path.basename(ruta)}' no contiene un reporte ({', '.join(extensiones)}) "
+                             f"que corresponda a esta carga. Contenido: {', '.join(todos) or 'vacío'}")
+        return [(miembro.filename, functools.partial(_abrir_miembro_zip, ruta, miembro.filename)) for miembro in miembros]
+    if extension == '.gz':
+        return [(os.path.basename(ruta)[:-3], functools.partial(gzip.open, ruta, 'rb'))]
+    return [(os.path.basename(ruta), functools.partial(contextlib.nullcontext, ruta))]
+
+def tamano_descomprimido(ruta, nombres):
+    """Tamaño en bytes de los reportes ya descomprimidos (sin descomprimirlos)."""
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension == '.zip':
+        with zipfile.ZipFile(ruta) as archivo_zip:
+            return sum(archivo_zip.getinfo(nombre).file_size for nombre in nombres)
+    if extension == '.gz':
+        # Los últimos 4 bytes del .gz guardan el tamaño original (módulo 2^32)
+        with open(ruta, 'rb') as archivo:
+            archivo.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', archivo.read(4))[0]
+    return os.path.getsize(ruta)
+
+def como_archivo_excel(fuente):
+    """Un libro de Excel necesita acceso aleatorio: el stream descomprimido se pasa en memoria, no a un temporal."""
+    return fuente if isinstance(fuente, str) else io.BytesIO(fuente.read())
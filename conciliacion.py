@@ -0,0 +1,105 @@
+# Conciliación de cada carga: totales de control calculados en pandas contra el mismo agregado en SQL Server
+# (una sola consulta agrupada sobre las filas de la carga, sin volver a leerlas) y contra el pie del reporte.
+import os
+import pandas as pd
+from sqlalchemy import text
+
+# --- Configuración de la Conciliación ---
+# Diferencia de monto tolerada por grupo (además del redondeo a 4 decimales de cada fila en DECIMAL(19, 4))
+TOLERANCIA_MONTO = float(os.environ.get("CONCILIACION_TOLERANCIA", "0.01"))
+REDONDEO_POR_FILA = 0.00005
+
+class ErrorConciliacion(ValueError):
+    """Los totales guardados no coinciden con los calculados durante la transformación."""
+
+def _clave_grupo(valor):
+    """Clave de grupo comparable entre pandas y SQL (1, 1.0, '1' y '1.0' son el mismo grupo; nulo es '')."""
+    if pd.isna(valor):
+        return ''
+    clave = str(valor).strip()
+    try:
+        numero = float(clave)
+    except ValueError:
+        return clave
+    return str(int(numero)) if numero.is_integer() else clave
+
+def totales_control(df, columna_monto, columna_grupo):
+    """Filas y suma del monto por grupo: {grupo: (filas, monto)}."""
+    montos = pd.to_numeric(df[columna_monto], errors='coerce').fillna(0)
+    grupos = df[columna_grupo].map(_clave_grupo)
+    resumen = montos.groupby(grupos).agg(['size', 'sum'])
+    return {grupo: (int(fila['size']), float(fila['sum'])) for grupo, fila in resumen.iterrows()}
+
+def consulta_totales(table_name, columna_monto, columna_grupo, filtro):
+    """Agregado de control en el servidor; 'filtro' (JOIN/WHERE sobre el alias t) limita a las filas de la carga."""
+    return text(f"""
+        SELECT CAST(t.[{columna_grupo}] AS NVARCHAR(100)) AS grupo,
+               COUNT_BIG(*) AS filas,
+               SUM(TRY_CAST(t.[{columna_monto}] AS DECIMAL(19, 4))) AS monto
+        FROM {table_name} t
+        {filtro}
+        GROUP BY CAST(t.[{columna_grupo}] AS NVARCHAR(100));
+    """)
+
+def totales_en_servidor(connection, consulta, params):
+    """Ejecuta el agregado de control y lo devuelve con las mismas claves que totales_control."""
+    totales = {}
+    for fila in connection.execute(consulta, params):
+        grupo = _clave_grupo(fila.grupo)
+        filas, monto = totales.get(grupo, (0, 0.0))
+        totales[grupo] = (filas + int(fila.filas), monto + float(fila.monto or 0))
+    return totales
+
+def comparar_totales(table_name, esperados, obtenidos):
+    """Compara filas y monto por grupo. Si algo no cuadra lo informa y lanza ErrorConciliacion."""
+    diferencias = []
+    for grupo in sorted(set(esperados) | set(obtenidos)):
+        filas_esperadas, monto_esperado = esperados.get(grupo, (0, 0.0))
+        filas_obtenidas, monto_obtenido = obtenidos.get(grupo, (0, 0.0))
+        tolerancia = TOLERANCIA_MONTO + REDONDEO_POR_FILA * max(filas_esperadas, filas_obtenidas)
+        if filas_esperadas != filas_obtenidas or abs(monto_esperado - monto_obtenido) > tolerancia:
+            diferencias.append(f"   - Grupo '{grupo or '(vacío)'}': esperado {filas_esperadas} filas / {monto_esperado:,.2f}, "
+                               f"guardado {filas_obtenidas} filas / {monto_obtenido:,.2f}")
+    if diferencias:
+        print(f"¡ERROR DE CONCILIACIÓN! Los totales guardados en '{table_name}' no coinciden con los del archivo:")
+        print("\n".join(diferencias))
+        raise ErrorConciliacion(f"{len(diferencias)} grupos no concilian en '{table_name}'.")
+    filas = sum(filas for filas, _ in esperados.values())
+    monto = sum(monto for _, monto in esperados.values())
+    print(f"Conciliación de '{table_name}' correcta: {filas} filas y monto {monto:,.2f} en {len(esperados)} grupos.")
+
+def ganchos_conciliacion(table_name, df, columna_monto, columna_grupo, filtro, params, incremental=False):
+    """
+    Devuelve los ganchos (antes, despues) para insertar_por_lotes / reemplazar_snapshot. 'despues' corre el
+    agregado de control en la misma transacción de la carga: si no concilia, la excepción la revierte.
+    Con 'incremental' (el filtro también abarca filas que ya estaban) 'antes' toma el mismo agregado y se
+    compara la diferencia.
+    """
+    previos = {}
+
+    def antes(connection):
+        previos.clear()
+        if incremental:
+            previos.update(totales_en_servidor(connection, consulta_totales(table_name, columna_monto, columna_grupo, filtro), params))
+
+    def despues(connection):
+        obtenidos = totales_en_servidor(connection, consulta_totales(table_name, columna_monto, columna_grupo, filtro), params)
+        for grupo, (filas, monto) in previos.items():
+            filas_obtenidas, monto_obtenido = obtenidos.get(grupo, (0, 0.0))
+            obtenidos[grupo] = (filas_obtenidas - filas, monto_obtenido - monto)
+        obtenidos = {grupo: total for grupo, total in obtenidos.items() if total != (0, 0.0)}
+        comparar_totales(table_name, totales_control(df, columna_monto, columna_grupo), obtenidos)
+
+    return antes, despues
+
+def verificar_total_pie(df, columna, table_name):
+    """Compara la suma de la columna con el total de la fila de pie del reporte (df.attrs['totales_pie'])."""
+    total_pie = df.attrs.get('totales_pie', {}).get(columna)
+    if total_pie is None:
+        print(f"¡ATENCIÓN! El reporte de '{table_name}' no trae total de '{columna}' en el pie; no se concilia contra el pie.")
+        return
+    total_filas = float(pd.to_numeric(df[columna], errors='coerce').fillna(0).sum())
+    if abs(total_filas - total_pie) > TOLERANCIA_MONTO:
+        print(f"¡ERROR DE CONCILIACIÓN! La suma de '{columna}' ({total_filas:,.2f}) no coincide con el total del pie del reporte ({total_pie:,.2f}).")
+        raise ErrorConciliacion(f"El total de '{columna}' no coincide con el pie del reporte de '{table_name}'.")
+    print(f"Total de '{columna}' conciliado con el pie del reporte: {total_pie:,.2f}.")
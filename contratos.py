@@ -0,0 +1,199 @@
+# Contratos de esquema de los reportes exportados
+# Cada contrato declara, por columna de destino: las columnas de origen aceptadas, el tipo, si admite
+# nulos (y con qué valor se rellenan) y el largo máximo. La lectura solo materializa esas columnas y
+# convierte los tipos durante el parseo, en lugar de leer todo como texto y corregirlo después.
+import numpy as np
+import pandas as pd
+from comprimidos import fuentes_reporte, extension_reporte, como_archivo_excel
+
+EXTENSIONES_REPORTE = ('.csv', '.xlsx', '.xls')
+
+# --- Contratos por Reporte ---
+# 'archivo' es el patrón del nombre del reporte; se usa para elegirlo cuando un .zip trae varios reportes.
+# 'pie' son las columnas cuyo total trae la última fila del reporte: esa fila se separa de los datos y sus
+# totales se guardan en df.attrs['totales_pie'] para conciliarlos con la suma de las filas (ver conciliacion.py).
+CONTRATOS = {
+    'ventas_totales': {
+        'archivo': r'venta',
+        'lectura': {},
+        'columnas': {
+            'nombre_cliente': {'origen': ['Company Name'], 'tipo': 'texto'},
+            'fecha': {'origen': ['Date'], 'tipo': 'fecha', 'formato': '%m/%d/%Y', 'errores': 'raise'},
+            'document_number': {'origen': ['Document Number'], 'tipo': 'texto'},
+            'tipo': {'origen': ['Type'], 'tipo': 'texto', 'requerida': False},
+            'item': {'origen': ['Item'], 'tipo': 'texto'},
+            'descripcion': {'origen': ['Description'], 'tipo': 'texto', 'requerida': False},
+            'clase': {'origen': ['Class'], 'tipo': 'texto', 'requerida': False},
+            'cantidad_producto': {'origen': ['Quantity'], 'tipo': 'decimal', 'requerida': False},
+            'presentacion': {'origen': ['UOM'], 'tipo': 'texto', 'requerida': False},
+            'amount': {'origen': ['Amount'], 'tipo': 'moneda'},
+            'created_from': {'origen': ['Created From'], 'tipo': 'texto', 'requerida': False},
+        },
+    },
+    'cartera': {
+        'archivo': r'cartera|aging|receivable',
+        'lectura': {'skiprows': 6},
+        'pie': ['open_balance'],
+        'columnas': {
+            'zona_csv_original': {'origen': ['Zones for Financial Reporting '], 'tipo': 'texto'},
+            'nombre_cliente': {'origen': ['Customer:Project '], 'tipo': 'texto'},
+            'tipo_transaccion': {'origen': ['Transaction Type '], 'tipo': 'texto'},
+            'fecha_facturacion': {'origen': ['Date '], 'tipo': 'fecha'},
+            'document_number': {'origen': ['Document Number '], 'tipo': 'texto'},
+            'fecha_pago': {'origen': ['Due Date '], 'tipo': 'fecha'},
+            'open_balance': {'origen': ['Open Balance '], 'tipo': 'moneda', 'nulo': False, 'defecto': 0.0},
+        },
+    },
+    'pending_orders': {
+        'archivo': r'pending|pendiente',
+        'lectura': {'skiprows': 6},
+        'pie': ['amount_net'],
+        'columnas': {
+            'nombre_cliente': {'origen': ['Customer '], 'tipo': 'texto'},
+            'amount_net': {'origen': ['Amount (Net) '], 'tipo': 'moneda', 'nulo': False, 'defecto': 0.0},
+            'document_number': {'origen': ['Document Number '], 'tipo': 'texto', 'largo_max': 20, 'nulo': False, 'defecto': ''},
+            'fecha': {'origen': ['Date '], 'tipo': 'fecha'},
+            'class_item': {'origen': ['Class Item '], 'tipo': 'texto', 'nulo': False, 'defecto': 'Descuento'},
+            'cantidad': {'origen': ['Quantity '], 'tipo': 'entero', 'nulo': False, 'defecto': 0},
+            # Según la versión del reporte el estado viene como 'Validated Status ' o como 'Status '
+            'estado': {'origen': ['Validated Status ', 'Status '], 'tipo': 'texto', 'largo_max': 50,
+                       'nulo': False, 'defecto': 'Desconocido', 'requerida': False},
+        },
+    },
+}
+
+# --- Conversores usados durante el parseo ---
+def _convertir_numero(valor):
+    """Convierte '1,234.5' a número; lo que no sea numérico queda como NaN."""
+    texto = str(valor).replace(',', '').strip()
+    try:
+        return float(texto)
+    except ValueError:
+        return np.nan
+
+def _convertir_moneda(valor):
+    """Convierte '$(1,234.50)' a -1234.5; lo que no sea numérico queda como NaN."""
+    texto = str(valor).replace('(', '-').replace(')', '').replace('$', '').replace(',', '').strip()
+    try:
+        return float(texto)
+    except ValueError:
+        return np.nan
+
+CONVERSORES = {
+    'entero': _convertir_numero,
+    'decimal': _convertir_numero,
+    'moneda': _convertir_moneda,
+}
+
+def columnas_origen(contrato):
+    """Diccionario columna de origen -> columna de destino."""
+    return {origen: destino for destino, spec in contrato['columnas'].items() for origen in spec['origen']}
+
+def opciones_lectura(contrato):
+    """Argumentos de read_csv/read_excel (usecols, dtype, converters) derivados del contrato."""
+    origenes = columnas_origen(contrato)
+    dtype, converters = {}, {}
+    for origen, destino in origenes.items():
+        tipo = contrato['columnas'][destino]['tipo']
+        if tipo == 'texto':
+            dtype[origen] = str
+        elif tipo in CONVERSORES:
+            converters[origen] = CONVERSORES[tipo]
+    return {'usecols': lambda columna: columna in origenes, 'dtype': dtype, 'converters': converters}
+
+def aplicar_contrato(df, contrato):
+    """Renombra, verifica columnas requeridas y aplica fechas, nulos y largos máximos."""
+    renombres, faltantes = {}, []
+    for destino, spec in contrato['columnas'].items():
+        presentes = [origen for origen in spec['origen'] if origen in df.columns]
+        if not presentes:
+            if spec.get('requerida', True):
+                faltantes.append(' / '.join(spec['origen']))
+            continue
+        renombres[presentes[0]] = destino
+        # Si vienen varias alternativas se usa la primera
+        df = df.drop(columns=presentes[1:])
+    if faltantes:
+        raise ValueError(f"Faltan columnas requeridas en el archivo: {', '.join(faltantes)}")
+    df = df.rename(columns=renombres)
+
+    for destino, spec in contrato['columnas'].items():
+        if destino not in df.columns:
+            continue
+        tipo = spec['tipo']
+        if tipo == 'fecha':
+            df[destino] = pd.to_datetime(df[destino], format=spec.get('formato'), errors=spec.get('errores', 'coerce'))
+        if tipo == 'texto' and 'largo_max' in spec:
+            df[destino] = df[destino].str.strip().str[:spec['largo_max']]
+        if spec.get('nulo', True) is False:
+            if 'defecto' in spec:
+                df[destino] = df[destino].fillna(spec['defecto'])
+            elif df[destino].isna().any():
+                raise ValueError(f"La columna '{destino}' tiene {df[destino].isna().sum()} valores vacíos y no admite nulos.")
+        if tipo == 'entero' and not df[destino].isna().any():
+            df[destino] = df[destino].astype(int)
+    return df
+
+def fuentes_con_contrato(input_file_path, nombre_contrato):
+    """Reportes a leer para el contrato: el archivo, el contenido de un .gz o los reportes que correspondan de un .zip."""
+    return fuentes_reporte(input_file_path, EXTENSIONES_REPORTE, CONTRATOS[nombre_contrato].get('archivo'))
+
+def _leer_fuente(nombre, abrir, contrato, opciones):
+    """Lee un reporte (ruta o stream descomprimido) con las opciones del contrato."""
+    file_extension = extension_reporte(nombre)
+    with abrir() as fuente:
+        if file_extension == '.csv':
+            return pd.read_csv(fuente, **opciones, **contrato['lectura'])
+        if file_extension in ['.xlsx', '.xls']:
+            lectura = {k: v for k, v in contrato['lectura'].items() if k != 'engine'}
+            return pd.read_excel(como_archivo_excel(fuente), **opciones, **lectura)
+    raise ValueError(f"Formato de archivo no soportado: {file_extension}. Solo se permiten archivos .csv, .xlsx y .xls (también dentro de .zip o .gz)")
+
+def _separar_pie(df, contrato):
+    """Separa la fila de totales del final del reporte. Devuelve (filas, {columna de destino: total del pie})."""
+    if df.empty:
+        return df, {}
+    pie = df.iloc[-1]
+    totales = {}
+    for destino in contrato['pie']:
+        origen = next((origen for origen in contrato['columnas'][destino]['origen'] if origen in df.columns), None)
+        valor = pd.to_numeric(pie[origen], errors='coerce') if origen else np.nan
+        if not pd.isna(valor):
+            totales[destino] = float(valor)
+    return df.iloc[:-1], totales
+
+def _leer_en_bloques(fuentes, contrato, opciones, chunksize):
+    """Generador de bloques ya procesados de todos los reportes; cada stream se descomprime a medida que se lee."""
+    for nombre, abrir in fuentes:
+        with abrir() as fuente:
+            for bloque in pd.read_csv(fuente, chunksize=chunksize, **opciones, **contrato['lectura']):
+                yield aplicar_contrato(bloque, contrato)
+
+def leer_con_contrato(input_file_path, nombre_contrato, chunksize=None):
+    """
+    Lee un CSV o Excel aplicando el contrato del reporte: solo las columnas necesarias y ya tipadas.
+    Acepta también .gz y .zip (si el zip trae varios reportes del mismo tipo se leen todos y se concatenan).
+    Con 'chunksize' (solo CSV) devuelve un generador de bloques ya procesados, para archivos que no caben en memoria.
+    """
+    contrato = CONTRATOS[nombre_contrato]
+    opciones = opciones_lectura(contrato)
+    fuentes = fuentes_con_contrato(input_file_path, nombre_contrato)
+    if chunksize:
+        no_csv = [nombre for nombre, _ in fuentes if extension_reporte(nombre) != '.csv']
+        if no_csv:
+            raise ValueError(f"La lectura por bloques solo está soportada para archivos .csv (recibido: {', '.join(no_csv)}).")
+        return _leer_en_bloques(fuentes, contrato, opciones, chunksize)
+    partes, totales_pie = [], {}
+    for nombre, abrir in fuentes:
+        df = _leer_fuente(nombre, abrir, contrato, opciones)
+        if contrato.get('pie'):
+            df, totales = _separar_pie(df, contrato)
+            for columna, total in totales.items():
+                totales_pie[columna] = totales_pie.get(columna, 0.0) + total
+        partes.append(aplicar_contrato(df, contrato))
+        if len(fuentes) > 1:
+            print(f" -> Reporte '{nombre}' leído: {len(partes[-1])} filas.")
+    df = partes[0] if len(partes) == 1 else pd.concat(partes, ignore_index=True)
+    if contrato.get('pie'):
+        df.attrs['totales_pie'] = totales_pie
+    return df
@@ -0,0 +1,300 @@
+# Cuarentena de filas con clientes no mapeados y su reproceso cuando el cliente ya existe en Clientes
+# Uso: python cuarentena.py                 -> reprocesa las filas de todas las tablas cuyos clientes ya se resuelven
+#      python cuarentena.py --tabla Cartera -> solo las de una tabla de destino
+import os
+import sys
+import uuid
+import argparse
+import pandas as pd
+from sqlalchemy import text
+import metricas
+
+# --- Configuración de la Cuarentena ---
+CUARENTENA_TABLE_NAME = 'Cuarentena_Clientes'
+
+# La fila se guarda en JSON con las mismas columnas que tendría en la tabla de destino, sin id_cliente
+DDL_CUARENTENA = f"""
+    CREATE TABLE {CUARENTENA_TABLE_NAME} (
+        id_cuarentena BIGINT IDENTITY(1, 1) NOT NULL CONSTRAINT PK_{CUARENTENA_TABLE_NAME} PRIMARY KEY,
+        tabla_destino NVARCHAR(128) NOT NULL,
+        nombre_cliente NVARCHAR(450) NOT NULL,
+        fila NVARCHAR(MAX) NOT NULL,
+        archivo_origen NVARCHAR(400) NULL,
+        id_carga CHAR(32) NOT NULL,
+        fecha_carga DATE NULL,
+        fecha_cuarentena DATETIME2(0) NOT NULL CONSTRAINT DF_{CUARENTENA_TABLE_NAME}_fecha DEFAULT SYSDATETIME(),
+        reprocesada DATETIME2(0) NULL,
+        INDEX IX_{CUARENTENA_TABLE_NAME}_pendientes (tabla_destino, reprocesada, nombre_cliente)
+    );
+"""
+
+def asegurar_cuarentena(connection):
+    """Crea la tabla de cuarentena si todavía no existe."""
+    connection.execute(text(f"IF OBJECT_ID(N'{CUARENTENA_TABLE_NAME}', N'U') IS NULL BEGIN {DDL_CUARENTENA} END"))
+
+def guardar_en_cuarentena(connection, df, tabla_destino, archivo_origen, id_carga, fecha_carga=None):
+    """
+    Guarda en la cuarentena las filas sin cliente. 'df' trae las columnas finales de la tabla de destino
+    (sin id_cliente) y 'nombre_cliente'. Con 'fecha_carga' (snapshots) primero se descarta la cuarentena
+    pendiente de ese día: el snapshot nuevo la reemplaza igual que a las filas de la tabla. Una fila idéntica
+    que ya está pendiente (otra corrida del mismo archivo) no se vuelve a guardar.
+    Se llama dentro de la transacción de la carga: si la carga falla, la cuarentena también se revierte.
+    """
+    asegurar_cuarentena(connection)
+    if fecha_carga is not None:
+        connection.execute(text(
+            f"DELETE FROM {CUARENTENA_TABLE_NAME} "
+            f"WHERE tabla_destino = :tabla AND fecha_carga = :fecha AND reprocesada IS NULL;"
+        ), {'tabla': tabla_destino, 'fecha': fecha_carga})
+    if df.empty:
+        return 0
+    filas = df.drop(columns=['nombre_cliente']).to_json(orient='records', lines=True, date_format='iso')
+    registros = pd.DataFrame({
+        'tabla_destino': tabla_destino,
+        'nombre_cliente': df['nombre_cliente'].astype(str).str.strip().str[:450].to_numpy(),
+        'fila': filas.rstrip('\n').split('\n'),
+        'archivo_origen': os.path.basename(str(archivo_origen))[:400],
+        'id_carga': id_carga,
+        'fecha_carga': fecha_carga,
+    })
+    # Una sola sentencia: OPENJSON reconstruye los registros y NOT EXISTS descarta los que ya están pendientes
+    guardadas = connection.execute(text(f"""
+        INSERT INTO {CUARENTENA_TABLE_NAME} (tabla_destino, nombre_cliente, fila, archivo_origen, id_carga, fecha_carga)
+        SELECT n.tabla_destino, n.nombre_cliente, n.fila, n.archivo_origen, n.id_carga, n.fecha_carga
+        FROM OPENJSON(:registros) WITH (
+            tabla_destino NVARCHAR(128), nombre_cliente NVARCHAR(450), fila NVARCHAR(MAX),
+            archivo_origen NVARCHAR(400), id_carga CHAR(32), fecha_carga DATE
+        ) n
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {CUARENTENA_TABLE_NAME} q
+            WHERE q.tabla_destino = n.tabla_destino AND q.reprocesada IS NULL
+              AND q.nombre_cliente = n.nombre_cliente AND q.fila = n.fila
+        );
+    """), {'registros': registros.to_json(orient='records', date_format='iso')}).rowcount
+    metricas.contar(CUARENTENA_TABLE_NAME, 'insertadas', guardadas)
+    repetidas = len(registros) - guardadas
+    print(f"Se guardaron {guardadas} filas de '{tabla_destino}' en la cuarentena '{CUARENTENA_TABLE_NAME}' "
+          f"({registros['nombre_cliente'].nunique()} clientes sin mapear)"
+          + (f"; {repetidas} ya estaban pendientes." if repetidas else "."))
+    return guardadas
+
+# --- Reproceso ---
+# Resúmenes que se recalculan para los clientes y fechas de las filas reprocesadas (#afectados)
+RESUMEN_VENTAS = """
+    IF OBJECT_ID(N'Ventas_Mensuales', N'U') IS NOT NULL
+    BEGIN
+        SELECT DISTINCT id_cliente, YEAR(fecha) AS año, MONTH(fecha) AS mes INTO #periodos FROM #afectados;
+        DELETE r FROM Ventas_Mensuales r JOIN #periodos p ON p.id_cliente = r.id_cliente AND p.año = r.año AND p.mes = r.mes;
+        INSERT INTO Ventas_Mensuales (id_cliente, clase, item, año, mes, amount, cantidad_producto, filas)
+        SELECT v.id_cliente, ISNULL(CAST(v.clase AS NVARCHAR(150)), ''), CAST(v.item AS NVARCHAR(150)),
+               YEAR(v.fecha), MONTH(v.fecha),
+               ISNULL(SUM(TRY_CAST(v.amount AS DECIMAL(19, 4))), 0),
+               ISNULL(SUM(TRY_CAST(v.cantidad_producto AS DECIMAL(19, 4))), 0),
+               COUNT(*)
+        FROM Ventas_Totales v
+        JOIN #periodos p ON p.id_cliente = v.id_cliente
+         AND v.fecha >= DATEFROMPARTS(p.año, p.mes, 1) AND v.fecha < DATEADD(MONTH, 1, DATEFROMPARTS(p.año, p.mes, 1))
+        GROUP BY v.id_cliente, ISNULL(CAST(v.clase AS NVARCHAR(150)), ''), CAST(v.item AS NVARCHAR(150)), YEAR(v.fecha), MONTH(v.fecha);
+        DROP TABLE #periodos;
+    END
+"""
+RESUMEN_CARTERA = """
+    IF OBJECT_ID(N'Cartera_Antiguedad', N'U') IS NOT NULL
+    BEGIN
+        SELECT DISTINCT id_cliente, fecha INTO #periodos FROM #afectados;
+        DELETE r FROM Cartera_Antiguedad r JOIN #periodos p ON p.id_cliente = r.id_cliente AND p.fecha = r.FechaCarga;
+        INSERT INTO Cartera_Antiguedad (FechaCarga, id_zone, id_cliente, rango_antiguedad, documentos, open_balance, dias_vencido_max)
+        SELECT c.FechaCarga, CAST(c.id_zone AS NVARCHAR(100)), c.id_cliente, ISNULL(c.rango_antiguedad, 'Sin fecha'),
+               COUNT(*), SUM(c.open_balance), MAX(c.dias_vencido)
+        FROM Cartera c JOIN #periodos p ON p.id_cliente = c.id_cliente AND p.fecha = c.FechaCarga
+        GROUP BY c.FechaCarga, CAST(c.id_zone AS NVARCHAR(100)), c.id_cliente, ISNULL(c.rango_antiguedad, 'Sin fecha');
+        DROP TABLE #periodos;
+    END
+"""
+
+# Cómo se reprocesa cada tabla de destino:
+# - 'criterio': cómo compara el nombre con Clientes el script de carga ('exacto': minúsculas y sin espacios
+#   en los extremos; 'limpio': clean_customer_name, sin puntuación).
+# - 'clave': deduplicación contra la tabla (las tablas de snapshot no la tienen).
+# - 'zona': expresión de id_zone cuando la zona viene del cliente (m = #mapa, f = la fila en cuarentena).
+# - 'resumen' y 'columna_fecha': resumen que se recalcula para las filas reprocesadas.
+DESTINOS = {
+    'Ventas_Totales': {'criterio': 'exacto', 'clave': ['id_cliente', 'fecha', 'document_number', 'item'],
+                       'resumen': RESUMEN_VENTAS, 'columna_fecha': 'fecha'},
+    'Forecast': {'criterio': 'exacto', 'clave': ['id_cliente', 'id_zone', 'mes', 'año']},
+    'Cuota_forecast': {'criterio': 'exacto', 'clave': ['id_cliente', 'id_zone', 'mes', 'año']},
+    'Cartera': {'criterio': 'limpio', 'zona': 'COALESCE(m.id_zone, f.id_zone)',
+                'resumen': RESUMEN_CARTERA, 'columna_fecha': 'FechaCarga'},
+    'Pending_Orders': {'criterio': 'limpio', 'zona': "COALESCE(m.id_zone, N'1')"},
+}
+
+def _tipo_columna(fila):
+    """Tipo SQL de una columna de la tabla de destino, para el WITH de OPENJSON."""
+    if fila.tipo in ('varchar', 'char', 'nvarchar', 'nchar', 'varbinary', 'binary'):
+        largo = 'max' if fila.max_length == -1 else fila.max_length // 2 if fila.tipo.startswith('n') else fila.max_length
+        return f"{fila.tipo}({largo})"
+    if fila.tipo in ('decimal', 'numeric'):
+        return f"{fila.tipo}({fila.precision}, {fila.scale})"
+    if fila.tipo in ('datetime2', 'datetimeoffset', 'time'):
+        return f"{fila.tipo}({fila.scale})"
+    return fila.tipo
+
+def _mapa_clientes(engine, pendientes):
+    """Resuelve los nombres en cuarentena con el cache de Clientes. Devuelve las filas de #mapa."""
+    from clientes_cache import obtener_clientes, clean_customer_name
+    clientes = obtener_clientes(engine, pendientes['nombre_cliente'].unique())
+    zonas = [None if pd.isna(zona) else str(int(zona)) for zona in pd.to_numeric(clientes['id_zone'], errors='coerce')]
+    por_criterio = {
+        'exacto': dict(zip(clientes['nombre_cliente'].astype(str).str.strip().str.lower(), zip(clientes['id_cliente'], zonas))),
+        'limpio': dict(zip(clientes['nombre_cliente_cleaned'], zip(clientes['id_cliente'], zonas))),
+    }
+    normalizar = {'exacto': lambda nombre: str(nombre).strip().lower(), 'limpio': clean_customer_name}
+    mapa = []
+    for fila in pendientes.itertuples(index=False):
+        criterio = DESTINOS[fila.tabla_destino]['criterio']
+        encontrado = por_criterio[criterio].get(normalizar[criterio](fila.nombre_cliente))
+        if encontrado:
+            mapa.append({'tabla_destino': fila.tabla_destino, 'nombre_cliente': fila.nombre_cliente,
+                         'id_cliente': int(encontrado[0]), 'id_zone': encontrado[1]})
+    return mapa
+
+def _reprocesar_tabla(connection, tabla):
+    """
+    Inserta en la tabla de destino, en una sola sentencia, las filas en cuarentena cuyos clientes están en
+    #mapa: OPENJSON reconstruye las columnas de cada fila y #mapa aporta id_cliente. Es un MERGE que nunca
+    coincide (equivale a INSERT ... SELECT) porque su OUTPUT, a diferencia del de INSERT, puede devolver el
+    id_cuarentena de origen: solo se marcan como reprocesadas las filas que realmente se escribieron.
+    Las que la deduplicación descarta siguen pendientes.
+    """
+    destino = DESTINOS[tabla]
+    columnas_query = text("""
+        SELECT c.name, t.name AS tipo, c.max_length, c.precision, c.scale
+        FROM sys.columns c JOIN sys.types t ON t.user_type_id = c.user_type_id
+        WHERE c.object_id = OBJECT_ID(:tabla) AND c.is_identity = 0 AND c.is_computed = 0;
+    """)
+    columnas_destino = {fila.name: _tipo_columna(fila) for fila in connection.execute(columnas_query, {'tabla': tabla})}
+    claves_json = connection.execute(text(f"""
+        SELECT DISTINCT j.[key] FROM {CUARENTENA_TABLE_NAME} q
+        JOIN #mapa m ON m.tabla_destino = q.tabla_destino AND m.nombre_cliente = q.nombre_cliente
+        CROSS APPLY OPENJSON(q.fila) j
+        WHERE q.tabla_destino = :tabla AND q.reprocesada IS NULL;
+    """), {'tabla': tabla}).scalars().all()
+    columnas_fila = [col for col in columnas_destino if col in claves_json and col != 'id_cliente']
+
+    seleccion = {'id_cliente': 'm.id_cliente'}
+    if 'zona' in destino:
+        seleccion['id_zone'] = destino['zona']
+    seleccion.update({col: f"f.[{col}]" for col in columnas_fila if col not in seleccion})
+    columnas = ', '.join(f"[{col}]" for col in seleccion)
+    con_tipos = ', '.join(f"[{col}] {columnas_destino[col]} '$.\"{col}\"'" for col in columnas_fila)
+    if destino.get('clave'):
+        # Una fila que quedó en cuarentena en dos cargas del mismo archivo se inserta una sola vez
+        numero_fila = f"ROW_NUMBER() OVER (PARTITION BY {', '.join(f'[{col}]' for col in destino['clave'])} ORDER BY id_cuarentena DESC)"
+        no_existe = "AND NOT EXISTS (SELECT 1 FROM {tabla} d WHERE {condicion})".format(
+            tabla=tabla, condicion=' AND '.join(f"d.[{col}] = filas.[{col}]" for col in destino['clave']))
+    else:
+        numero_fila, no_existe = "1", ""
+    connection.execute(text("CREATE TABLE #escritas (id_cuarentena BIGINT PRIMARY KEY, id_cliente INT, fecha DATE);"))
+    fecha_salida = f"inserted.[{destino['columna_fecha']}]" if destino.get('resumen') else "NULL"
+
+    insertadas = connection.execute(text(f"""
+        WITH filas_mapeadas AS (
+            SELECT {', '.join(f'{expresion} AS [{col}]' for col, expresion in seleccion.items())}, q.id_cuarentena
+            FROM {CUARENTENA_TABLE_NAME} q
+            JOIN #mapa m ON m.tabla_destino = q.tabla_destino AND m.nombre_cliente = q.nombre_cliente
+            CROSS APPLY OPENJSON(q.fila) WITH ({con_tipos}) f
+            WHERE q.tabla_destino = :tabla AND q.reprocesada IS NULL
+        ), filas AS (
+            SELECT *, {numero_fila} AS numero_fila FROM filas_mapeadas
+        )
+        MERGE INTO {tabla} AS t
+        USING (SELECT * FROM filas WHERE numero_fila = 1 {no_existe}) AS origen ON 1 = 0
+        WHEN NOT MATCHED THEN
+            INSERT ({columnas}) VALUES ({', '.join(f"origen.[{col}]" for col in seleccion)})
+        OUTPUT origen.id_cuarentena, inserted.[id_cliente], {fecha_salida} INTO #escritas (id_cuarentena, id_cliente, fecha);
+    """), {'tabla': tabla}).rowcount
+    resueltas = connection.execute(text(f"""
+        SELECT COUNT(*) FROM {CUARENTENA_TABLE_NAME} q
+        JOIN #mapa m ON m.tabla_destino = q.tabla_destino AND m.nombre_cliente = q.nombre_cliente
+        WHERE q.tabla_destino = :tabla AND q.reprocesada IS NULL;
+    """), {'tabla': tabla}).scalar()
+    connection.execute(text(f"""
+        UPDATE q SET reprocesada = SYSDATETIME()
+        FROM {CUARENTENA_TABLE_NAME} q JOIN #escritas e ON e.id_cuarentena = q.id_cuarentena;
+    """))
+    if destino.get('resumen'):
+        connection.execute(text("SELECT id_cliente, fecha INTO #afectados FROM #escritas;"))
+        connection.execute(text(destino['resumen']))
+        connection.execute(text("DROP TABLE #afectados;"))
+    connection.execute(text("DROP TABLE #escritas;"))
+    return resueltas, insertadas
+
+def reprocesar_cuarentena(engine, tablas=None):
+    """
+    Reprocesa la cuarentena: vuelve a mapear los clientes con el cache de Clientes y carga solo las filas cuyo
+    cliente ahora se resuelve. Todo corre en una transacción; solo las filas insertadas quedan marcadas como reprocesadas.
+    """
+    tablas = set(tablas or DESTINOS)
+    with engine.connect() as connection:
+        if connection.execute(text(f"SELECT OBJECT_ID(N'{CUARENTENA_TABLE_NAME}', N'U');")).scalar() is None:
+            print(f"La tabla '{CUARENTENA_TABLE_NAME}' no existe: no hay filas en cuarentena.")
+            return {}
+        pendientes = pd.read_sql_query(text(f"""
+            SELECT tabla_destino, nombre_cliente, COUNT(*) AS filas FROM {CUARENTENA_TABLE_NAME}
+            WHERE reprocesada IS NULL GROUP BY tabla_destino, nombre_cliente;
+        """), connection)
+    pendientes = pendientes[pendientes['tabla_destino'].isin(tablas & set(DESTINOS))]
+    if pendientes.empty:
+        print("No hay filas pendientes en la cuarentena.")
+        return {}
+    print(f"Filas pendientes en la cuarentena: {pendientes['filas'].sum()} ({pendientes['nombre_cliente'].nunique()} clientes).")
+
+    mapa = _mapa_clientes(engine, pendientes)
+    if not mapa:
+        print("Ninguno de los clientes en cuarentena existe todavía en la tabla Clientes.")
+        return {}
+
+    resultados = {}
+    with engine.begin() as connection:
+        connection.execute(text("""
+            CREATE TABLE #mapa (
+                tabla_destino NVARCHAR(128) COLLATE DATABASE_DEFAULT NOT NULL,
+                nombre_cliente NVARCHAR(450) COLLATE DATABASE_DEFAULT NOT NULL,
+                id_cliente INT NOT NULL,
+                id_zone NVARCHAR(100) NULL,
+                PRIMARY KEY (tabla_destino, nombre_cliente)
+            );
+        """))
+        connection.execute(text("INSERT INTO #mapa VALUES (:tabla_destino, :nombre_cliente, :id_cliente, :id_zone);"), mapa)
+        for tabla in sorted({fila['tabla_destino'] for fila in mapa}):
+            resueltas, insertadas = _reprocesar_tabla(connection, tabla)
+            resultados[tabla] = (resueltas, insertadas)
+            metricas.contar(tabla, 'insertadas', insertadas)
+            print(f" -> '{tabla}': {resueltas} filas con cliente resuelto, {insertadas} insertadas y marcadas como reprocesadas"
+                  + (f" ({resueltas - insertadas} ya estaban en la tabla y siguen pendientes)." if resueltas > insertadas else "."))
+        connection.execute(text("DROP TABLE #mapa;"))
+    return resultados
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    parser = argparse.ArgumentParser(description="Reprocesa las filas en cuarentena cuyos clientes ya existen en Clientes.")
+    parser.add_argument('--tabla', action='append', choices=sorted(DESTINOS), help="Tabla de destino a reprocesar (se puede repetir).")
+    args = parser.parse_args()
+
+    # Carga las variables de entorno desde el archivo .env (dentro del ejecutable si se empaquetó con PyInstaller)
+    load_dotenv(dotenv_path=os.path.join(sys._MEIPASS, '.env') if getattr(sys, 'frozen', False) else '.env')
+    SERVER_AND_PORT = f"{os.environ.get('SERVER_NAME')}:{os.environ.get('PORT')}"
+    connection_string = (f"mssql+pymssql://{os.environ.get('DB_USERNAME')}:{os.environ.get('DB_PASSWORD')}"
+                         f"@{SERVER_AND_PORT}/{os.environ.get('DATABASE_NAME')}")
+
+    metricas.iniciar('cuarentena', uuid.uuid4().hex)
+    try:
+        reprocesar_cuarentena(create_engine(connection_string), args.tabla)
+    except Exception as e:
+        print(f"Error al reprocesar la cuarentena: {e}")
+        print(f"Tipo de error: {type(e).__name__}")
+        metricas.finalizar(exitosa=False)
+        sys.exit(1)
+    metricas.finalizar()
@@ -0,0 +1,319 @@
+# Esquema esperado de la base de datos: tablas auxiliares, índices de deduplicación y búsqueda, y particionado de los snapshots
+# Uso: python esquema.py            -> compara con la base de datos y muestra lo que falta (no cambia nada)
+#      python esquema.py --aplicar  -> además crea lo que falta
+import os
+import sys
+import argparse
+import datetime
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from cuarentena import CUARENTENA_TABLE_NAME, DDL_CUARENTENA
+
+def get_env_path():
+    """Obtiene la ruta correcta del archivo .env."""
+    if getattr(sys, 'frozen', False):
+        # Estamos en un entorno PyInstaller
+        return os.path.join(sys._MEIPASS, '.env')
+    else:
+        # Estamos en un entorno de desarrollo normal
+        return '.env'
+
+# Carga las variables de entorno desde el archivo .env
+load_dotenv(dotenv_path=get_env_path())
+
+# --- Configuración de la Base de Datos ---
+SERVER_NAME = os.environ.get("SERVER_NAME")
+PORT = os.environ.get("PORT")
+DATABASE_NAME = os.environ.get("DATABASE_NAME")
+USERNAME = os.environ.get("DB_USERNAME")
+PASSWORD = os.environ.get("DB_PASSWORD")
+SERVER_AND_PORT = f"{SERVER_NAME}:{PORT}"
+connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
+
+# --- Configuración del Particionado ---
+# Días hacia adelante que se dejan con su propia partición (cada corrida con --aplicar agrega los que falten)
+DIAS_PARTICION_ADELANTE = int(os.environ.get("ESQUEMA_DIAS_PARTICION", "31"))
+
+# --- Esquema Esperado ---
+# Tablas auxiliares (la cuarentena también la crean los scripts de carga si falta). Ventas_Mensuales y
+# Cartera_Antiguedad las crean los propios scripts, porque al crearlas las inicializan con el histórico.
+TABLAS = {
+    'Reglas_Remapeo': """
+        CREATE TABLE Reglas_Remapeo (
+            id_regla INT IDENTITY(1, 1) NOT NULL CONSTRAINT PK_Reglas_Remapeo PRIMARY KEY,
+            conjunto NVARCHAR(50) NOT NULL,
+            zona NVARCHAR(150) NULL,
+            nombre NVARCHAR(300) NULL,
+            nueva_zona NVARCHAR(150) NULL,
+            nuevo_nombre NVARCHAR(300) NULL,
+            id_destino INT NULL,
+            activa BIT NOT NULL CONSTRAINT DF_Reglas_Remapeo_activa DEFAULT 1
+        );
+        CREATE INDEX IX_Reglas_Remapeo_conjunto ON Reglas_Remapeo (conjunto, activa);
+    """,
+    CUARENTENA_TABLE_NAME: DDL_CUARENTENA,
+}
+
+# Columnas calculadas: el nombre normalizado de Clientes permite buscar por nombre con un seek
+COLUMNAS_CALCULADAS = [
+    {'tabla': 'Clientes', 'nombre': 'nombre_cliente_clave',
+     'expresion': 'CAST(LOWER(LTRIM(RTRIM(nombre_cliente))) AS NVARCHAR(450))'},
+]
+
+# Índices de las consultas de deduplicación y búsqueda. Un índice existente con otro nombre sirve si sus
+# columnas clave empiezan con las declaradas (en el mismo orden) e incluye el resto de las columnas.
+INDICES = [
+    {'tabla': 'Ventas_Totales', 'nombre': 'IX_Ventas_Totales_dedup',
+     'clave': ['id_cliente', 'fecha', 'document_number', 'item'], 'incluidas': []},
+    # En el WOR la deduplicación se filtra por los años y meses del libro (ver wor2.py)
+    {'tabla': 'Forecast', 'nombre': 'IX_Forecast_dedup',
+     'clave': ['año', 'mes', 'id_zone', 'id_cliente'], 'incluidas': []},
+    {'tabla': 'Cuotas_Avance_Categoria', 'nombre': 'IX_Cuotas_Avance_Categoria_dedup',
+     'clave': ['año', 'mes', 'id_zone', 'id_producto'], 'incluidas': []},
+    {'tabla': 'Cuota_forecast', 'nombre': 'IX_Cuota_forecast_dedup',
+     'clave': ['año', 'mes', 'id_zone', 'id_cliente'], 'incluidas': []},
+    {'tabla': 'Clientes', 'nombre': 'IX_Clientes_nombre_clave',
+     'clave': ['nombre_cliente_clave'], 'incluidas': ['id_cliente', 'id_zone']},
+]
+
+# Snapshots diarios: una partición por FechaCarga permite reemplazar el día con SWITCH (ver snapshot.py)
+PARTICIONES = [
+    {'tabla': 'Cartera', 'columna': 'FechaCarga'},
+    {'tabla': 'Pending_Orders', 'columna': 'FechaCarga'},
+]
+TIPOS_FECHA = ('date', 'datetime', 'datetime2', 'smalldatetime')
+
+def existe_tabla(connection, tabla):
+    return connection.execute(text("SELECT OBJECT_ID(:tabla, N'U');"), {'tabla': tabla}).scalar() is not None
+
+def columnas_tabla(connection, tabla):
+    """Columnas de la tabla: {nombre: (tipo, max_length)}. max_length = -1 para (max)."""
+    columnas_query = text("""
+        SELECT c.name, t.name AS tipo, c.max_length
+        FROM sys.columns c JOIN sys.types t ON t.user_type_id = c.user_type_id
+        WHERE c.object_id = OBJECT_ID(:tabla);
+    """)
+    return {fila.name: (fila.tipo, fila.max_length) for fila in connection.execute(columnas_query, {'tabla': tabla})}
+
+def indices_tabla(connection, tabla):
+    """Índices de la tabla: {nombre: {'tipo', 'clave', 'incluidas'}}."""
+    indices_query = text("""
+        SELECT i.name, i.type, c.name AS columna, ic.key_ordinal, ic.is_included_column
+        FROM sys.indexes i
+        JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+        JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        WHERE i.object_id = OBJECT_ID(:tabla) AND i.index_id > 0 AND i.is_hypothetical = 0
+        ORDER BY i.index_id, ic.key_ordinal, ic.index_column_id;
+    """)
+    indices = {}
+    for fila in connection.execute(indices_query, {'tabla': tabla}):
+        indice = indices.setdefault(fila.name, {'tipo': fila.type, 'clave': [], 'incluidas': []})
+        if fila.key_ordinal > 0:
+            indice['clave'].append(fila.columna)
+        else:
+            indice['incluidas'].append(fila.columna)
+    return indices
+
+def indice_equivalente(indices, clave, incluidas):
+    """Nombre de un índice existente que resuelve la misma búsqueda, o None."""
+    for nombre, indice in indices.items():
+        if indice['tipo'] == 5:
+            continue  # El columnstore agrupado no permite seeks por la clave
+        cubre = indice['tipo'] == 1 or set(incluidas) <= set(indice['clave']) | set(indice['incluidas'])
+        if indice['clave'][:len(clave)] == clave and cubre:
+            return nombre
+    return None
+
+def revisar_tablas(connection):
+    cambios = []
+    for tabla, ddl in TABLAS.items():
+        if existe_tabla(connection, tabla):
+            print(f"  [ok]     Tabla {tabla}")
+        else:
+            print(f"  [falta]  Tabla {tabla}")
+            cambios.append((f"Crear tabla {tabla}", [ddl]))
+    return cambios
+
+def revisar_columnas_calculadas(connection):
+    cambios = []
+    for columna in COLUMNAS_CALCULADAS:
+        tabla, nombre = columna['tabla'], columna['nombre']
+        if not existe_tabla(connection, tabla):
+            print(f"  [omitido] Columna {tabla}.{nombre}: la tabla no existe.")
+        elif nombre in columnas_tabla(connection, tabla):
+            print(f"  [ok]     Columna {tabla}.{nombre}")
+        else:
+            print(f"  [falta]  Columna {tabla}.{nombre}")
+            cambios.append((f"Agregar columna {tabla}.{nombre}",
+                            [f"ALTER TABLE {tabla} ADD [{nombre}] AS {columna['expresion']} PERSISTED;"]))
+    return cambios
+
+def revisar_indices(connection, columnas_pendientes):
+    """Compara los índices declarados con los existentes. Las columnas (max) no pueden ser clave: pasan a INCLUDE."""
+    cambios = []
+    for declarado in INDICES:
+        tabla, nombre = declarado['tabla'], declarado['nombre']
+        if not existe_tabla(connection, tabla):
+            print(f"  [omitido] Índice {nombre}: la tabla {tabla} todavía no existe (se crea en la primera carga).")
+            continue
+        columnas = columnas_tabla(connection, tabla)
+        faltantes = [col for col in declarado['clave'] + declarado['incluidas']
+                     if col not in columnas and (tabla, col) not in columnas_pendientes]
+        if faltantes:
+            print(f"  [omitido] Índice {nombre}: a {tabla} le faltan las columnas {', '.join(faltantes)}.")
+            continue
+        # El seek usa un prefijo de la clave: desde la primera columna (max) en adelante todas pasan a INCLUDE
+        clave = list(declarado['clave'])
+        for posicion, col in enumerate(declarado['clave']):
+            if col in columnas and columnas[col][1] == -1:
+                clave = declarado['clave'][:posicion]
+                break
+        incluidas = declarado['clave'][len(clave):] + declarado['incluidas']
+        if not clave:
+            print(f"  [omitido] Índice {nombre}: la primera columna clave de {tabla} es (max) y no puede indexarse.")
+            continue
+        if len(clave) < len(declarado['clave']):
+            print(f"  [aviso]  Índice {nombre}: {declarado['clave'][len(clave)]} es (max) y no puede ser clave; "
+                  f"{', '.join(declarado['clave'][len(clave):])} quedan como columnas incluidas.")
+        existente = indice_equivalente(indices_tabla(connection, tabla), clave, incluidas)
+        if existente:
+            print(f"  [ok]     Índice {nombre}" + (f" (cubierto por {existente})" if existente != nombre else ""))
+            continue
+        print(f"  [falta]  Índice {nombre} en {tabla} ({', '.join(clave)})" +
+              (f" INCLUDE ({', '.join(incluidas)})" if incluidas else ""))
+        texto_incluidas = f" INCLUDE ({', '.join(f'[{col}]' for col in incluidas)})" if incluidas else ""
+        cambios.append((f"Crear índice {nombre}", [
+            f"CREATE NONCLUSTERED INDEX [{nombre}] ON {tabla} ({', '.join(f'[{col}]' for col in clave)}){texto_incluidas} "
+            f"WITH (SORT_IN_TEMPDB = ON);"
+        ]))
+    return cambios
+
+def limites_faltantes(connection, funcion, desde, hasta):
+    """Días entre 'desde' y 'hasta' que todavía no son límite de la función de partición."""
+    existentes = {
+        fila[0].date() if isinstance(fila[0], datetime.datetime) else fila[0]
+        for fila in connection.execute(text("""
+            SELECT prv.value FROM sys.partition_range_values prv
+            JOIN sys.partition_functions pf ON pf.function_id = prv.function_id WHERE pf.name = :funcion;
+        """), {'funcion': funcion})
+    }
+    dias = (hasta - desde).days + 1
+    return [desde + datetime.timedelta(days=n) for n in range(dias) if desde + datetime.timedelta(days=n) not in existentes]
+
+def revisar_particiones(connection):
+    """
+    Cada snapshot se particiona por día (RANGE RIGHT) con su propia función y esquema de partición, para que el
+    tipo coincida con el de la columna. Los días futuros se agregan con SPLIT mientras están vacíos (solo metadatos).
+    """
+    cambios = []
+    hoy = datetime.date.today()
+    hasta = hoy + datetime.timedelta(days=DIAS_PARTICION_ADELANTE)
+    for declarada in PARTICIONES:
+        tabla, columna = declarada['tabla'], declarada['columna']
+        funcion, esquema = f"pf_{tabla}_{columna}", f"ps_{tabla}_{columna}"
+        if not existe_tabla(connection, tabla):
+            print(f"  [omitido] Partición de {tabla}: la tabla todavía no existe (se crea en la primera carga).")
+            continue
+        columnas = columnas_tabla(connection, tabla)
+        if columna not in columnas or columnas[columna][0] not in TIPOS_FECHA:
+            print(f"  [omitido] Partición de {tabla}: la columna {columna} no existe o no es de tipo fecha.")
+            continue
+        tipo = columnas[columna][0]
+        existe_funcion = connection.execute(text("SELECT 1 FROM sys.partition_functions WHERE name = :nombre;"),
+                                            {'nombre': funcion}).scalar() is not None
+        sentencias = []
+        if not existe_funcion:
+            minima = connection.execute(text(f"SELECT MIN(CAST([{columna}] AS DATE)) FROM {tabla};")).scalar() or hoy
+            dias = [minima + datetime.timedelta(days=n) for n in range((hasta - minima).days + 1)]
+            sentencias.append(f"CREATE PARTITION FUNCTION [{funcion}] ({tipo}) AS RANGE RIGHT FOR VALUES "
+                              f"({', '.join(repr(dia.isoformat()) for dia in dias)});")
+            sentencias.append(f"CREATE PARTITION SCHEME [{esquema}] AS PARTITION [{funcion}] ALL TO ([PRIMARY]);")
+        else:
+            nuevos = limites_faltantes(connection, funcion, hoy, hasta)
+            for dia in nuevos:
+                sentencias.append(f"ALTER PARTITION SCHEME [{esquema}] NEXT USED [PRIMARY];")
+                sentencias.append(f"ALTER PARTITION FUNCTION [{funcion}]() SPLIT RANGE ('{dia.isoformat()}');")
+            if nuevos:
+                print(f"  [falta]  Partición de {tabla}: {len(nuevos)} días nuevos hasta {hasta}.")
+
+        indices = indices_tabla(connection, tabla)
+        agrupado = next((nombre for nombre, indice in indices.items() if indice['tipo'] in (1, 5)), None)
+        particionada = connection.execute(text("""
+            SELECT 1 FROM sys.indexes i JOIN sys.partition_schemes ps ON ps.data_space_id = i.data_space_id
+            WHERE i.object_id = OBJECT_ID(:tabla) AND i.index_id IN (0, 1);
+        """), {'tabla': tabla}).scalar() is not None
+        if particionada:
+            print(f"  [ok]     Partición de {tabla} por {columna}")
+        elif agrupado:
+            # Mover un índice agrupado existente reescribe la tabla entera: se deja para una ventana de mantenimiento
+            print(f"  [manual] Partición de {tabla}: ya tiene el índice agrupado {agrupado}; para particionarla hay que "
+                  f"recrearlo con DROP_EXISTING = ON sobre [{esquema}]([{columna}]).")
+        else:
+            print(f"  [falta]  Partición de {tabla} por {columna}")
+            sentencias.append(f"CREATE CLUSTERED INDEX [CIX_{tabla}_{columna}] ON {tabla} ([{columna}]) "
+                              f"WITH (SORT_IN_TEMPDB = ON) ON [{esquema}]([{columna}]);")
+        if particionada or not agrupado:
+            # SWITCH exige que todos los índices estén alineados con la partición
+            no_alineados = connection.execute(text("""
+                SELECT i.name FROM sys.indexes i
+                WHERE i.object_id = OBJECT_ID(:tabla) AND i.index_id > 1
+                  AND i.data_space_id NOT IN (SELECT data_space_id FROM sys.partition_schemes);
+            """), {'tabla': tabla}).scalars().all()
+            for nombre in no_alineados:
+                print(f"  [aviso]  El índice {nombre} de {tabla} no está alineado; recréalo sobre [{esquema}]([{columna}]) "
+                      f"o el SWITCH de snapshot.py fallará.")
+        if sentencias:
+            cambios.append((f"Particionar {tabla} por {columna}", sentencias))
+    return cambios
+
+def revisar_esquema(engine):
+    """Compara el esquema declarado con la base de datos. Devuelve [(descripción, [sentencias])] con lo que falta."""
+    with engine.connect() as connection:
+        print("\nTablas:")
+        cambios = revisar_tablas(connection)
+        print("\nColumnas calculadas:")
+        cambios_columnas = revisar_columnas_calculadas(connection)
+        print("\nÍndices:")
+        pendientes = {(columna['tabla'], columna['nombre']) for columna in COLUMNAS_CALCULADAS}
+        cambios_indices = revisar_indices(connection, pendientes)
+        print("\nParticionado de snapshots:")
+        cambios_particiones = revisar_particiones(connection)
+    return cambios + cambios_columnas + cambios_indices + cambios_particiones
+
+def aplicar_cambios(engine, cambios):
+    """Aplica cada cambio en su propia transacción. Devuelve la cantidad de cambios que fallaron."""
+    fallidos = 0
+    for descripcion, sentencias in cambios:
+        try:
+            with engine.begin() as connection:
+                for sentencia in sentencias:
+                    connection.execute(text(sentencia))
+            print(f"  [aplicado] {descripcion}")
+        except Exception as e:
+            fallidos += 1
+            print(f"  [error]  {descripcion}: {e}")
+    return fallidos
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compara el esquema esperado por los scripts de carga con la base de datos.")
+    parser.add_argument('--aplicar', action='store_true', help="Crea en la base de datos lo que falta (por defecto solo se muestra).")
+    args = parser.parse_args()
+
+    try:
+        engine = create_engine(connection_string)
+        print(f"Revisando el esquema de '{DATABASE_NAME}' en '{SERVER_AND_PORT}'...")
+        cambios = revisar_esquema(engine)
+    except Exception as e:
+        print(f"Error al revisar el esquema: {e}")
+        print(f"Tipo de error: {type(e).__name__}")
+        sys.exit(1)
+
+    if not cambios:
+        print("\nEl esquema está al día.")
+    elif not args.aplicar:
+        print(f"\nHay {len(cambios)} cambios pendientes. Ejecuta 'python esquema.py --aplicar' para aplicarlos.")
+    else:
+        print(f"\nAplicando {len(cambios)} cambios...")
+        if aplicar_cambios(engine, cambios):
+            sys.exit(1)
+        print("Esquema actualizado.")
@@ -0,0 +1,275 @@
+# Inserción por lotes con tamaño adaptativo y reintentos ante errores transitorios
+import os
+import time
+import random
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, IntegrityError, ProgrammingError
+import metricas
+
+# --- Configuración de la Inserción ---
+MAX_PARAMETROS = 2100 # Límite de parámetros por sentencia en SQL Server
+MAX_FILAS_VALUES = 1000 # Límite de filas en un INSERT ... VALUES de SQL Server
+MAX_REINTENTOS = int(os.environ.get("INSERT_MAX_REINTENTOS", "5"))
+ESPERA_BASE_SEGUNDOS = float(os.environ.get("INSERT_ESPERA_BASE", "1.0"))
+ESPERA_MAXIMA_SEGUNDOS = 60.0
+# Disposición de la carga: 'auto' ordena por la clave del índice agrupado de la tabla de destino y, si es
+# columnstore, carga por grupos de filas comprimidos; 'ninguna' inserta en el orden del archivo.
+DISPOSICION = os.environ.get("INSERT_DISPOSICION", "auto").lower()
+MIN_FILAS_ROWGROUP = 102400 # Desde este tamaño un INSERT va directo a un rowgroup comprimido (sin delta store)
+MAX_FILAS_ROWGROUP = 1048576 # Tamaño máximo de un rowgroup de columnstore
+STAGING_COLUMNSTORE = '#carga_columnstore'
+# Filas por tanda de la copia masiva a tablas de staging (se convierten a tuplas de a una tanda por vez)
+FILAS_COPIA_MASIVA = int(os.environ.get("INSERT_FILAS_COPIA_MASIVA", "100000"))
+
+# Códigos de SQL Server / FreeTDS que indican un error transitorio (vale la pena reintentar)
+CODIGOS_TRANSITORIOS = {
+    1205,   # Deadlock: la transacción fue elegida como víctima
+    1222,   # Tiempo de espera de bloqueo agotado
+    -2,     # Timeout
+    20003,  # Timeout de lectura/escritura (FreeTDS)
+    20004,  # Error de lectura del servidor (FreeTDS)
+    20006,  # Error de escritura al servidor (FreeTDS)
+    20009,  # Servidor no disponible (FreeTDS)
+    20047,  # Conexión terminada (FreeTDS)
+    10053, 10054, 10060,  # Conexión cerrada o reiniciada por la red
+    40197, 40501, 40613, 49918, 49919, 49920,  # Servicio ocupado o no disponible temporalmente
+}
+
+def es_error_transitorio(error):
+    """Indica si un error de base de datos es transitorio (deadlock, timeout, caída de la conexión)."""
+    if isinstance(error, IntegrityError):
+        return False
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    original = getattr(error, 'orig', error)
+    argumentos = getattr(original, 'args', ())
+    if argumentos and isinstance(argumentos[0], int) and argumentos[0] in CODIGOS_TRANSITORIOS:
+        return True
+    mensaje = str(original).lower()
+    return 'deadlock' in mensaje or 'timeout' in mensaje or 'timed out' in mensaje
+
+def tamano_lote_maximo(num_columnas):
+    """Filas máximas por INSERT respetando el límite de 2100 parámetros y 1000 filas de SQL Server."""
+    return max(1, min(MAX_FILAS_VALUES, (MAX_PARAMETROS - 1) // max(num_columnas, 1)))
+
+class ControladorLotes:
+    """
+    Ajusta el tamaño de lote midiendo la latencia y las filas/seg de cada lote.
+    Sigue creciendo (o achicándose) mientras el rendimiento mejora y cambia de dirección cuando empeora.
+    """
+    FACTOR_CAMBIO = 1.25
+    TOLERANCIA = 0.05
+
+    def __init__(self, num_columnas, tamano_inicial=None):
+        self.maximo = tamano_lote_maximo(num_columnas)
+        self.minimo = min(10, self.maximo)
+        self.tamano = max(self.minimo, min(tamano_inicial or self.maximo // 4, self.maximo))
+        self.direccion = 1
+        self.rendimiento_anterior = None
+        self.latencias = []
+
+    def registrar(self, filas, segundos):
+        """Registra un lote y calcula el tamaño del siguiente. Devuelve las filas/seg del lote."""
+        rendimiento = filas / max(segundos, 1e-6)
+        self.latencias.append(segundos)
+        if self.rendimiento_anterior is not None and rendimiento < self.rendimiento_anterior * (1 - self.TOLERANCIA):
+            self.direccion = -self.direccion
+        factor = self.FACTOR_CAMBIO if self.direccion > 0 else 1 / self.FACTOR_CAMBIO
+        nuevo_tamano = max(self.minimo, min(int(round(self.tamano * factor)), self.maximo))
+        # Al llegar a un límite se explora en la otra dirección
+        if nuevo_tamano == self.tamano:
+            self.direccion = -self.direccion
+        self.tamano = nuevo_tamano
+        self.rendimiento_anterior = rendimiento
+        return rendimiento
+
+def _espera_reintento(intento):
+    """Backoff exponencial con jitter para no reintentar todos al mismo tiempo."""
+    espera = min(ESPERA_MAXIMA_SEGUNDOS, ESPERA_BASE_SEGUNDOS * (2 ** (intento - 1)))
+    return random.uniform(espera / 2, espera * 1.5)
+
+def describir_indice_agrupado(connection, table_name):
+    """
+    Devuelve el índice agrupado de la tabla: {'columnstore': bool, 'clave': [columnas]}, o None si es un heap.
+    Un columnstore agrupado no tiene columnas clave (salvo que sea ordenado).
+    """
+    indice_query = text("""
+        SELECT i.type AS tipo, c.name AS columna
+        FROM sys.indexes i
+        LEFT JOIN sys.index_columns ic
+               ON ic.object_id = i.object_id AND ic.index_id = i.index_id AND ic.key_ordinal > 0
+        LEFT JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        WHERE i.object_id = OBJECT_ID(:tabla) AND i.index_id = 1
+        ORDER BY ic.key_ordinal;
+    """)
+    filas = connection.execute(indice_query, {'tabla': table_name}).fetchall()
+    if not filas:
+        return None
+    return {'columnstore': filas[0].tipo == 5, 'clave': [fila.columna for fila in filas if fila.columna]}
+
+def ordenar_por_clave(df, columnas_clave):
+    """Ordena las filas por la clave agrupada (las columnas que estén en el DataFrame) para evitar page splits."""
+    columnas = [col for col in columnas_clave if col in df.columns]
+    if not columnas:
+        return df
+    return df.sort_values(columnas, kind='mergesort', ignore_index=True)
+
+def _insertar_lotes(connection, df, destino, controlador, lotes):
+    """
+    Inserta el DataFrame en 'destino' con lotes de tamaño adaptativo. Devuelve las filas insertadas.
+    Cada lote se anota en 'lotes' como (filas, segundos); las métricas se publican recién después del commit.
+    """
+    filas_insertadas = 0
+    while filas_insertadas < len(df):
+        inicio_lote = filas_insertadas
+        batch_df = df.iloc[inicio_lote: inicio_lote + controlador.tamano]
+        try:
+            inicio = time.perf_counter()
+            batch_df.to_sql(destino, con=connection, if_exists='append', index=False, method='multi')
+            segundos = time.perf_counter() - inicio
+        except (ProgrammingError, IntegrityError) as e:
+            print(f"\n¡ERROR DE BASE DE DATOS en el lote de filas {inicio_lote} a {inicio_lote + len(batch_df)}!")
+            print(f"Tipo de error: {type(e).__name__}")
+            print(f"Mensaje de error: {e}")
+            if hasattr(e.orig, 'args') and len(e.orig.args) > 1:
+                print(f"    > Mensaje de SQL Server: {e.orig.args[1]}")
+            if isinstance(e, IntegrityError):
+                print("Esto podría indicar que un duplicado aún se está intentando insertar a pesar de la deduplicación previa, o un problema de FK.")
+            raise
+        rendimiento = controlador.registrar(len(batch_df), segundos)
+        lotes.append((len(batch_df), segundos))
+        filas_insertadas += len(batch_df)
+        print(f"Lote insertado exitosamente: filas {inicio_lote} a {filas_insertadas} "
+              f"({len(batch_df)} filas en {segundos:.2f} s, {rendimiento:.0f} filas/seg)")
+    return filas_insertadas
+
+def funcion_copia_masiva(connection):
+    """
+    Copia masiva (BCP de FreeTDS) de la conexión pymssql, disponible desde pymssql 2.2.8. Con versiones
+    anteriores u otro driver devuelve None y la carga sigue con INSERT ... VALUES por lotes.
+    """
+    conexion_dbapi = connection.connection.dbapi_connection
+    return (getattr(conexion_dbapi, 'bulk_copy', None)
+            or getattr(getattr(conexion_dbapi, '_conn', None), 'bulk_copy', None))
+
+def _ids_columnas(connection, destino, columnas):
+    """column_id de cada columna del DataFrame en la tabla de destino (también tablas temporales #)."""
+    catalogo = 'tempdb.sys.columns' if destino.startswith('#') else 'sys.columns'
+    nombre_objeto = f"tempdb..{destino}" if destino.startswith('#') else destino
+    ids = {fila.name: fila.column_id for fila in connection.execute(
+        text(f"SELECT name, column_id FROM {catalogo} WHERE object_id = OBJECT_ID(:tabla);"), {'tabla': nombre_objeto})}
+    return [ids[col] for col in columnas]
+
+def _copiar_masivo(connection, df, destino, copia_masiva, lotes):
+    """
+    Carga el DataFrame en 'destino' con la copia masiva del driver y TABLOCK: sobre un heap (y con
+    recuperación simple o bulk-logged, como tempdb) SQL Server la registra mínimamente, a diferencia de
+    los INSERT ... VALUES de to_sql. Devuelve las filas cargadas.
+    """
+    ids = _ids_columnas(connection, destino, df.columns)
+    filas_insertadas = 0
+    for desde in range(0, len(df), FILAS_COPIA_MASIVA):
+        tanda = df.iloc[desde: desde + FILAS_COPIA_MASIVA].astype(object)
+        tanda = tanda.where(tanda.notna(), None)
+        inicio = time.perf_counter()
+        copia_masiva(destino, tanda.itertuples(index=False, name=None), column_ids=ids,
+                     batch_size=FILAS_COPIA_MASIVA, tablock=True)
+        segundos = time.perf_counter() - inicio
+        lotes.append((len(tanda), segundos))
+        filas_insertadas += len(tanda)
+        print(f"Copia masiva a '{destino}': filas {desde} a {filas_insertadas} en {segundos:.2f} s")
+    return filas_insertadas
+
+def rangos_rowgroup(total_filas):
+    """
+    Divide la carga en tramos de hasta MAX_FILAS_ROWGROUP filas. Si el último tramo quedaría por debajo de
+    MIN_FILAS_ROWGROUP se reparte con el anterior en dos mitades, para que ningún tramo termine en el delta store.
+    """
+    rangos = [[desde, min(desde + MAX_FILAS_ROWGROUP, total_filas)] for desde in range(0, total_filas, MAX_FILAS_ROWGROUP)]
+    if len(rangos) > 1 and rangos[-1][1] - rangos[-1][0] < MIN_FILAS_ROWGROUP:
+        ultimo = rangos.pop()
+        mitad = (rangos[-1][0] + ultimo[1]) // 2
+        rangos[-1][1] = mitad
+        rangos.append([mitad, ultimo[1]])
+    return rangos
+
+def _insertar_columnstore(connection, df, controlador, table_name, lotes):
+    """
+    Carga en una tabla con columnstore agrupado: los lotes van primero a una tabla temporal y de ahí a la
+    tabla de destino con INSERT ... SELECT WITH (TABLOCK) en tramos de al menos MIN_FILAS_ROWGROUP filas,
+    que se comprimen directamente en rowgroups en lugar de pasar por el delta store.
+    """
+    columnas = ", ".join(f"[{col}]" for col in df.columns)
+    connection.execute(text(f"DROP TABLE IF EXISTS {STAGING_COLUMNSTORE};"))
+    connection.execute(text(f"SELECT TOP 0 {columnas} INTO {STAGING_COLUMNSTORE} FROM {table_name};"))
+    connection.execute(text(f"ALTER TABLE {STAGING_COLUMNSTORE} ADD _fila BIGINT IDENTITY(1, 1) NOT NULL;"))
+    try:
+        _insertar_lotes(connection, df, STAGING_COLUMNSTORE, controlador, lotes)
+        filas_insertadas = 0
+        for desde, hasta in rangos_rowgroup(len(df)):
+            inicio = time.perf_counter()
+            resultado = connection.execute(text(f"""
+                INSERT INTO {table_name} WITH (TABLOCK) ({columnas})
+                SELECT {columnas} FROM {STAGING_COLUMNSTORE} WHERE _fila > :desde AND _fila <= :hasta ORDER BY _fila;
+            """), {'desde': desde, 'hasta': hasta})
+            filas_insertadas += resultado.rowcount
+            print(f"Rowgroup cargado en '{table_name}': filas {desde} a {hasta} en {time.perf_counter() - inicio:.2f} s")
+        return filas_insertadas
+    finally:
+        connection.execute(text(f"DROP TABLE IF EXISTS {STAGING_COLUMNSTORE};"))
+
+def insertar_por_lotes(engine, df, table_name, antes=None, despues=None, destino=None):
+    """
+    Inserta el DataFrame en la tabla con lotes de tamaño adaptativo, todo en una sola transacción.
+    'antes' y 'despues' reciben la conexión y se ejecutan dentro de la misma transacción.
+    Ante un error transitorio (deadlock, timeout, conexión caída) SQL Server revierte la transacción,
+    así que se reintenta la transacción completa con backoff exponencial y jitter.
+    Con INSERT_DISPOSICION='auto' las filas se ordenan por la clave del índice agrupado de la tabla y, si
+    la tabla es columnstore, se cargan por rowgroups completos (ver _insertar_columnstore).
+    Con 'destino' las filas se cargan en esa tabla de staging (un heap) y 'table_name' solo se usa para el
+    orden, los mensajes y las métricas; si el driver tiene copia masiva se usa con TABLOCK (ver _copiar_masivo).
+    Las métricas de los lotes se publican solo si la transacción confirma: los lotes de un intento revertido
+    no se cuentan.
+    Devuelve el total de filas insertadas.
+    """
+    controlador = ControladorLotes(len(df.columns))
+    intento = 0
+    while True:
+        lotes = []
+        try:
+            with engine.connect() as connection:
+                with connection.begin():
+                    if antes:
+                        antes(connection)
+                    inicio_carga = time.perf_counter()
+                    indice = describir_indice_agrupado(connection, table_name) if DISPOSICION != 'ninguna' else None
+                    df_carga = ordenar_por_clave(df, indice['clave']) if indice else df
+                    copia_masiva = funcion_copia_masiva(connection) if destino else None
+                    if copia_masiva:
+                        filas_insertadas = _copiar_masivo(connection, df_carga, destino, copia_masiva, lotes)
+                    elif destino:
+                        filas_insertadas = _insertar_lotes(connection, df_carga, destino, controlador, lotes)
+                    elif indice and indice['columnstore'] and len(df_carga) >= MIN_FILAS_ROWGROUP:
+                        filas_insertadas = _insertar_columnstore(connection, df_carga, controlador, table_name, lotes)
+                    else:
+                        filas_insertadas = _insertar_lotes(connection, df_carga, table_name, controlador, lotes)
+                    if despues:
+                        despues(connection)
+            segundos_totales = time.perf_counter() - inicio_carga
+            print(f"Inserción en '{table_name}' completada: {filas_insertadas} filas en {segundos_totales:.1f} s "
+                  f"(último tamaño de lote: {controlador.tamano}).")
+            for filas, segundos in lotes:
+                metricas.registrar_lote(table_name, filas, segundos)
+            metricas.contar(table_name, 'insertadas', filas_insertadas)
+            return filas_insertadas
+        except DBAPIError as e:
+            if not es_error_transitorio(e) or intento >= MAX_REINTENTOS:
+                raise
+            intento += 1
+            metricas.registrar_reintento(table_name, e)
+            espera = _espera_reintento(intento)
+            # Después de un error de red conviene empezar con lotes más chicos
+            controlador.tamano = max(controlador.minimo, controlador.tamano // 2)
+            print(f"\nError transitorio al insertar en '{table_name}' ({type(e).__name__}: {e}).")
+            print(f"Se reintenta la transacción completa en {espera:.1f} s (intento {intento} de {MAX_REINTENTOS}).")
+            time.sleep(espera)
@@ -0,0 +1,207 @@
+# Métricas en vivo de las cargas: archivo .prom para el textfile collector de node-exporter y log JSON
+import os
+import json
+import math
+import time
+import atexit
+import datetime
+import threading
+
+# --- Configuración de las Métricas ---
+# Carpeta que lee node-exporter (--collector.textfile.directory); si se deja vacía no se publican métricas.
+METRICAS_DIR = os.environ.get("METRICAS_DIR", "metricas")
+INTERVALO_PUBLICACION_SEGUNDOS = float(os.environ.get("METRICAS_INTERVALO", "5"))
+UMBRAL_LOTE_LENTO_SEGUNDOS = float(os.environ.get("METRICAS_LOTE_LENTO_SEG", "10"))
+CUANTILES = (0.5, 0.9, 0.99)
+
+# Etapas del pipeline que se cuentan por tabla
+ETAPAS = ('leidas', 'mapeadas', 'deduplicadas', 'insertadas')
+
+_lock = threading.Lock()
+_estado = {}
+
+def _ahora():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+def _cuantil(valores_ordenados, q):
+    """Cuantil por rango más cercano sobre una lista ya ordenada."""
+    if not valores_ordenados:
+        return 0.0
+    indice = min(len(valores_ordenados) - 1, max(0, math.ceil(q * len(valores_ordenados)) - 1))
+    return valores_ordenados[indice]
+
+def _tabla(nombre_tabla):
+    """Contadores de una tabla dentro de la ejecución actual (se crean la primera vez)."""
+    return _estado['tablas'].setdefault(nombre_tabla, {
+        'filas': {etapa: 0 for etapa in ETAPAS},
+        'latencias': [],
+        'filas_lotes': 0,
+        'segundos_lotes': 0.0,
+        'lotes_lentos': 0,
+        'reintentos': 0,
+        'errores': 0,
+    })
+
+def _registrar_evento(evento, **datos):
+    """Agrega una línea al log JSON de la ejecución."""
+    linea = {'fecha_hora': _ahora(), 'script': _estado['script'], 'id_carga': _estado['id_carga'], 'evento': evento, **datos}
+    with open(_estado['ruta_log'], 'a', encoding='utf-8') as f:
+        f.write(json.dumps(linea, ensure_ascii=False, default=str) + '\n')
+
+def _familia(lineas, nombre, ayuda, muestras):
+    """Agrega una métrica al formato de texto de Prometheus (todas sus series juntas, como exige el formato)."""
+    lineas.append(f'# HELP {nombre} {ayuda}')
+    lineas.append(f'# TYPE {nombre} gauge')
+    for etiquetas, valor in muestras:
+        texto_etiquetas = ','.join(f'{clave}="{valor_etiqueta}"' for clave, valor_etiqueta in etiquetas.items())
+        lineas.append(f'{nombre}{{{texto_etiquetas}}} {valor}')
+
+def _lineas_prometheus():
+    """Arma el contenido del archivo .prom con el estado actual."""
+    script = _estado['script']
+    tablas = _estado['tablas']
+    latencias = {nombre: sorted(tabla['latencias']) for nombre, tabla in tablas.items()}
+    lineas = []
+    _familia(lineas, 'etl_filas_total', 'Filas procesadas por etapa (leidas, mapeadas, deduplicadas, insertadas).',
+             [({'script': script, 'tabla': nombre, 'etapa': etapa}, filas)
+              for nombre, tabla in tablas.items() for etapa, filas in tabla['filas'].items()])
+    _familia(lineas, 'etl_filas_por_segundo', 'Filas/seg de la inserción por lotes.',
+             [({'script': script, 'tabla': nombre}, f"{tabla['filas_lotes'] / tabla['segundos_lotes'] if tabla['segundos_lotes'] else 0.0:.3f}")
+              for nombre, tabla in tablas.items()])
+    _familia(lineas, 'etl_lote_latencia_segundos', 'Latencia de los lotes de inserción por cuantil.',
+             [({'script': script, 'tabla': nombre, 'quantile': q}, f"{_cuantil(valores, q):.4f}")
+              for nombre, valores in latencias.items() for q in CUANTILES])
+    _familia(lineas, 'etl_lote_latencia_segundos_max', 'Latencia del lote más lento.',
+             [({'script': script, 'tabla': nombre}, f"{valores[-1] if valores else 0.0:.4f}") for nombre, valores in latencias.items()])
+    _familia(lineas, 'etl_lotes_total', 'Lotes de inserción ejecutados.',
+             [({'script': script, 'tabla': nombre}, len(valores)) for nombre, valores in latencias.items()])
+    _familia(lineas, 'etl_lotes_lentos_total', f'Lotes que tardaron {UMBRAL_LOTE_LENTO_SEGUNDOS:g} s o más.',
+             [({'script': script, 'tabla': nombre}, tabla['lotes_lentos']) for nombre, tabla in tablas.items()])
+    _familia(lineas, 'etl_reintentos_total', 'Reintentos de la transacción de inserción.',
+             [({'script': script, 'tabla': nombre}, tabla['reintentos']) for nombre, tabla in tablas.items()])
+    _familia(lineas, 'etl_errores_total', 'Errores en la carga de la tabla.',
+             [({'script': script, 'tabla': nombre}, tabla['errores']) for nombre, tabla in tablas.items()])
+
+    fin = _estado['fin'] or time.time()
+    etiquetas = {'script': script}
+    _familia(lineas, 'etl_clientes_no_mapeados', 'Clientes del archivo que no se encontraron en la tabla Clientes.',
+             [(etiquetas, len(_estado['no_mapeados']))])
+    _familia(lineas, 'etl_inicio_timestamp_segundos', 'Inicio de la ejecución (epoch).', [(etiquetas, f"{_estado['inicio']:.0f}")])
+    _familia(lineas, 'etl_duracion_segundos', 'Duración de la ejecución hasta ahora.', [(etiquetas, f"{fin - _estado['inicio']:.1f}")])
+    _familia(lineas, 'etl_en_ejecucion', '1 mientras la carga está corriendo.', [(etiquetas, 0 if _estado['fin'] else 1)])
+    if _estado['exitosa'] is not None:
+        _familia(lineas, 'etl_ultima_ejecucion_exitosa', '1 si la última ejecución terminó sin errores.',
+                 [(etiquetas, 1 if _estado['exitosa'] else 0)])
+        _familia(lineas, 'etl_ultima_ejecucion_timestamp_segundos', 'Fin de la última ejecución (epoch).', [(etiquetas, f"{fin:.0f}")])
+    return lineas
+
+def _publicar(forzar=False):
+    """Reescribe el archivo .prom (como máximo cada INTERVALO_PUBLICACION_SEGUNDOS, salvo que se fuerce)."""
+    if not forzar and time.time() - _estado['ultima_publicacion'] < INTERVALO_PUBLICACION_SEGUNDOS:
+        return
+    try:
+        # Se escribe en un temporal y se renombra para que node-exporter nunca lea un archivo a medias
+        ruta_tmp = _estado['ruta_prom'] + '.tmp'
+        with open(ruta_tmp, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(_lineas_prometheus()) + '\n')
+        os.replace(ruta_tmp, _estado['ruta_prom'])
+        _estado['ultima_publicacion'] = time.time()
+    except OSError as e:
+        print(f"Advertencia: No se pudieron publicar las métricas en '{METRICAS_DIR}'. Error: {e}")
+
+def iniciar(script, id_carga):
+    """Inicia las métricas de la ejecución. Sin METRICAS_DIR el resto de las funciones no hacen nada."""
+    if not METRICAS_DIR:
+        return
+    try:
+        os.makedirs(METRICAS_DIR, exist_ok=True)
+    except OSError as e:
+        print(f"Advertencia: No se pudo crear la carpeta de métricas '{METRICAS_DIR}'. Error: {e}")
+        return
+    with _lock:
+        _estado.update({
+            'script': script,
+            'id_carga': id_carga,
+            'ruta_prom': os.path.join(METRICAS_DIR, f"etl_{script}.prom"),
+            'ruta_log': os.path.join(METRICAS_DIR, f"etl_{script}.jsonl"),
+            'inicio': time.time(),
+            'fin': None,
+            'exitosa': None,
+            'ultima_publicacion': 0.0,
+            'tablas': {},
+            'no_mapeados': set(),
+        })
+        _registrar_evento('inicio')
+        _publicar(forzar=True)
+    atexit.register(_al_salir)
+
+def contar(nombre_tabla, etapa, filas):
+    """Suma filas a una etapa del pipeline (leidas, mapeadas, deduplicadas, insertadas)."""
+    if not _estado:
+        return
+    with _lock:
+        _tabla(nombre_tabla)['filas'][etapa] += int(filas)
+        _registrar_evento('etapa', tabla=nombre_tabla, etapa=etapa, filas=int(filas))
+        _publicar()
+
+def clientes_no_mapeados(nombres):
+    """Registra los clientes del archivo que no se pudieron mapear."""
+    if not _estado:
+        return
+    with _lock:
+        nuevos = set(map(str, nombres)) - _estado['no_mapeados']
+        _estado['no_mapeados'] |= nuevos
+        if nuevos:
+            _registrar_evento('clientes_no_mapeados', cantidad=len(nuevos), clientes=sorted(nuevos))
+        _publicar()
+
+def registrar_lote(nombre_tabla, filas, segundos):
+    """Registra la latencia de un lote de inserción; los lotes lentos quedan en el log JSON."""
+    if not _estado:
+        return
+    with _lock:
+        tabla = _tabla(nombre_tabla)
+        tabla['latencias'].append(segundos)
+        tabla['filas_lotes'] += filas
+        tabla['segundos_lotes'] += segundos
+        if segundos >= UMBRAL_LOTE_LENTO_SEGUNDOS:
+            tabla['lotes_lentos'] += 1
+            _registrar_evento('lote_lento', tabla=nombre_tabla, filas=filas, segundos=round(segundos, 3))
+        _publicar()
+
+def registrar_reintento(nombre_tabla, error):
+    """Registra un reintento de la transacción de inserción."""
+    if not _estado:
+        return
+    with _lock:
+        _tabla(nombre_tabla)['reintentos'] += 1
+        _registrar_evento('reintento', tabla=nombre_tabla, error=f"{type(error).__name__}: {error}")
+        _publicar()
+
+def registrar_error(nombre_tabla, error):
+    """Registra el error de la carga de una tabla; la ejecución terminará como fallida."""
+    if not _estado:
+        return
+    with _lock:
+        _tabla(nombre_tabla)['errores'] += 1
+        _registrar_evento('error', tabla=nombre_tabla, error=f"{type(error).__name__}: {error}")
+        _publicar(forzar=True)
+
+def finalizar(exitosa=True):
+    """Cierra la ejecución: publica el estado final y deja un resumen en el log JSON."""
+    if not _estado or _estado['fin']:
+        return
+    with _lock:
+        exitosa = exitosa and not any(tabla['errores'] for tabla in _estado['tablas'].values())
+        _estado['fin'] = time.time()
+        _estado['exitosa'] = exitosa
+        resumen = {nombre: dict(tabla['filas'], lotes=len(tabla['latencias']),
+                                filas_por_segundo=round(tabla['filas_lotes'] / tabla['segundos_lotes'], 1) if tabla['segundos_lotes'] else 0.0)
+                   for nombre, tabla in _estado['tablas'].items()}
+        _registrar_evento('fin', exitosa=exitosa, duracion_segundos=round(_estado['fin'] - _estado['inicio'], 1),
+                          clientes_no_mapeados=len(_estado['no_mapeados']), tablas=resumen)
+        _publicar(forzar=True)
+
+def _al_salir():
+    # Si el script terminó sin llamar a finalizar (sys.exit por un error), la ejecución queda como fallida
+    finalizar(exitosa=False)
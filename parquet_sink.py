@@ -0,0 +1,217 @@
+# Copia en Parquet particionado de cada carga a SQL Server
+# Uso: python parquet_sink.py --listar                          -> cargas registradas en el catálogo
+#      python parquet_sink.py --tabla Cartera --carga <id_carga> -> vuelve a cargar en SQL Server una carga guardada
+import os
+import sys
+import uuid
+import json
+import argparse
+import threading
+import datetime
+import pandas as pd
+
+# --- Configuración del Destino Parquet ---
+# Carpeta local o de red; si se deja vacía no se escribe la copia en Parquet.
+PARQUET_DIR = os.environ.get("PARQUET_DIR", "parquet")
+CATALOGO_NOMBRE = '_catalogo.json'
+
+_catalogo_lock = threading.Lock()
+
+def _ruta_catalogo():
+    return os.path.join(PARQUET_DIR, CATALOGO_NOMBRE)
+
+def _leer_catalogo():
+    """Lee el catálogo de cargas escritas en Parquet."""
+    ruta = _ruta_catalogo()
+    if not os.path.exists(ruta):
+        return {}
+    with open(ruta, encoding='utf-8') as f:
+        return json.load(f)
+
+def _registrar_en_catalogo(table_name, columnas_particion, derivadas, esquema, carga, reemplazados=()):
+    """Agrega una carga al catálogo. Se reescribe en un archivo temporal para no dejarlo a medias."""
+    with _catalogo_lock:
+        catalogo = _leer_catalogo()
+        tabla = catalogo.setdefault(table_name, {'columnas_particion': columnas_particion, 'cargas': []})
+        # Los archivos reemplazados (snapshot del mismo día) dejan de pertenecer a sus cargas anteriores
+        if reemplazados:
+            for anterior in tabla['cargas']:
+                anterior['archivos'] = [archivo for archivo in anterior['archivos'] if archivo not in reemplazados]
+            tabla['cargas'] = [anterior for anterior in tabla['cargas'] if anterior['archivos']]
+        tabla['columnas_particion'] = columnas_particion
+        tabla['particiones_derivadas'] = derivadas
+        tabla['esquema'] = esquema
+        # En la carga por bloques cada bloque agrega sus archivos a la misma carga
+        existente = next((c for c in tabla['cargas'] if c['id_carga'] == carga['id_carga']), None)
+        if existente:
+            existente['filas'] += carga['filas']
+            existente['archivos'].extend(carga['archivos'])
+        else:
+            tabla['cargas'].append(carga)
+        ruta_tmp = _ruta_catalogo() + '.tmp'
+        with open(ruta_tmp, 'w', encoding='utf-8') as f:
+            json.dump(catalogo, f, ensure_ascii=False, indent=2)
+        os.replace(ruta_tmp, _ruta_catalogo())
+
+def _valor_particion(valor):
+    """Texto usado en el nombre de la carpeta de la partición (estilo Hive: columna=valor)."""
+    if isinstance(valor, (datetime.date, pd.Timestamp)):
+        return valor.strftime('%Y-%m-%d')
+    return str(valor)
+
+def escribir_parquet(df, table_name, id_carga, columnas_particion=None, columna_fecha_mensual=None, parte=None, reemplazar=False):
+    """
+    Escribe el DataFrame cargado en PARQUET_DIR/<tabla>/<columna>=<valor>/part-<id_carga>.parquet.
+    Se particiona por columnas existentes (ej. ['FechaCarga']) o por año/mes de una columna de fecha.
+    Con 'parte' (carga por bloques) el archivo se llama part-<id_carga>-<parte>.parquet.
+    Con 'reemplazar' se borran los archivos anteriores de las particiones escritas (snapshot del mismo día),
+    siempre después de escribir el nuevo: si la escritura falla, la copia anterior queda intacta.
+    Un error al escribir solo genera una advertencia: la carga a SQL Server ya se completó.
+    """
+    if not PARQUET_DIR or df.empty:
+        return []
+    try:
+        import pyarrow  # noqa: F401  (motor usado por to_parquet)
+    except ImportError:
+        print("Advertencia: 'pyarrow' no está instalado. Se omite la copia en Parquet.")
+        return []
+
+    try:
+        df_parquet = df
+        if columna_fecha_mensual:
+            fechas = pd.to_datetime(df[columna_fecha_mensual], errors='coerce')
+            df_parquet = df.assign(año=fechas.dt.year.astype('Int64'), mes=fechas.dt.month.astype('Int64'))
+            columnas_particion = ['año', 'mes']
+        columnas_particion = list(columnas_particion or [])
+
+        archivos_escritos = []
+        reemplazados = []
+        grupos = df_parquet.groupby(columnas_particion, dropna=False) if columnas_particion else [((), df_parquet)]
+        for claves, grupo in grupos:
+            claves = claves if isinstance(claves, tuple) else (claves,)
+            carpetas = [f"{col}={_valor_particion(valor)}" for col, valor in zip(columnas_particion, claves)]
+            ruta_dir = os.path.join(PARQUET_DIR, table_name, *carpetas)
+            os.makedirs(ruta_dir, exist_ok=True)
+            nombre_archivo = f"part-{id_carga}-{parte}.parquet" if parte else f"part-{id_carga}.parquet"
+            ruta_archivo = os.path.join(ruta_dir, nombre_archivo)
+            # Las columnas de partición quedan en el nombre de la carpeta, no dentro del archivo.
+            # Se escribe en un temporal y se renombra: un error a mitad de escritura no deja un archivo a medias.
+            grupo.drop(columns=columnas_particion).to_parquet(ruta_archivo + '.tmp', index=False)
+            os.replace(ruta_archivo + '.tmp', ruta_archivo)
+            archivos_escritos.append(os.path.relpath(ruta_archivo, PARQUET_DIR))
+            if reemplazar:
+                for anterior in os.listdir(ruta_dir):
+                    if anterior.startswith('part-') and anterior.endswith('.parquet') and anterior != nombre_archivo:
+                        os.remove(os.path.join(ruta_dir, anterior))
+                        reemplazados.append(os.path.relpath(os.path.join(ruta_dir, anterior), PARQUET_DIR))
+
+        esquema = {col: str(dtype) for col, dtype in df_parquet.dtypes.items()}
+        derivadas = bool(columna_fecha_mensual)
+        _registrar_en_catalogo(table_name, columnas_particion, derivadas, esquema, {
+            'id_carga': id_carga,
+            'fecha_hora': datetime.datetime.now().isoformat(timespec='seconds'),
+            'filas': int(len(df_parquet)),
+            'archivos': archivos_escritos
+        }, reemplazados)
+        print(f"Copia en Parquet de '{table_name}' escrita en '{PARQUET_DIR}' ({len(archivos_escritos)} particiones).")
+        return archivos_escritos
+    except Exception as e:
+        print(f"Advertencia: No se pudo escribir la copia en Parquet de '{table_name}'. Error: {e}")
+        return []
+
+def leer_carga_parquet(table_name, id_carga):
+    """Lee los archivos de una carga registrada en el catálogo, restaurando las columnas de partición."""
+    catalogo = _leer_catalogo()
+    if table_name not in catalogo:
+        raise ValueError(f"La tabla '{table_name}' no tiene cargas en el catálogo de '{PARQUET_DIR}'.")
+    tabla = catalogo[table_name]
+    carga = next((c for c in tabla['cargas'] if c['id_carga'] == id_carga), None)
+    if carga is None:
+        raise ValueError(f"La carga '{id_carga}' no está registrada para la tabla '{table_name}'.")
+
+    partes = []
+    for ruta_relativa in carga['archivos']:
+        parte = pd.read_parquet(os.path.join(PARQUET_DIR, ruta_relativa))
+        carpetas = os.path.dirname(ruta_relativa).split(os.sep)[1:]
+        for carpeta in carpetas:
+            col, valor = carpeta.split('=', 1)
+            parte[col] = valor
+        partes.append(parte)
+    df = pd.concat(partes, ignore_index=True)
+
+    # Restaurar los tipos de las columnas de partición según el esquema registrado
+    for col in tabla['columnas_particion']:
+        if col in df.columns:
+            tipo = tabla.get('esquema', {}).get(col, 'object')
+            if tipo.lower().startswith(('int', 'float')):
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+            elif col == 'FechaCarga' or tipo.startswith('datetime'):
+                df[col] = pd.to_datetime(df[col], errors='coerce').dt.date
+    return df
+
+def recargar_sql(engine, table_name, id_carga):
+    """
+    Vuelve a cargar en SQL Server una carga guardada en Parquet, sin reprocesar el archivo original. Usa el mismo
+    camino que los scripts de carga: los snapshots (particionados por FechaCarga) reemplazan el día con
+    reemplazar_snapshot, así recargar un día no lo duplica; las demás tablas se insertan con insertar_por_lotes.
+    """
+    from insercion import insertar_por_lotes
+    from snapshot import reemplazar_snapshot
+
+    df = leer_carga_parquet(table_name, id_carga)
+    tabla = _leer_catalogo()[table_name]
+    if tabla.get('particiones_derivadas'):
+        # Las columnas año/mes solo existen en las carpetas, no en la tabla de destino
+        df = df.drop(columns=tabla['columnas_particion'], errors='ignore')
+    if 'FechaCarga' in tabla['columnas_particion']:
+        filas = 0
+        for fecha, df_dia in df.groupby('FechaCarga'):
+            filas += reemplazar_snapshot(engine, df_dia, table_name, 'FechaCarga', fecha)
+    else:
+        filas = insertar_por_lotes(engine, df, table_name)
+    print(f"Se recargaron {filas} filas en '{table_name}' desde la carga Parquet '{id_carga}'.")
+    return filas
+
+def listar_cargas():
+    """Muestra las cargas registradas en el catálogo, por tabla."""
+    catalogo = _leer_catalogo()
+    if not catalogo:
+        print(f"No hay cargas registradas en '{_ruta_catalogo()}'.")
+    for table_name, tabla in sorted(catalogo.items()):
+        print(f"\n{table_name}:")
+        for carga in tabla['cargas']:
+            print(f"   {carga['id_carga']}  {carga['fecha_hora']}  {carga['filas']} filas  {len(carga['archivos'])} archivos")
+
+if __name__ == '__main__':
+    import metricas
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    parser = argparse.ArgumentParser(description="Lista las cargas guardadas en Parquet o vuelve a cargar una en SQL Server.")
+    parser.add_argument('--listar', action='store_true', help="Muestra las cargas registradas en el catálogo.")
+    parser.add_argument('--tabla', help="Tabla de destino de la carga a recargar.")
+    parser.add_argument('--carga', help="id_carga a recargar (ver --listar).")
+    args = parser.parse_args()
+
+    # Carga las variables de entorno desde el archivo .env (dentro del ejecutable si se empaquetó con PyInstaller)
+    load_dotenv(dotenv_path=os.path.join(sys._MEIPASS, '.env') if getattr(sys, 'frozen', False) else '.env')
+    PARQUET_DIR = os.environ.get("PARQUET_DIR", "parquet")
+    if args.listar:
+        listar_cargas()
+        sys.exit()
+    if not args.tabla or not args.carga:
+        parser.error("Indica --tabla y --carga para recargar, o --listar.")
+
+    SERVER_AND_PORT = f"{os.environ.get('SERVER_NAME')}:{os.environ.get('PORT')}"
+    connection_string = (f"mssql+pymssql://{os.environ.get('DB_USERNAME')}:{os.environ.get('DB_PASSWORD')}"
+                         f"@{SERVER_AND_PORT}/{os.environ.get('DATABASE_NAME')}")
+
+    metricas.iniciar('recarga_parquet', uuid.uuid4().hex)
+    try:
+        recargar_sql(create_engine(connection_string), args.tabla, args.carga)
+    except Exception as e:
+        print(f"Error al recargar la carga '{args.carga}' de '{args.tabla}': {e}")
+        print(f"Tipo de error: {type(e).__name__}")
+        metricas.finalizar(exitosa=False)
+        sys.exit(1)
+    metricas.finalizar()
@@ -1,14 +1,14 @@
-import pandas as pd
-from tkinter import Tk, filedialog
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import ProgrammingError, IntegrityError, SQLAlchemyError
-import numpy as np
-import pyodbc
+# Los módulos pesados (pandas, sqlalchemy) se importan en segundo plano mientras se elige el archivo.
 import datetime # <--- Import necesario para la fecha
 import os
 import sys
-import re
+import uuid
 from dotenv import load_dotenv
+from arranque import (precargar_modulos, conectar_en_segundo_plano, revalidar_clientes_en_segundo_plano,
+                      en_segundo_plano, esperar, esperar_pandas)
+import metricas
+
+precargar_modulos('pandas', 'sqlalchemy')
 
 def get_env_path():
     """Obtiene la ruta correcta del archivo .env."""
@@ -32,53 +32,68 @@ SERVER_AND_PORT = f"{SERVER_NAME}:{PORT}"
 # --- Configuración de Tablas en la Base de Datos ---
 TABLE_NAME = 'Pending_Orders'
 CLIENTES_TABLE_NAME = 'Clientes'
+ID_CARGA = uuid.uuid4().hex # Identificador de esta ejecución
 
 connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
-engine = create_engine(connection_string)
 
-try:
-    with engine.connect() as connection:
-        connection.execute(text("SELECT 1"))
-    print(f"Conexión a SQL Server '{DATABASE_NAME}' en '{SERVER_NAME}' establecida.")
+# Mientras el usuario elige el archivo se abre la conexión y se revalida el cache de Clientes.
+engine_future = conectar_en_segundo_plano(connection_string)
+clientes_future = revalidar_clientes_en_segundo_plano(engine_future)
 
+def cargar_archivo(input_file_path):
+    """Lee el CSV de órdenes pendientes según su contrato (6 filas de encabezado y una de totales al final).
+    El CSV puede venir dentro de un .zip o un .gz; se descomprime a medida que se lee."""
+    from contratos import leer_con_contrato
+    # Montos, cantidades, largos máximos y valores por defecto se aplican durante la lectura
+    df = leer_con_contrato(input_file_path, 'pending_orders')
+    print("CSV cargado exitosamente.")
+    return df
+
+try:
     # --- Lógica para seleccionar archivo ---
+    from tkinter import Tk, filedialog
     root = Tk()
     root.withdraw()
     print("Por favor, selecciona el archivo 'ordenes_pendientes.csv'...")
     file_path = filedialog.askopenfilename(
         title="Selecciona el archivo 'ordenes_pendientes.csv'",
-        filetypes=[("Archivos CSV", "*.csv")]
+        filetypes=[("Archivos CSV o comprimidos", "*.csv *.zip *.gz"), ("Archivos CSV", "*.csv"), ("Archivos comprimidos", "*.zip *.gz")]
     )
     if not file_path:
         print("No se seleccionó ningún archivo. Saliendo del programa.")
         exit()
     input_file_path = file_path
+    metricas.iniciar('pending_orders', ID_CARGA)
+
+    # --- Cargar y Pre-procesar el CSV (en paralelo con la conexión y el cache de Clientes) ---
+    archivo_future = en_segundo_plano(cargar_archivo, input_file_path)
+
+    esperar_pandas()
+    import pandas as pd
+    from sqlalchemy.exc import ProgrammingError, IntegrityError, SQLAlchemyError
+    from clientes_cache import obtener_clientes, clean_customer_name
+    from parquet_sink import escribir_parquet
+    from snapshot import reemplazar_snapshot, MODO_SNAPSHOT
+    from cuarentena import guardar_en_cuarentena
+    from conciliacion import ErrorConciliacion, verificar_total_pie, ganchos_conciliacion
 
-    # --- Cargar y Pre-procesar el CSV ---
     try:
-        df = pd.read_csv(input_file_path, skiprows=6, skipfooter=1, engine='python')
-        print("CSV cargado exitosamente.")
+        df = archivo_future.result()
     except Exception as e:
         print(f"Ocurrió un error inesperado al cargar el CSV: {e}")
         exit()
 
-    # --- Renombrar Columnas ---
-    column_renames = {
-        'Customer ': 'nombre_cliente',
-        'Amount (Net) ': 'amount_net',
-        'Document Number ': 'document_number',
-        'Date ': 'fecha',
-        'Class Item ': 'class_item',
-        'Quantity ':'cantidad'
-    }
-    if 'Validated Status ' in df.columns:
-        column_renames['Validated Status '] = 'estado'
-    elif 'Status ' in df.columns:
-        column_renames['Status '] = 'estado'
-    
-    df = df.rename(columns=column_renames)
-    df['class_item'] = df['class_item'].fillna("Descuento")
-    print("Columnas renombradas.")
+    metricas.contar(TABLE_NAME, 'leidas', len(df))
+
+    # --- Conciliación contra el pie del reporte ---
+    try:
+        verificar_total_pie(df, 'amount_net', TABLE_NAME)
+    except ErrorConciliacion as e:
+        metricas.registrar_error(TABLE_NAME, e)
+        sys.exit(1)
+
+    engine = esperar(engine_future, "Error de conexión a la base de datos")
+    print(f"Conexión a SQL Server '{DATABASE_NAME}' en '{SERVER_NAME}' establecida.")
 
     # --- Procesamiento de Fechas ---
     if 'fecha' in df.columns:
@@ -94,20 +109,10 @@ try:
     print("\nMapeando clientes y zonas desde la tabla Clientes...")
     DEFAULT_ZONE_ID = 1 # Zona por defecto si un cliente no la tiene asignada
     try:
-        with engine.connect() as connection:
-            # MODIFICACIÓN: Pedimos también la columna id_zone
-            clientes_db_query = text(f"SELECT id_cliente, nombre_cliente, id_zone FROM {CLIENTES_TABLE_NAME};")
-            clientes_db = pd.read_sql_query(clientes_db_query, connection)
-        
-        def clean_customer_name(name):
-            if pd.isna(name): return None
-            name = str(name).strip().lower()
-            name = re.sub(r'[^a-z0-9\s]', '', name)
-            name = re.sub(r'\s+', ' ', name).strip()
-            return name
+        # Los clientes (con id_zone y nombre normalizado) vienen del cache local
+        clientes_db = obtener_clientes(engine, df['nombre_cliente'].unique(), cache=esperar(clientes_future, "Error al revalidar el cache de Clientes"))
 
         df['nombre_cliente_cleaned'] = df['nombre_cliente'].apply(clean_customer_name)
-        clientes_db['nombre_cliente_cleaned'] = clientes_db['nombre_cliente'].apply(clean_customer_name)
         
         # MODIFICACIÓN: Incluimos id_zone en el merge para traerlo a nuestro DataFrame
         df = pd.merge(df, clientes_db[['id_cliente', 'nombre_cliente_cleaned', 'id_zone']], 
@@ -115,11 +120,14 @@ try:
         
         unmapped_clientes = df[df['id_cliente'].isna()]['nombre_cliente'].unique()
         if len(unmapped_clientes) > 0:
-            print(f"Advertencia: Los siguientes clientes no se encontraron y se omitirán: {', '.join(map(str, unmapped_clientes))}")
+            print(f"Advertencia: Los siguientes clientes no se encontraron y sus filas se guardan en la cuarentena: {', '.join(map(str, unmapped_clientes))}")
+            metricas.clientes_no_mapeados(unmapped_clientes)
         
-        # Lógica de asignación de zona y limpieza
-        df = df.dropna(subset=['id_cliente']).copy()
+        # Lógica de asignación de zona y limpieza (las filas sin cliente se apartan para la cuarentena)
+        df_sin_cliente = df[df['id_cliente'].isna()]
+        df = df.dropna(subset=['id_cliente'])
         df['id_cliente'] = df['id_cliente'].astype(int)
+        metricas.contar(TABLE_NAME, 'mapeadas', len(df))
         
         # Si un cliente existe pero no tiene zona asignada en la DB, le ponemos la de por defecto
         df['id_zone'] = df['id_zone'].fillna(DEFAULT_ZONE_ID).astype(int)
@@ -133,53 +141,73 @@ try:
             print("VERIFICA que la columna 'id_zone' exista en tu tabla 'Clientes'.")
         exit()
     
-    # --- 7. Conversión Final de Tipos y Limpieza ---
+    # --- 7. Selección final de columnas ---
+    # Los tipos, largos máximos y valores por defecto ya los aplicó el contrato durante la lectura
     print("\nRealizando limpieza final...")
-    if 'amount_net' in df.columns:
-        df['amount_net'] = df['amount_net'].astype(str).str.replace('$', '', regex=False).str.replace(',', '', regex=False).str.strip()
-        df['amount_net'] = pd.to_numeric(df['amount_net'], errors='coerce').fillna(0.0)
-
-        cleaned_cantidad = df['cantidad'].astype(str).str.replace(',', '')
-        df['cantidad'] = pd.to_numeric(cleaned_cantidad, errors='coerce').fillna(0).astype(int)
-
-    if 'document_number' in df.columns:
-        df['document_number'] = df['document_number'].astype(str).str.strip().str[:20].fillna('')
-    
-    if 'estado' in df.columns:
-        df['estado'] = df['estado'].astype(str).str.strip().str[:50].fillna('Desconocido')
-        
     final_db_columns = [
         'id_cliente', 'class_item', 'cantidad', 'amount_net', 'document_number', 'estado', 'fecha',
         'id_zone', 'nombre_mes', 'mes', 'dia', 'año'
     ]
     df_para_sql = df[[col for col in final_db_columns if col in df.columns]]
+    # La cuarentena lleva las mismas columnas salvo id_cliente e id_zone, que salen de Clientes al reprocesar
+    columnas_cuarentena = [col for col in final_db_columns if col in df_sin_cliente.columns and col not in ('id_cliente', 'id_zone')]
+    df_cuarentena = df_sin_cliente[columnas_cuarentena + ['nombre_cliente']]
     print("Limpieza final completada.")
     
     # --- 8. Preparación final para la inserción ---
-    df_to_insert = df_para_sql.copy()
+    df_to_insert = df_para_sql
     print(f"\nTotal de filas en el DataFrame preparado: {len(df_para_sql)}")
     print(f"Filas a insertar (snapshot diario completo): {len(df_to_insert)}")
+    # El snapshot se carga completo: no hay deduplicación contra la tabla
+    metricas.contar(TABLE_NAME, 'deduplicadas', len(df_to_insert))
     
     # --- 10. Insertar el DataFrame en SQL Server por lotes ---
+    fecha_carga = datetime.date.today()
+
+    def guardar_cuarentena(connection):
+        # La cuarentena del día se reemplaza en la misma transacción que el snapshot
+        guardar_en_cuarentena(connection, df_cuarentena.assign(FechaCarga=fecha_carga), TABLE_NAME,
+                              input_file_path, ID_CARGA, fecha_carga=fecha_carga)
+
     if len(df_to_insert) == 0:
         print(f"No hay registros válidos para insertar en la tabla '{TABLE_NAME}'. Proceso completado.")
+        with engine.begin() as connection:
+            guardar_cuarentena(connection)
     else:
-        df_to_insert['FechaCarga'] = datetime.date.today()
+        df_to_insert['FechaCarga'] = fecha_carga
         
         print(f"\nIniciando inserción por lotes en la tabla '{TABLE_NAME}'...")
-        BATCH_SIZE = 1000
+        # Conciliación por zona con un solo agregado sobre la FechaCarga, en la misma transacción que el snapshot
+        antes_conciliacion, verificar_conciliacion = ganchos_conciliacion(
+            TABLE_NAME, df_to_insert, 'amount_net', 'id_zone', "WHERE t.FechaCarga = :fecha", {'fecha': fecha_carga},
+            incremental=MODO_SNAPSHOT == 'agregar')
+
+        def despues_del_snapshot(connection):
+            verificar_conciliacion(connection)
+            guardar_cuarentena(connection)
+
         try:
-            with engine.connect() as connection_insert_records:
-                with connection_insert_records.begin():
-                    df_to_insert.to_sql(TABLE_NAME, con=connection_insert_records, if_exists='append', index=False, chunksize=BATCH_SIZE)
+            # Una nueva corrida del mismo día reemplaza el snapshot de esa FechaCarga en lugar de duplicarlo
+            reemplazar_snapshot(engine, df_to_insert, TABLE_NAME, 'FechaCarga', fecha_carga,
+                                antes=antes_conciliacion, despues=despues_del_snapshot, id_carga=ID_CARGA)
             print(f"\nProceso de carga de '{TABLE_NAME}' finalizado. Total de filas insertadas: {len(df_to_insert)}.")
+            # Copia del snapshot en Parquet, particionada por FechaCarga
+            escribir_parquet(df_to_insert, TABLE_NAME, ID_CARGA, columnas_particion=['FechaCarga'], reemplazar=True)
+        except ErrorConciliacion as e:
+            # La transacción se revirtió: el snapshot anterior del día queda intacto
+            metricas.registrar_error(TABLE_NAME, e)
+            metricas.finalizar(exitosa=False)
+            sys.exit(1)
         except (ProgrammingError, IntegrityError, SQLAlchemyError) as e:
             print(f"\n¡ERROR DURANTE LA INSERCIÓN!")
             print(f"Tipo de error: {type(e).__name__}")
             print(f"Mensaje: {e}")
+            metricas.finalizar(exitosa=False)
+    metricas.finalizar()
             
 except Exception as e:
     print(f"Ocurrió un error inesperado en el script: {e}")
+    metricas.finalizar(exitosa=False)
 finally:
     if 'engine' in locals() and engine:
         engine.dispose()
@@ -0,0 +1,101 @@
+# Motor de reglas de remapeo de zonas, clientes y productos (reemplaza los casos especiales escritos en el código)
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+# --- Configuración de las Reglas ---
+# 'archivo': reglas_remapeo.json; 'db': tabla Reglas_Remapeo; 'auto': la tabla si tiene reglas del conjunto, si no el archivo.
+REGLAS_ORIGEN = os.environ.get("REGLAS_ORIGEN", "auto").lower()
+REGLAS_ARCHIVO = os.environ.get("REGLAS_ARCHIVO", "reglas_remapeo.json")
+REGLAS_TABLE_NAME = 'Reglas_Remapeo'
+COMODIN = '*' # Coincide con cualquier zona o nombre
+COLUMNAS_REGLA = ['zona', 'nombre', 'nueva_zona', 'nuevo_nombre', 'id']
+
+def _ruta_archivo():
+    """Ruta del archivo de reglas (dentro del ejecutable si se empaquetó con PyInstaller)."""
+    if getattr(sys, 'frozen', False) and not os.path.isabs(REGLAS_ARCHIVO):
+        return os.path.join(sys._MEIPASS, REGLAS_ARCHIVO)
+    return REGLAS_ARCHIVO
+
+def _reglas_desde_archivo(conjunto):
+    ruta = _ruta_archivo()
+    if not os.path.exists(ruta):
+        raise FileNotFoundError(f"No se encontró el archivo de reglas de remapeo '{ruta}'.")
+    with open(ruta, encoding='utf-8') as f:
+        return pd.DataFrame(json.load(f).get(conjunto, []), columns=COLUMNAS_REGLA)
+
+def _reglas_desde_db(engine, conjunto):
+    """Reglas activas del conjunto en la tabla Reglas_Remapeo; None si la tabla no existe."""
+    with engine.connect() as connection:
+        if connection.execute(text(f"SELECT OBJECT_ID(N'{REGLAS_TABLE_NAME}', N'U');")).scalar() is None:
+            return None
+        reglas_query = text(f"""
+            SELECT zona, nombre, nueva_zona, nuevo_nombre, id_destino AS id
+            FROM {REGLAS_TABLE_NAME} WHERE conjunto = :conjunto AND activa = 1;
+        """)
+        return pd.read_sql_query(reglas_query, connection, params={'conjunto': conjunto})
+
+def _clave(serie):
+    """Clave de comparación: sin espacios en los extremos y en minúsculas."""
+    return serie.astype(str).str.strip().str.lower()
+
+def compilar_reglas(reglas):
+    """
+    Compila las reglas en una tabla de búsqueda indexada por (zona, nombre). Una zona o nombre vacío equivale
+    al comodín. Si dos reglas tienen la misma condición se queda la última.
+    """
+    reglas = reglas.reindex(columns=COLUMNAS_REGLA)
+    reglas['zona'] = _clave(reglas['zona'].fillna(COMODIN).replace('', COMODIN))
+    reglas['nombre'] = _clave(reglas['nombre'].fillna(COMODIN).replace('', COMODIN))
+    reglas['id'] = pd.to_numeric(reglas['id'], errors='coerce')
+    return reglas.drop_duplicates(subset=['zona', 'nombre'], keep='last').set_index(['zona', 'nombre'])
+
+def cargar_reglas(conjunto, engine=None):
+    """Carga y compila las reglas de un conjunto ('cartera', 'wor_zonas', 'wor_productos', ...)."""
+    reglas = None
+    if engine is not None and REGLAS_ORIGEN in ('db', 'auto'):
+        reglas = _reglas_desde_db(engine, conjunto)
+        if reglas is None and REGLAS_ORIGEN == 'db':
+            raise ValueError(f"La tabla '{REGLAS_TABLE_NAME}' no existe y REGLAS_ORIGEN='db'.")
+        if reglas is not None and reglas.empty and REGLAS_ORIGEN == 'auto':
+            reglas = None
+    origen = REGLAS_TABLE_NAME
+    if reglas is None:
+        reglas = _reglas_desde_archivo(conjunto)
+        origen = _ruta_archivo()
+    print(f"Reglas de remapeo '{conjunto}' cargadas desde '{origen}': {len(reglas)} reglas.")
+    return compilar_reglas(reglas)
+
+def _buscar(reglas, zonas, nombres):
+    """
+    Regla que aplica a cada fila, en orden de prioridad: (zona, nombre), (zona, *), (*, nombre).
+    Son tres búsquedas vectorizadas sin importar cuántas reglas haya. De cada fila se toma la regla completa
+    de mayor prioridad que coincide: sus campos vacíos no se completan con los de una regla más general.
+    """
+    posiciones = np.full(len(zonas), -1)
+    for claves_zona, claves_nombre in ((zonas, nombres), (zonas, COMODIN), (COMODIN, nombres)):
+        indice = pd.MultiIndex.from_arrays([
+            claves_zona if isinstance(claves_zona, pd.Series) else pd.Series(COMODIN, index=zonas.index),
+            claves_nombre if isinstance(claves_nombre, pd.Series) else pd.Series(COMODIN, index=nombres.index),
+        ])
+        posiciones = np.where(posiciones >= 0, posiciones, reglas.index.get_indexer(indice))
+    # La posición -1 (ninguna regla) queda como fila vacía
+    return reglas.reset_index(drop=True).reindex(posiciones).set_axis(zonas.index)
+
+def aplicar_reglas(df, reglas, columna_zona=None, columna_nombre=None):
+    """
+    Aplica las reglas al DataFrame en una sola pasada: reescribe la zona y el nombre de las filas que
+    coinciden y devuelve una Serie con el id asignado por la regla (NaN si ninguna regla asigna id).
+    """
+    sin_columna = pd.Series(COMODIN, index=df.index)
+    zonas = _clave(df[columna_zona]) if columna_zona else sin_columna
+    nombres = _clave(df[columna_nombre]) if columna_nombre else sin_columna
+    coincidencias = _buscar(reglas, zonas, nombres)
+    if columna_zona:
+        df[columna_zona] = coincidencias['nueva_zona'].where(coincidencias['nueva_zona'].notna(), df[columna_zona])
+    if columna_nombre:
+        df[columna_nombre] = coincidencias['nuevo_nombre'].where(coincidencias['nuevo_nombre'].notna(), df[columna_nombre])
+    return coincidencias['id']
@@ -0,0 +1,186 @@
+# Carga de snapshots diarios (Cartera, Pending_Orders): reemplazo atómico de las filas de una FechaCarga
+import os
+import uuid
+from sqlalchemy import text
+from insercion import insertar_por_lotes
+
+# --- Configuración del Modo Snapshot ---
+# 'reemplazar': una nueva corrida del mismo día reemplaza el snapshot de esa fecha.
+# 'agregar': las filas se agregan a la tabla como antes (una segunda corrida duplica el día).
+MODO_SNAPSHOT = os.environ.get("SNAPSHOT_MODO", "reemplazar").lower()
+
+def describir_particion(connection, table_name, columna_fecha):
+    """Si la tabla está particionada por la columna de fecha devuelve (esquema, función de partición); si no, None."""
+    particion_query = text("""
+        SELECT ps.name AS esquema, pf.name AS funcion, c.name AS columna
+        FROM sys.indexes i
+        JOIN sys.partition_schemes ps ON ps.data_space_id = i.data_space_id
+        JOIN sys.partition_functions pf ON pf.function_id = ps.function_id
+        JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id AND ic.partition_ordinal = 1
+        JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        WHERE i.object_id = OBJECT_ID(:tabla) AND i.index_id IN (0, 1);
+    """)
+    fila = connection.execute(particion_query, {'tabla': table_name}).first()
+    if fila is None or fila.columna != columna_fecha:
+        return None
+    return fila.esquema, fila.funcion
+
+def particion_exclusiva(connection, table_name, columna_fecha, funcion, fecha):
+    """
+    Número de la partición donde cae la fecha, siempre que no tenga filas de otras fechas (si la tiene,
+    intercambiar la partición completa borraría esos días). Si no se puede usar SWITCH devuelve None.
+    Se llama dentro de la transacción del reemplazo: el bloqueo se mantiene hasta el SWITCH, así otra carga
+    no puede agregar filas de otra fecha a la partición entre la verificación y el intercambio.
+    """
+    numero = connection.execute(text(f"SELECT $PARTITION.[{funcion}](:fecha);"), {'fecha': fecha}).scalar()
+    otras_fechas = connection.execute(text(
+        f"SELECT COUNT_BIG(*) FROM {table_name} WITH (UPDLOCK, HOLDLOCK) "
+        f"WHERE $PARTITION.[{funcion}]([{columna_fecha}]) = :numero AND [{columna_fecha}] <> :fecha;"
+    ), {'numero': numero, 'fecha': fecha}).scalar()
+    return numero if otras_fechas == 0 else None
+
+def describir_columnas(connection, table_name):
+    """Columnas de la tabla en orden, con la definición de las calculadas."""
+    columnas_query = text("""
+        SELECT c.name, c.is_computed, c.is_nullable, cc.definition, cc.is_persisted
+        FROM sys.columns c
+        LEFT JOIN sys.computed_columns cc ON cc.object_id = c.object_id AND cc.column_id = c.column_id
+        WHERE c.object_id = OBJECT_ID(:tabla)
+        ORDER BY c.column_id;
+    """)
+    return connection.execute(columnas_query, {'tabla': table_name}).fetchall()
+
+def espejo_reproducible(columnas):
+    """
+    La tabla espejo agrega las columnas calculadas al final: solo tiene la misma estructura que la original
+    si en ella las calculadas ya están después de todas las columnas comunes.
+    """
+    calculadas = [col.is_computed for col in columnas]
+    return calculadas == sorted(calculadas)
+
+def crear_tabla_espejo(connection, table_name, nueva, esquema, columna_fecha):
+    """
+    Crea un heap vacío con las mismas columnas que la original y en el mismo esquema de partición; con
+    crear_indices_espejo queda como exige ALTER TABLE ... SWITCH entre particiones. SELECT INTO convertiría
+    las columnas calculadas en columnas comunes, así que se copian solo las columnas comunes y las calculadas
+    se agregan con su definición del catálogo (ver espejo_reproducible).
+    """
+    columnas = describir_columnas(connection, table_name)
+    comunes = ", ".join(f"[{col.name}]" for col in columnas if not col.is_computed)
+    connection.execute(text(f"DROP TABLE IF EXISTS {nueva};"))
+    connection.execute(text(f"SELECT TOP 0 {comunes} INTO {nueva} FROM {table_name};"))
+    for col in columnas:
+        if col.is_computed:
+            persistida = f" PERSISTED{'' if col.is_nullable else ' NOT NULL'}" if col.is_persisted else ''
+            connection.execute(text(f"ALTER TABLE {nueva} ADD [{col.name}] AS {col.definition}{persistida};"))
+    # Un índice agrupado temporal ubica el heap en el esquema de partición
+    ubicacion = f"ON [{esquema}]([{columna_fecha}])"
+    connection.execute(text(f"CREATE CLUSTERED INDEX CIX_espejo ON {nueva} ([{columna_fecha}]) {ubicacion};"))
+    connection.execute(text(f"DROP INDEX CIX_espejo ON {nueva};"))
+
+def crear_indices_espejo(connection, table_name, nueva, esquema, columna_fecha):
+    """Crea en la tabla espejo los índices de la original, alineados al esquema de partición y con sus filtros."""
+    indices_query = text("""
+        SELECT i.index_id, i.name, i.type, i.is_unique, i.filter_definition, c.name AS columna,
+               ic.key_ordinal, ic.is_descending_key, ic.is_included_column
+        FROM sys.indexes i
+        JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+        JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        WHERE i.object_id = OBJECT_ID(:tabla) AND i.index_id > 0 AND i.is_hypothetical = 0
+        ORDER BY i.index_id, ic.is_included_column, ic.key_ordinal, ic.index_column_id;
+    """)
+    indices = {}
+    for fila in connection.execute(indices_query, {'tabla': table_name}):
+        indice = indices.setdefault(fila.index_id, {'nombre': fila.name, 'tipo': fila.type, 'unico': fila.is_unique,
+                                                    'filtro': fila.filter_definition, 'clave': [], 'incluidas': []})
+        if fila.key_ordinal > 0:
+            indice['clave'].append(f"[{fila.columna}] {'DESC' if fila.is_descending_key else 'ASC'}")
+        else:
+            indice['incluidas'].append(f"[{fila.columna}]")
+
+    ubicacion = f"ON [{esquema}]([{columna_fecha}])"
+    for indice in indices.values():
+        unico = 'UNIQUE ' if indice['unico'] else ''
+        incluidas = f" INCLUDE ({', '.join(indice['incluidas'])})" if indice['incluidas'] else ''
+        filtro = f" WHERE {indice['filtro']}" if indice['filtro'] else ''
+        if indice['tipo'] == 5:
+            sentencia = f"CREATE CLUSTERED COLUMNSTORE INDEX [{indice['nombre']}] ON {nueva} {ubicacion};"
+        elif indice['tipo'] == 6:
+            sentencia = f"CREATE NONCLUSTERED COLUMNSTORE INDEX [{indice['nombre']}] ON {nueva} ({', '.join(indice['incluidas'])}){filtro} {ubicacion};"
+        elif indice['tipo'] == 1:
+            sentencia = f"CREATE {unico}CLUSTERED INDEX [{indice['nombre']}] ON {nueva} ({', '.join(indice['clave'])}) {ubicacion};"
+        else:
+            sentencia = f"CREATE {unico}NONCLUSTERED INDEX [{indice['nombre']}] ON {nueva} ({', '.join(indice['clave'])}){incluidas}{filtro} {ubicacion};"
+        connection.execute(text(sentencia))
+
+def reemplazar_snapshot(engine, df, table_name, columna_fecha, fecha, antes=None, despues=None, id_carga=None):
+    """
+    Carga el snapshot de 'fecha' de forma idempotente. Las filas se cargan primero en una tabla de staging
+    y después, en la misma transacción, reemplazan a las que ya hubiera para esa fecha. El staging es un heap
+    que se llena con la copia masiva del driver y TABLOCK (ver insercion._copiar_masivo); sin copia masiva
+    se llena con INSERT ... VALUES por lotes, que no se registran mínimamente.
+    - Tabla particionada por la fecha: se crean los índices del staging y ALTER TABLE ... SWITCH de la
+      partición (solo metadatos).
+    - Si no: DELETE de la fecha e INSERT ... SELECT WITH (TABLOCK) desde el staging.
+    Los lectores nunca ven un día a medio cargar. 'antes' y 'despues' corren dentro de la misma transacción.
+    Las tablas auxiliares llevan el id de la carga en el nombre, así dos cargas simultáneas no comparten staging.
+    Devuelve el total de filas cargadas.
+    """
+    if MODO_SNAPSHOT == 'agregar':
+        return insertar_por_lotes(engine, df, table_name, antes=antes, despues=despues)
+
+    # Solo decide el tipo de staging: SWITCH exige una tabla permanente en el mismo esquema de partición.
+    # Si se puede usar SWITCH se vuelve a verificar dentro de la transacción (preparar_staging).
+    with engine.connect() as connection:
+        particionada = describir_particion(connection, table_name, columna_fecha) is not None
+
+    sufijo = id_carga or uuid.uuid4().hex
+    columnas = ", ".join(f"[{col}]" for col in df.columns)
+    if particionada:
+        staging = f"{table_name}_snapshot_staging_{sufijo}"
+        salida = f"{table_name}_snapshot_salida_{sufijo}"
+    else:
+        # Tabla temporal: no choca con otras ejecuciones y tempdb usa recuperación simple, así que la copia
+        # masiva con TABLOCK al heap se registra mínimamente
+        staging = f"#snapshot_{table_name}"
+    numero_particion = esquema_particion = None
+
+    def preparar_staging(connection):
+        nonlocal numero_particion, esquema_particion
+        if antes:
+            antes(connection)
+        particion = describir_particion(connection, table_name, columna_fecha) if particionada else None
+        esquema_particion = particion[0] if particion else None
+        numero_particion = particion_exclusiva(connection, table_name, columna_fecha, particion[1], fecha) if particion else None
+        if particion and numero_particion is None:
+            print(f"La partición de {fecha} en '{table_name}' contiene otras fechas; se reemplaza con DELETE + INSERT.")
+        if numero_particion and not espejo_reproducible(describir_columnas(connection, table_name)):
+            print(f"'{table_name}' tiene columnas calculadas entre columnas comunes y no se puede armar una tabla "
+                  f"espejo para SWITCH; se reemplaza con DELETE + INSERT.")
+            numero_particion = None
+        if numero_particion:
+            crear_tabla_espejo(connection, table_name, staging, esquema_particion, columna_fecha)
+        else:
+            connection.execute(text(f"DROP TABLE IF EXISTS {staging};"))
+            connection.execute(text(f"SELECT TOP 0 {columnas} INTO {staging} FROM {table_name};"))
+
+    def intercambiar(connection):
+        if numero_particion:
+            # Los índices del staging se crean después de la carga, sobre el heap ya lleno
+            crear_indices_espejo(connection, table_name, staging, esquema_particion, columna_fecha)
+            crear_tabla_espejo(connection, table_name, salida, esquema_particion, columna_fecha)
+            crear_indices_espejo(connection, table_name, salida, esquema_particion, columna_fecha)
+            connection.execute(text(f"ALTER TABLE {table_name} SWITCH PARTITION {numero_particion} TO {salida} PARTITION {numero_particion};"))
+            connection.execute(text(f"ALTER TABLE {staging} SWITCH PARTITION {numero_particion} TO {table_name} PARTITION {numero_particion};"))
+            connection.execute(text(f"DROP TABLE {salida};"))
+            print(f"Partición {numero_particion} de '{table_name}' ({fecha}) reemplazada con SWITCH.")
+        else:
+            eliminadas = connection.execute(text(f"DELETE FROM {table_name} WHERE [{columna_fecha}] = :fecha;"), {'fecha': fecha}).rowcount
+            connection.execute(text(f"INSERT INTO {table_name} WITH (TABLOCK) ({columnas}) SELECT {columnas} FROM {staging};"))
+            if eliminadas > 0:
+                print(f"Se reemplazaron {eliminadas} filas del snapshot anterior de {fecha} en '{table_name}'.")
+        connection.execute(text(f"DROP TABLE {staging};"))
+        if despues:
+            despues(connection)
+
+    return insertar_por_lotes(engine, df, table_name, antes=preparar_staging, despues=intercambiar, destino=staging)
@@ -0,0 +1,9 @@
+# Los módulos de la carga están en la raíz del repositorio (no es un paquete)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Igual que en los scripts: con pandas anterior a 3.0 se mide con copy-on-write activo
+from arranque import activar_copy_on_write
+activar_copy_on_write()
@@ -0,0 +1,230 @@
+# Presupuesto de memoria por fila de las transformaciones de cada pipeline.
+# Cada transformación corre sobre datos sintéticos bajo tracemalloc y el pico de memoria asignada se divide por
+# las filas de entrada. Si un cambio agrega una copia completa del DataFrame, el pico por fila crece y el test
+# falla (test_copia_extra_supera_presupuesto verifica que el margen no alcanza para una copia).
+import os
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+
+import contratos
+import reglas_remapeo
+import transformaciones
+from conciliacion import totales_control
+
+FILAS = 20000
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Pico de memoria permitido, en bytes por fila de entrada: lo medido más un margen chico (alrededor del 10%),
+# menor que lo que agrega una copia del DataFrame. Si un cambio los supera, revisar antes de subirlos que no se
+# esté copiando el DataFrame completo sin necesidad.
+PRESUPUESTO_BYTES_POR_FILA = {
+    'lectura_ventas_totales': 170,
+    'lectura_cartera': 140,
+    'lectura_pending_orders': 130,
+    'reglas_cartera': 220,
+    'reglas_wor_zonas': 155,
+    'totales_control': 125,
+    'normalizar_claves_ventas': 85,
+    'dedup_ventas': 105,
+    'limpiar_forecast_wor': 235,
+    'limpiar_category_wor': 65,
+    'ids_cliente_wor': 160,
+    'preparar_forecast_wor': 150,
+    'preparar_cuota_forecast_wor': 105,
+    'preparar_cuotas_zona_wor': 115,
+    'preparar_cuotas_wor': 160,
+    'dedup_wor': 90,
+    'preparar_snapshot_cartera': 265,
+    'antiguedad_cartera': 85,
+    'resumen_antiguedad_cartera': 145,
+}
+
+def pico_por_fila(funcion, filas):
+    """
+    Ejecuta la función bajo tracemalloc. Devuelve (pico de memoria asignada por fila, resultado).
+    Antes corre una vez sin medir, para que los imports y caches del primer uso no cuenten.
+    """
+    funcion()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        resultado = funcion()
+        pico = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (pico - base) / filas, resultado
+
+def verificar_presupuesto(nombre, bytes_por_fila):
+    presupuesto = PRESUPUESTO_BYTES_POR_FILA[nombre]
+    assert bytes_por_fila <= presupuesto, (
+        f"'{nombre}' usó {bytes_por_fila:,.0f} bytes por fila; el presupuesto es {presupuesto:,.0f}.")
+
+def _valor_sintetico(tipo, spec, i):
+    """Valor de texto como lo trae el reporte exportado para la columna de origen."""
+    if tipo == 'fecha':
+        return f"{1 + i % 12:02d}/{1 + i % 28:02d}/2024"
+    if tipo == 'moneda':
+        return f"${(i % 1000) * 12.5:,.2f}" if i % 7 else f"$({(i % 1000) * 1.5:,.2f})"
+    if tipo in ('entero', 'decimal'):
+        return str(i % 50)
+    return f"Texto {i % 500}"
+
+def escribir_reporte(tmp_path, nombre_contrato, filas=FILAS):
+    """CSV sintético con las columnas de origen del contrato (6 filas de encabezado y pie si el contrato los lee)."""
+    contrato = contratos.CONTRATOS[nombre_contrato]
+    df = pd.DataFrame({
+        spec['origen'][0]: [_valor_sintetico(spec['tipo'], spec, i) for i in range(filas)]
+        for spec in contrato['columnas'].values()
+    })
+    ruta = tmp_path / f"{nombre_contrato}.csv"
+    with open(ruta, 'w', encoding='utf-8', newline='') as f:
+        f.write("Reporte\n" * contrato['lectura'].get('skiprows', 0))
+        df.to_csv(f, index=False)
+        if contrato.get('pie'):
+            f.write(','.join('Total' if i == 0 else '' for i in range(len(df.columns))) + '\n')
+    return ruta
+
+@pytest.mark.parametrize('nombre_contrato', ['ventas_totales', 'cartera', 'pending_orders'])
+def test_lectura_con_contrato(tmp_path, nombre_contrato):
+    ruta = escribir_reporte(tmp_path, nombre_contrato)
+    bytes_por_fila, df = pico_por_fila(lambda: contratos.leer_con_contrato(str(ruta), nombre_contrato), FILAS)
+    assert len(df) == FILAS
+    verificar_presupuesto(f"lectura_{nombre_contrato}", bytes_por_fila)
+
+@pytest.fixture
+def reglas(monkeypatch):
+    monkeypatch.setattr(reglas_remapeo, 'REGLAS_ARCHIVO', os.path.join(RAIZ, 'reglas_remapeo.json'))
+    return lambda conjunto: reglas_remapeo.cargar_reglas(conjunto)
+
+def test_reglas_cartera(reglas):
+    reglas_cartera = reglas('cartera')
+    zonas = np.array(['Walmart', 'Amazon', 'Zone 1', 'Zone 2'], dtype=object)
+    nombres = np.array(['Ecommerce', '- no customer/project -', 'Cliente A', 'Cliente B'], dtype=object)
+    df = pd.DataFrame({'zona_csv_original': zonas[np.arange(FILAS) % 4], 'nombre_cliente': nombres[np.arange(FILAS) % 3]})
+    bytes_por_fila, _ = pico_por_fila(
+        lambda: reglas_remapeo.aplicar_reglas(df, reglas_cartera, columna_zona='zona_csv_original', columna_nombre='nombre_cliente'), FILAS)
+    assert (df['nombre_cliente'] == 'Walmart Ecommerce').any()
+    verificar_presupuesto('reglas_cartera', bytes_por_fila)
+
+def test_reglas_wor_zonas(reglas):
+    reglas_zonas = reglas('wor_zonas')
+    df = pd.DataFrame({'Zone': [f"Zone {1 + i % 7}" for i in range(FILAS)]})
+    bytes_por_fila, ids = pico_por_fila(lambda: reglas_remapeo.aplicar_reglas(df, reglas_zonas, columna_zona='Zone'), FILAS)
+    assert ids.notna().all()
+    verificar_presupuesto('reglas_wor_zonas', bytes_por_fila)
+
+def test_totales_control():
+    df = pd.DataFrame({'id_zone': np.arange(FILAS) % 11, 'open_balance': np.arange(FILAS) * 1.25})
+    bytes_por_fila, totales = pico_por_fila(lambda: totales_control(df, 'open_balance', 'id_zone'), FILAS)
+    assert sum(filas for filas, _ in totales.values()) == FILAS
+    verificar_presupuesto('totales_control', bytes_por_fila)
+
+# --- Transformaciones de los pipelines (transformaciones.py) ---
+FECHA_CARGA = pd.Timestamp('2024-12-31').date()
+CLAVES_WOR = ['id_cliente', 'id_zone', 'mes', 'año']
+CLIENTES_WOR = pd.DataFrame({'nombre_cliente': [f"cliente {i}" for i in range(380)], 'id_cliente': np.arange(380)})
+
+def ventas_mapeadas(tmp_path):
+    """Ventas Totales como quedan después de mapear los clientes (entrada de la deduplicación)."""
+    df = contratos.leer_con_contrato(str(escribir_reporte(tmp_path, 'ventas_totales')), 'ventas_totales')
+    return df.assign(nombre_cliente_lower=df['nombre_cliente'].str.lower(), id_cliente=np.arange(FILAS) % 300)
+
+def cartera_mapeada(tmp_path):
+    """Cartera como queda después del merge con Clientes; una de cada 20 filas sin cliente."""
+    df = contratos.leer_con_contrato(str(escribir_reporte(tmp_path, 'cartera')), 'cartera')
+    indice = np.arange(FILAS)
+    return df.assign(nombre_cliente_cleaned=df['nombre_cliente'].str.lower(),
+                     id_cliente=np.where(indice % 20, indice % 300, np.nan),
+                     id_zone=(indice % 7 + 1).astype(float))
+
+def tabla_wor():
+    """Tabla del WOR como sale del libro: celdas vacías, cuotas en cero y nombres de cliente con espacios."""
+    indice = np.arange(FILAS)
+    return pd.DataFrame({
+        'nombre_cliente': [f" Cliente {i % 400} " for i in range(FILAS)],
+        **{f"semana_{n}": np.where(indice % 9, (indice % 100) * 1.5, None) for n in range(1, 6)},
+        'TOTAL': np.where(indice % 4, (indice % 50) * 10.0, 0),
+        'nombre_mes': 'January', 'mes': 1 + indice % 12, 'año': 2024,
+        'Zone': [f"Zone {1 + i % 6}" for i in range(FILAS)],
+        'id_zone': 1 + indice % 6,
+    })
+
+def wor_mapeada():
+    """Tabla del WOR con id_cliente mapeado; los clientes 380 a 399 no existen."""
+    df = tabla_wor()
+    return df.assign(id_cliente=transformaciones.ids_cliente_por_nombre(df['nombre_cliente'], CLIENTES_WOR))
+
+def etapas(tmp_path):
+    """Cada etapa: (función que recibe el DataFrame de entrada, DataFrame de entrada)."""
+    ventas = ventas_mapeadas(tmp_path)
+    ventas_existentes = ventas.iloc[::3][transformaciones.CLAVES_VENTAS]
+    cartera = cartera_mapeada(tmp_path)
+    snapshot, _ = transformaciones.preparar_snapshot_cartera(cartera, FECHA_CARGA)
+    wor = wor_mapeada()
+    forecast, _ = transformaciones.preparar_forecast(wor)
+    libro = tabla_wor().rename(columns={'nombre_cliente': 'ZONA/CLIENTE'}).assign(**{'Py %': 0.5})
+    cuotas = wor.assign(id_producto=np.where(np.arange(FILAS) % 10, np.arange(FILAS) % 40, np.nan),
+                        cuota_dinero=wor['semana_1'], cuota_volumen=wor['semana_2'])
+    return {
+        'normalizar_claves_ventas': (transformaciones.normalizar_claves, ventas),
+        'dedup_ventas': (lambda df: transformaciones.filtrar_claves_existentes(df, ventas_existentes), ventas),
+        'limpiar_forecast_wor': (lambda df: transformaciones.limpiar_dataframe(df, 'forecast'), libro),
+        'limpiar_category_wor': (lambda df: transformaciones.limpiar_dataframe(df, 'category'), libro),
+        'ids_cliente_wor': (lambda df: transformaciones.ids_cliente_por_nombre(df['nombre_cliente'], CLIENTES_WOR), wor),
+        'preparar_forecast_wor': (transformaciones.preparar_forecast, wor),
+        'preparar_cuota_forecast_wor': (transformaciones.preparar_cuota_forecast, wor),
+        'preparar_cuotas_zona_wor': (transformaciones.preparar_cuotas_zona, wor),
+        'preparar_cuotas_wor': (transformaciones.preparar_cuotas, cuotas),
+        'dedup_wor': (lambda df: transformaciones.filas_nuevas(df, forecast.iloc[::3][CLAVES_WOR], CLAVES_WOR), forecast),
+        'preparar_snapshot_cartera': (lambda df: transformaciones.preparar_snapshot_cartera(df, FECHA_CARGA), cartera),
+        'antiguedad_cartera': (lambda df: transformaciones.calcular_antiguedad(df, FECHA_CARGA), cartera),
+        'resumen_antiguedad_cartera': (lambda df: transformaciones.resumir_antiguedad(df, FECHA_CARGA), snapshot),
+    }
+
+NOMBRES_ETAPAS = [
+    'normalizar_claves_ventas', 'dedup_ventas', 'limpiar_forecast_wor', 'limpiar_category_wor', 'ids_cliente_wor',
+    'preparar_forecast_wor', 'preparar_cuota_forecast_wor', 'preparar_cuotas_zona_wor', 'preparar_cuotas_wor',
+    'dedup_wor', 'preparar_snapshot_cartera', 'antiguedad_cartera', 'resumen_antiguedad_cartera',
+]
+
+@pytest.mark.parametrize('nombre', NOMBRES_ETAPAS)
+def test_transformacion(tmp_path, nombre):
+    funcion, df = etapas(tmp_path)[nombre]
+    bytes_por_fila, _ = pico_por_fila(lambda: funcion(df), FILAS)
+    verificar_presupuesto(nombre, bytes_por_fila)
+
+def test_transformaciones_resultado(tmp_path):
+    """Las etapas medidas hacen lo que se espera sobre los datos sintéticos (no se mide un camino vacío)."""
+    pasos = etapas(tmp_path)
+    funcion, ventas = pasos['dedup_ventas']
+    assert len(funcion(ventas)) == FILAS - len(range(0, FILAS, 3))
+    funcion, cartera = pasos['preparar_snapshot_cartera']
+    snapshot, cuarentena = funcion(cartera)
+    assert len(snapshot) + len(cuarentena) == FILAS and len(cuarentena) == FILAS // 20
+    assert snapshot['rango_antiguedad'].notna().all()
+    funcion, wor = pasos['preparar_forecast_wor']
+    forecast, sin_cliente = funcion(wor)
+    assert len(sin_cliente) > 0 and forecast['id_cliente'].dtype.kind == 'i'
+    funcion, forecast = pasos['dedup_wor']
+    assert 0 < len(funcion(forecast)) < len(forecast)
+
+@pytest.mark.parametrize('nombre', NOMBRES_ETAPAS)
+def test_copia_extra_supera_presupuesto(tmp_path, nombre):
+    """Una copia completa de la entrada (un df.copy() que vuelva a aparecer en la etapa) no entra en el presupuesto."""
+    funcion, df = etapas(tmp_path)[nombre]
+    bytes_por_fila, _ = pico_por_fila(lambda: funcion(df.copy(deep=True)), FILAS)
+    assert bytes_por_fila > PRESUPUESTO_BYTES_POR_FILA[nombre]
+
+@pytest.mark.parametrize('nombre_contrato', ['ventas_totales', 'cartera'])
+def test_copia_extra_en_lectura_supera_presupuesto(tmp_path, nombre_contrato):
+    """Una copia completa del DataFrame leído, mientras el original sigue en uso, no entra en el presupuesto."""
+    ruta = str(escribir_reporte(tmp_path, nombre_contrato))
+
+    def leer_y_copiar():
+        df = contratos.leer_con_contrato(ruta, nombre_contrato)
+        return df, df.copy(deep=True)
+
+    bytes_por_fila, _ = pico_por_fila(leer_y_copiar, FILAS)
+    assert bytes_por_fila > PRESUPUESTO_BYTES_POR_FILA[f"lectura_{nombre_contrato}"]
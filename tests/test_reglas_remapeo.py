@@ -0,0 +1,30 @@
+# Prioridad de las reglas de remapeo: (zona, nombre), (zona, *), (*, nombre)
+import pandas as pd
+
+from reglas_remapeo import compilar_reglas, aplicar_reglas
+
+def test_regla_especifica_no_se_mezcla_con_la_general():
+    reglas = compilar_reglas(pd.DataFrame([
+        {'zona': 'Walmart', 'nombre': 'Ecommerce', 'nueva_zona': 'E-Commerce', 'nuevo_nombre': None},
+        {'zona': '*', 'nombre': 'Ecommerce', 'nueva_zona': None, 'nuevo_nombre': 'Cliente Ecommerce', 'id': 7},
+    ]))
+    df = pd.DataFrame({'zona': ['Walmart', 'Zone 1'], 'nombre': ['Ecommerce', 'Ecommerce']})
+    ids = aplicar_reglas(df, reglas, columna_zona='zona', columna_nombre='nombre')
+    # La regla específica no trae nuevo nombre ni id: el nombre queda igual y no se toma el id de la general
+    assert df.loc[0, 'zona'] == 'E-Commerce'
+    assert df.loc[0, 'nombre'] == 'Ecommerce'
+    assert pd.isna(ids[0])
+    # Sin regla específica aplica la general
+    assert df.loc[1, 'zona'] == 'Zone 1'
+    assert df.loc[1, 'nombre'] == 'Cliente Ecommerce'
+    assert ids[1] == 7
+
+def test_zona_con_comodin_tiene_prioridad_sobre_nombre_con_comodin():
+    reglas = compilar_reglas(pd.DataFrame([
+        {'zona': '*', 'nombre': 'Cliente A', 'id': 1},
+        {'zona': 'Zone 2', 'nombre': '*', 'id': 2},
+    ]))
+    df = pd.DataFrame({'zona': ['Zone 2', 'Zone 3', 'Zone 3'], 'nombre': ['Cliente A', 'cliente a ', 'Otro']})
+    ids = aplicar_reglas(df, reglas, columna_zona='zona', columna_nombre='nombre')
+    assert ids.tolist()[:2] == [2, 1]
+    assert pd.isna(ids[2])
@@ -0,0 +1,162 @@
+# Transformaciones de los pipelines que no usan la base de datos: deduplicación de Ventas Totales, limpieza y
+# preparación de las tablas del WOR, y antigüedad y preparación del snapshot de Cartera. Están fuera de los
+# scripts (que abren el diálogo y se conectan al importarlos) para que tests/test_memoria.py mida su memoria.
+import numpy as np
+import pandas as pd
+
+# --- Ventas Totales: deduplicación ---
+CLAVES_VENTAS = ['id_cliente', 'fecha', 'document_number', 'item']
+
+def normalizar_claves(df):
+    """Normaliza las columnas de deduplicación para comparar el archivo con la tabla."""
+    df_claves = df[CLAVES_VENTAS]
+    if df_claves.empty:
+        return df_claves
+    df_claves['id_cliente'] = df_claves['id_cliente'].astype(int)
+    df_claves['document_number'] = df_claves['document_number'].astype(str).str.strip()
+    df_claves['fecha'] = pd.to_datetime(df_claves['fecha']).dt.normalize()
+    df_claves['item'] = df_claves['item'].astype(str).str.strip()
+    return df_claves
+
+def filtrar_claves_existentes(df, existentes):
+    """
+    Filas cuya clave (id_cliente, fecha, document_number, item) no está entre las existentes, sin las columnas
+    del nombre de cliente. Las claves se comparan como MultiIndex (vectorizado) en lugar de armar una tupla por fila.
+    """
+    if existentes.empty:
+        df_nuevas = df
+    else:
+        claves_existentes = pd.MultiIndex.from_frame(normalizar_claves(existentes))
+        df_nuevas = df[~pd.MultiIndex.from_frame(normalizar_claves(df)).isin(claves_existentes)]
+    return df_nuevas.drop(columns=['nombre_cliente', 'nombre_cliente_lower'], errors='ignore')
+
+# --- WOR: limpieza y preparación de las tablas ---
+COLUMNAS_SEMANAS = ['semana_1', 'semana_2', 'semana_3', 'semana_4', 'semana_5']
+
+def limpiar_dataframe(df, tipo_tabla):
+    df_clean = df.fillna(0)
+    if tipo_tabla == 'forecast':
+        df_clean = df_clean.drop(columns=['Py %'], errors='ignore')
+        df_clean = df_clean.drop(index=df_clean.index[0], errors='ignore')
+        # Se recorre por columna (pocas) en lugar de por fila, sin convertir cada fila a una Serie
+        contiene_total = df_clean.apply(lambda columna: columna.astype(str).str.contains('Total', regex=False)).any(axis=1)
+        df_clean = df_clean[~contiene_total]
+        columna_1 = df_clean.columns[0]
+        df_clean = df_clean[df_clean[columna_1] != 0]
+    return df_clean
+
+def ids_cliente_por_nombre(nombres, clientes_db):
+    """id_cliente de cada nombre, comparando sin espacios y en mayúsculas; NaN si el cliente no existe."""
+    clientes_map = dict(zip(clientes_db['nombre_cliente'].astype(str).str.strip().str.upper(), clientes_db['id_cliente']))
+    return nombres.str.strip().str.upper().map(clientes_map)
+
+def apartar_sin_cliente(df, nombres_sin_cliente):
+    """
+    Separa las filas sin cliente (ya con las columnas de la tabla). Devuelve (filas con cliente, filas para la cuarentena).
+    Se cargan después, cuando el cliente exista en Clientes, con 'python cuarentena.py'.
+    """
+    df_sin_cliente = df.loc[nombres_sin_cliente.index].drop(columns=['id_cliente']).assign(nombre_cliente=nombres_sin_cliente)
+    return df.drop(index=nombres_sin_cliente.index), df_sin_cliente
+
+def preparar_forecast(df):
+    """Columnas de Forecast con las semanas numéricas. Devuelve (filas con cliente, filas para la cuarentena)."""
+    # Las filas sin cliente se apartan después de la limpieza, así llegan a la cuarentena con las columnas de la tabla
+    nombres_sin_cliente = df.loc[df['id_cliente'].isna(), 'nombre_cliente']
+    cols_to_keep = COLUMNAS_SEMANAS + ['mes', 'año', 'id_cliente', 'id_zone', 'nombre_mes']
+    df = df.filter(items=cols_to_keep)
+    for col in COLUMNAS_SEMANAS:
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(float)
+    df, df_sin_cliente = apartar_sin_cliente(df, nombres_sin_cliente)
+    df['id_cliente'] = df['id_cliente'].astype(int)
+    return df, df_sin_cliente
+
+def preparar_cuota_forecast(df):
+    """Columnas de Cuota_forecast por cliente con la cuota numérica. Devuelve (filas con cliente, filas para la cuarentena)."""
+    nombres_sin_cliente = df.loc[df['id_cliente'].isna(), 'nombre_cliente']
+    df = df.rename(columns={"TOTAL": "cuota"})
+    df['cuota'] = pd.to_numeric(df['cuota'], errors='coerce').fillna(0).astype(float)
+    cols_finales = ['id_zone', 'id_cliente', 'cuota', 'nombre_mes', 'mes', 'año']
+    df = df.filter(items=cols_finales)
+    df, df_sin_cliente = apartar_sin_cliente(df, nombres_sin_cliente)
+    df['id_cliente'] = df['id_cliente'].astype(int)
+    return df, df_sin_cliente
+
+def preparar_cuotas_zona(df):
+    """Cuotas generales por zona (id_cliente 0): solo las cuotas mayores a 0, con las columnas de Cuota_forecast."""
+    df = df.assign(id_cliente=0)
+    if 'cuota' not in df.columns and 'TOTAL' in df.columns:
+        df = df.rename(columns={"TOTAL": "cuota"})
+    df['cuota'] = pd.to_numeric(df['cuota'], errors='coerce').fillna(0).astype(float)
+    df = df[df['cuota'] > 0]
+    cols_finales = ['id_zone', 'id_cliente', 'cuota', 'nombre_mes', 'mes', 'año']
+    return df.filter(items=cols_finales)
+
+def preparar_cuotas(df):
+    """Columnas de Cuotas_Avance_Categoria, sin las filas cuyo producto no tiene regla."""
+    df = df.dropna(subset=['id_producto'])
+    df['id_producto'] = df['id_producto'].astype(int)
+    cols_to_keep = ['cuota_dinero', 'cuota_volumen', 'id_producto', 'id_zone', 'nombre_mes', 'mes', 'año']
+    df = df.filter(items=cols_to_keep)
+    df['cuota_dinero'] = pd.to_numeric(df['cuota_dinero'], errors='coerce').fillna(0).astype(float)
+    df['cuota_volumen'] = pd.to_numeric(df['cuota_volumen'], errors='coerce').fillna(0).astype(int)
+    return df
+
+def filas_nuevas(df, existentes, columnas_clave):
+    """
+    Filas cuya clave no está entre las existentes en la tabla. Se compara como MultiIndex, igual que en Ventas
+    Totales: un merge con indicator arma un DataFrame combinado completo solo para filtrar.
+    """
+    if existentes.empty:
+        return df
+    claves_existentes = pd.MultiIndex.from_frame(existentes[columnas_clave])
+    return df[~pd.MultiIndex.from_frame(df[columnas_clave]).isin(claves_existentes)]
+
+# --- Cartera: antigüedad de saldos y preparación del snapshot ---
+RANGOS_ANTIGUEDAD = [-1, 30, 60, 90, np.inf]
+ETIQUETAS_ANTIGUEDAD = ['0-30', '31-60', '61-90', '90+']
+
+def zona_entera(zona):
+    """El id_zone de Clientes llega como float tras el merge (3.0): se pasa a entero para que se guarde como '3',
+    igual que el CAST(id_zone AS NVARCHAR) del reproceso de la cuarentena. Las zonas de texto del archivo no cambian."""
+    return int(zona) if isinstance(zona, float) and zona.is_integer() else zona
+
+def calcular_antiguedad(df, fecha_carga):
+    """Agrega dias_vencido y rango_antiguedad contra la fecha de carga."""
+    # Si el documento no tiene fecha de vencimiento se usa la fecha de facturación
+    fechas_vencimiento = pd.to_datetime(df['fecha_pago'], errors='coerce')
+    fechas_vencimiento = fechas_vencimiento.fillna(pd.to_datetime(df['fecha_facturacion'], errors='coerce'))
+    dias_vencido = (pd.Timestamp(fecha_carga) - fechas_vencimiento).dt.days.clip(lower=0).astype('Int64')
+    rango_antiguedad = pd.cut(dias_vencido.astype(float), bins=RANGOS_ANTIGUEDAD, labels=ETIQUETAS_ANTIGUEDAD).astype(object)
+    return df.assign(dias_vencido=dias_vencido, rango_antiguedad=rango_antiguedad)
+
+def resumir_antiguedad(df, fecha_carga):
+    """Resumen del snapshot por zona, cliente y rango de antigüedad."""
+    df_resumen = df.assign(id_zone=df['id_zone'].map(zona_entera).astype(str), rango_antiguedad=df['rango_antiguedad'].fillna('Sin fecha'))
+    df_resumen = df_resumen.groupby(['id_zone', 'id_cliente', 'rango_antiguedad'], as_index=False).agg(
+        documentos=('open_balance', 'size'),
+        open_balance=('open_balance', 'sum'),
+        dias_vencido_max=('dias_vencido', 'max')
+    )
+    df_resumen.insert(0, 'FechaCarga', fecha_carga)
+    return df_resumen
+
+def preparar_snapshot_cartera(df, fecha_carga):
+    """
+    Columnas finales del snapshot con la antigüedad y las fechas como YYYY-MM-DD. Las filas sin cliente siguen
+    el mismo camino y se apartan al final. Devuelve (filas a insertar, filas para la cuarentena).
+    """
+    sin_cliente = df['id_cliente'].isna()
+    nombres_sin_cliente = df.loc[sin_cliente, 'nombre_cliente']
+    # Se eliminan las columnas que ya no son necesarias para la tabla final
+    df_to_insert = df.drop(columns=['nombre_cliente', 'nombre_cliente_cleaned', 'zona_csv_original'], errors='ignore')
+    df_to_insert = calcular_antiguedad(df_to_insert, fecha_carga)
+    for columna in ('fecha_facturacion', 'fecha_pago'):
+        if columna in df_to_insert.columns:
+            df_to_insert[columna] = pd.to_datetime(df_to_insert[columna], errors='coerce').dt.strftime('%Y-%m-%d')
+    # La cuarentena lleva las columnas de la tabla salvo id_cliente. Su id_zone es la zona del archivo; al
+    # reprocesarlas se usa la del cliente si la tiene.
+    df_cuarentena = df_to_insert[sin_cliente].drop(columns=['id_cliente']).assign(nombre_cliente=nombres_sin_cliente, FechaCarga=fecha_carga)
+    df_to_insert = df_to_insert[~sin_cliente]
+    # Convertimos a entero DESPUÉS de eliminar los NaN para evitar errores.
+    df_to_insert['id_cliente'] = df_to_insert['id_cliente'].astype(int)
+    return df_to_insert, df_cuarentena
@@ -1,17 +1,14 @@
 # Librerias usadas
-import pandas as pd
-from openpyxl import load_workbook
-import datetime
-import re
-from io import BytesIO
-import requests
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import ProgrammingError, IntegrityError
-import pyodbc
-from tkinter import Tk, filedialog
+# Los módulos pesados (pandas, sqlalchemy) se importan en segundo plano mientras se elige el archivo.
 import sys
 import os
+import uuid
 from dotenv import load_dotenv
+from arranque import (precargar_modulos, conectar_en_segundo_plano, revalidar_clientes_en_segundo_plano,
+                      en_segundo_plano, esperar, esperar_pandas)
+import metricas
+
+precargar_modulos('pandas', 'sqlalchemy', 'openpyxl')
 
 def get_env_path():
     """Obtiene la ruta correcta del archivo .env."""
@@ -38,30 +35,68 @@ SERVER_AND_PORT = f"{SERVER_NAME}:{PORT}"
 # --- Configuración de Tablas en la Base de Datos ---
 TABLE_NAME = 'Ventas_Totales' # Nombre de tu tabla de destino
 CLIENTES_TABLE_NAME = 'Clientes' # Nombre de tu tabla de clientes
+RESUMEN_TABLE_NAME = 'Ventas_Mensuales' # Resumen mensual mantenido en cada carga
+ID_CARGA = uuid.uuid4().hex # Identificador de esta ejecución
+# --- Modo por bloques (streaming) para exportaciones CSV muy grandes ---
+# 'auto': se activa si el CSV supera el umbral; 'si' / 'no' lo fuerzan.
+MODO_STREAMING = os.environ.get("VENTAS_MODO_STREAMING", "auto").lower()
+UMBRAL_STREAMING_MB = float(os.environ.get("VENTAS_STREAMING_UMBRAL_MB", "200"))
+# Tamaño de lectura de cada bloque. Después del mapeo y la deduplicación quedan menos filas, así que los bloques
+# se acumulan hasta MIN_FILAS_ROWGROUP filas nuevas antes de insertar: en una tabla columnstore cada inserción
+# llena un rowgroup comprimido en lugar de ir al delta store (ver insercion.py).
+FILAS_POR_BLOQUE = int(os.environ.get("VENTAS_STREAMING_FILAS", "102400"))
+# Claves enviadas por consulta al buscar registros existentes (limita el tamaño de cada request a SQL Server)
+CLAVES_POR_CONSULTA = int(os.environ.get("VENTAS_DEDUP_CLAVES_POR_CONSULTA", "5000"))
 #--- Conexion con la base de datos
 connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
-engine = create_engine(connection_string)
 
-# --- 1. Crear el motor de SQLAlchemy y probar la conexión ---
-try:
-    engine = create_engine(connection_string)
-    with engine.connect() as connection:
-        connection.execute(text("SELECT 1"))
-    print(f"Conexión a SQL Server '{DATABASE_NAME}' en '{SERVER_NAME}' establecida.")
-except Exception as e:
-    print(f"Error de conexión a la base de datos: {e}")
-    sys.exit() # Usar sys.exit()
+# --- 1. Crear el motor de SQLAlchemy y probar la conexión (en segundo plano) ---
+# Mientras el usuario elige el archivo se abre la conexión y se revalida el cache de Clientes.
+engine_future = conectar_en_segundo_plano(connection_string)
+clientes_future = revalidar_clientes_en_segundo_plano(engine_future)
+
+def cargar_archivo(input_file_path):
+    """Lee el archivo CSV o Excel de ventas (o un .zip/.gz que los contenga) según el contrato de esquema del reporte."""
+    from contratos import leer_con_contrato
+    # Verificar que el archivo existe
+    if not os.path.exists(input_file_path):
+        raise FileNotFoundError(f"El archivo no se encontró en '{input_file_path}'")
+    
+    # Solo se leen las columnas del contrato, ya renombradas y con sus tipos (incluida la fecha)
+    df = leer_con_contrato(input_file_path, 'ventas_totales')
+    print(f"Archivo cargado exitosamente: {os.path.basename(input_file_path)}")
+    return df
+
+def usar_modo_streaming(input_file_path):
+    """Decide si el archivo se procesa por bloques (solo CSV, también dentro de .zip o .gz)."""
+    from contratos import fuentes_con_contrato
+    from comprimidos import extension_reporte, tamano_descomprimido
+    if MODO_STREAMING not in ('si', 'sí', '1', 'true', 'auto') or not os.path.exists(input_file_path):
+        return False
+    try:
+        nombres = [nombre for nombre, _ in fuentes_con_contrato(input_file_path, 'ventas_totales')]
+    except Exception:
+        # Un archivo comprimido inválido se informa al cargarlo
+        return False
+    if not all(extension_reporte(nombre) == '.csv' for nombre in nombres):
+        return False
+    if MODO_STREAMING == 'auto':
+        # Se compara el tamaño descomprimido: es el que determina la memoria necesaria
+        return tamano_descomprimido(input_file_path, nombres) > UMBRAL_STREAMING_MB * 1024 * 1024
+    return True
 
 # --- Lógica para seleccionar archivo ---
+from tkinter import Tk, filedialog
 root = Tk()
 root.withdraw()
 print("Por favor, selecciona el archivo")
 file_path = filedialog.askopenfilename(
     title="Selecciona el archivo",
     filetypes=[
-        ("Todos los soportados", "*.csv;*.xlsx;*.xls"),
+        ("Todos los soportados", "*.csv;*.xlsx;*.xls;*.zip;*.gz"),
         ("Archivos CSV", "*.csv"),
         ("Archivos Excel", "*.xlsx;*.xls"),
+        ("Archivos comprimidos", "*.zip;*.gz"),
         ("Todos los archivos", "*.*")
     ]
 )
@@ -70,25 +105,26 @@ if not file_path:
     sys.exit() # Usar sys.exit()
 
 input_file_path = file_path
+metricas.iniciar('ventas_totales', ID_CARGA)
 
-try:
-    # Verificar que el archivo existe
-    if not os.path.exists(input_file_path):
-        raise FileNotFoundError(f"El archivo no se encontró en '{input_file_path}'")
-    
-    # Obtener la extensión del archivo
-    file_extension = os.path.splitext(input_file_path)[1].lower()
-    
-    # Cargar el archivo según su extensión
-    if file_extension == '.csv':
-        df = pd.read_csv(input_file_path)
-        print(f"Archivo CSV cargado exitosamente: {os.path.basename(input_file_path)}")
-    elif file_extension in ['.xlsx', '.xls']:
-        df = pd.read_excel(input_file_path)
-        print(f"Archivo Excel cargado exitosamente: {os.path.basename(input_file_path)}")
-    else:
-        raise ValueError(f"Formato de archivo no soportado: {file_extension}. Solo se permiten archivos .csv, .xlsx y .xls")
+# La lectura del archivo corre en paralelo con la conexión y el cache de Clientes.
+# En modo por bloques el archivo no se carga completo: se lee bloque a bloque más abajo.
+modo_streaming = usar_modo_streaming(input_file_path)
+archivo_future = None if modo_streaming else en_segundo_plano(cargar_archivo, input_file_path)
 
+esperar_pandas()
+import pandas as pd
+from sqlalchemy import text
+from clientes_cache import obtener_clientes
+from parquet_sink import escribir_parquet
+from insercion import insertar_por_lotes, MIN_FILAS_ROWGROUP
+from transformaciones import CLAVES_VENTAS, normalizar_claves, filtrar_claves_existentes
+from contratos import leer_con_contrato
+from cuarentena import guardar_en_cuarentena
+from conciliacion import ErrorConciliacion, ganchos_conciliacion
+
+try:
+    df = archivo_future.result() if archivo_future else None
 except FileNotFoundError:
     print(f"Error: El archivo de entrada no se encontró en '{input_file_path}'")
     sys.exit()
@@ -104,161 +140,335 @@ except Exception as e:
     print(f"Tipo de error: {type(e).__name__}")
     sys.exit()
 
-column_renames = {
-        'Company Name': 'nombre_cliente',
-        'Date' : 'fecha',
-        'Document Number' : 'document_number',
-        'Type':'tipo',
-        'Item':'item',
-        'Description' : 'descripcion',
-        'Class':'clase',
-        'Quantity':'cantidad_producto',
-        'UOM':'presentacion',
-        'Amount':'amount',
-        'Created From':'created_from',
-    }
-
-df = df.drop(columns=['Status'], errors='ignore')
-df = df.rename(columns=column_renames)
-
-if 'amount' in df.columns:
-    print(df[['amount']].head())
-    print(f"Tipo de datos de 'amount': {df['amount'].dtype}")
-    non_numeric_values = pd.to_numeric(df['amount'], errors='coerce').isna().sum()
-    print(f"Cantidad de valores no numéricos (que se harán NaN) antes de la conversión: {non_numeric_values}")
-else:
-    print("La columna 'amount' NO se encontró después de renombrar.")
-    print(f"Columnas disponibles: {df.columns.tolist()}")
+engine = esperar(engine_future, "Error de conexión a la base de datos")
+print(f"Conexión a SQL Server '{DATABASE_NAME}' en '{SERVER_NAME}' establecida.")
 
-df['fecha'] = pd.to_datetime(df['fecha'], format='%m/%d/%Y')
-    
 # --- 6. Mapeo de nombres de cliente directamente desde la tabla Clientes ---
-print("\nEstandarizando y mapeando nombre_cliente a id_cliente desde la tabla Clientes...")
-    
 # **Nota:** Se elimina la sección de `nombre_estandar_map` para que el mapeo sea dinámico con la base de datos.
-
-# Cargar los clientes de la base de datos
-with engine.connect() as connection_read_clientes:
-    clientes_db_query = text(f"SELECT id_cliente, nombre_cliente FROM {CLIENTES_TABLE_NAME};")
-    clientes_db = pd.read_sql_query(clientes_db_query, connection_read_clientes)
+def mapear_clientes(df, cache_clientes=None):
+    """
+    Mapea nombre_cliente a id_cliente. Devuelve (filas mapeadas, filas para la cuarentena): las de clientes que no
+    existen en Clientes se guardan en la cuarentena en la misma transacción que la inserción (ver cargar_registros_nuevos).
+    """
+    print("\nEstandarizando y mapeando nombre_cliente a id_cliente desde la tabla Clientes...")
+    # Cargar los clientes desde el cache local (solo se consulta la base de datos si la tabla Clientes cambió)
+    clientes_db = obtener_clientes(engine, df['nombre_cliente'].unique(), cache=cache_clientes)
     # Convertir a minúsculas y quitar espacios en ambos lados para una comparación robusta
     clientes_db['nombre_cliente_lower'] = clientes_db['nombre_cliente'].str.lower().str.strip()
     cliente_id_map_db = dict(zip(clientes_db['nombre_cliente_lower'], clientes_db['id_cliente']))
 
-# Estandarizar los nombres del CSV (solo a minúsculas y sin espacios) y luego mapear a id_cliente
-df['nombre_cliente_lower'] = df['nombre_cliente'].astype(str).str.lower().str.strip()
-# Ahora mapeamos directamente los nombres del CSV a los IDs de la base de datos
-# No se aplica el mapeo manual, solo el mapeo contra la DB
-df['id_cliente'] = df['nombre_cliente_lower'].map(cliente_id_map_db)
-
-unmapped_clientes = df[df['id_cliente'].isna()]['nombre_cliente'].unique()
-if len(unmapped_clientes) > 0:
-    print(f"Advertencia: Los siguientes clientes del CSV no se encontraron en la tabla Clientes y se omitirán: {', '.join(unmapped_clientes)}")
-    # Aquí se filtran las filas que no tienen un id_cliente
-    df = df.dropna(subset=['id_cliente']).copy()
-else:
-    print("Todos los clientes del CSV fueron encontrados en la tabla Clientes.")
+    # Estandarizar los nombres del CSV (solo a minúsculas y sin espacios) y luego mapear a id_cliente
+    df['nombre_cliente_lower'] = df['nombre_cliente'].astype(str).str.lower().str.strip()
+    # Ahora mapeamos directamente los nombres del CSV a los IDs de la base de datos
+    # No se aplica el mapeo manual, solo el mapeo contra la DB
+    df['id_cliente'] = df['nombre_cliente_lower'].map(cliente_id_map_db)
+
+    unmapped_clientes = df[df['id_cliente'].isna()]['nombre_cliente'].unique()
+    df_sin_cliente = df.iloc[0:0]
+    if len(unmapped_clientes) > 0:
+        print(f"Advertencia: Los siguientes clientes del CSV no se encontraron en la tabla Clientes y sus filas se guardan en la cuarentena: {', '.join(map(str, unmapped_clientes))}")
+        metricas.clientes_no_mapeados(unmapped_clientes)
+        # Las filas van con las columnas que tendrían en la tabla; se cargan después con 'python cuarentena.py'
+        df_sin_cliente = df[df['id_cliente'].isna()].drop(columns=['nombre_cliente_lower', 'id_cliente'])
+        df_sin_cliente['item'] = df_sin_cliente['item'].astype(str)
+        # Aquí se filtran las filas que no tienen un id_cliente
+        df = df.dropna(subset=['id_cliente'])
+    else:
+        print("Todos los clientes del CSV fueron encontrados en la tabla Clientes.")
 
-df['id_cliente'] = df['id_cliente'].astype(int)
-print("id_cliente mapeado y clientes no encontrados manejados.")
+    df['id_cliente'] = df['id_cliente'].astype(int)
+    print("id_cliente mapeado y clientes no encontrados manejados.")
+    metricas.contar(TABLE_NAME, 'mapeadas', len(df))
+    return df, df_sin_cliente
 
-df_para_sql = df
 # --- 9. Deduplicación antes de la inserción ---
-print(f"\nVerificando registros duplicados en la tabla '{TABLE_NAME}'...")
-
-unique_cols_for_deduplication = ['id_cliente', 'fecha', 'document_number', 'item']
-
-if not all(col in df_para_sql.columns for col in unique_cols_for_deduplication):
-    print(f"¡ERROR! Las columnas para detección de duplicados no están todas presentes en df_para_sql: {unique_cols_for_deduplication}")
-    print(f"Columnas disponibles: {df_para_sql.columns.tolist()}")
-    raise Exception(f"Faltan columnas para la detección de duplicados en {TABLE_NAME}.")
-
-existing_records_query_cols = ", ".join(unique_cols_for_deduplication)
-existing_records_df = pd.DataFrame()
-try:
-    with engine.connect() as connection_read_records:
-        existing_records_df = pd.read_sql_query(f"SELECT {existing_records_query_cols} FROM {TABLE_NAME}", connection_read_records)
-    print(f"Se cargaron {len(existing_records_df)} filas existentes de '{TABLE_NAME}' para verificar duplicados.")
-except Exception as e:
-    print(f"Advertencia: No se pudieron cargar los registros existentes para la deduplicación. Procediendo sin filtrar duplicados existentes. Error: {e}")
-
-# --- LÓGICA DE DEDUPLICACIÓN ---
-df_para_sql_processed_for_dedup = df_para_sql.copy()
-existing_records_df_processed_for_dedup = existing_records_df.copy()
-
-df_para_sql_processed_for_dedup['id_cliente'] = df_para_sql_processed_for_dedup['id_cliente'].astype(int)
-if not existing_records_df_processed_for_dedup.empty:
-    existing_records_df_processed_for_dedup['id_cliente'] = existing_records_df_processed_for_dedup['id_cliente'].astype(int)
-
-df_para_sql_processed_for_dedup['document_number'] = df_para_sql_processed_for_dedup['document_number'].astype(str).str.strip()
-if not existing_records_df_processed_for_dedup.empty:
-    existing_records_df_processed_for_dedup['document_number'] = existing_records_df_processed_for_dedup['document_number'].astype(str).str.strip()
+unique_cols_for_deduplication = CLAVES_VENTAS
+
+def leer_registros_existentes(df_para_sql):
+    """
+    Lee de la tabla solo las claves que coinciden con las del archivo o bloque (semi-join con OPENJSON), así
+    la memoria y la lectura no dependen del tamaño de la tabla. Las claves se envían tal como las escribe la
+    carga (document_number e item como texto, fecha sin hora), en tandas de CLAVES_POR_CONSULTA. La fecha se
+    compara como rango del día (igual que la normalización de normalizar_claves, por si alguna fecha trae hora)
+    y ninguna columna de la tabla pasa por funciones: IX_Ventas_Totales_dedup (ver esquema.py) sigue
+    resolviendo las cuatro columnas con un seek.
+    """
+    existing_records_df = pd.DataFrame()
+    if df_para_sql.empty:
+        return existing_records_df
+    try:
+        with engine.connect() as connection_read_records:
+            claves = pd.DataFrame({
+                'id_cliente': df_para_sql['id_cliente'].astype(int),
+                'fecha': pd.to_datetime(df_para_sql['fecha']).dt.strftime('%Y-%m-%d'),
+                'document_number': df_para_sql['document_number'].astype(str),
+                'item': df_para_sql['item'].astype(str),
+            }).drop_duplicates()
+            claves_query = text(f"""
+                SELECT v.id_cliente, v.fecha, v.document_number, v.item
+                FROM {TABLE_NAME} v
+                JOIN OPENJSON(:claves) WITH (
+                    id_cliente INT, fecha DATE, document_number NVARCHAR(200), item NVARCHAR(200)
+                ) k
+                  ON v.id_cliente = k.id_cliente
+                 AND v.fecha >= k.fecha AND v.fecha < DATEADD(day, 1, k.fecha)
+                 AND v.document_number = k.document_number AND v.item = k.item;
+            """)
+            tandas = [
+                pd.read_sql_query(claves_query, connection_read_records,
+                                  params={'claves': claves.iloc[desde: desde + CLAVES_POR_CONSULTA].to_json(orient='records')})
+                for desde in range(0, len(claves), CLAVES_POR_CONSULTA)
+            ]
+            existing_records_df = pd.concat(tandas, ignore_index=True)
+        print(f"Se cargaron {len(existing_records_df)} filas existentes de '{TABLE_NAME}' para verificar duplicados.")
+    except Exception as e:
+        print(f"Advertencia: No se pudieron cargar los registros existentes para la deduplicación. Procediendo sin filtrar duplicados existentes. Error: {e}")
+    return existing_records_df
+
+def filtrar_registros_nuevos(df_para_sql, existing_records_df):
+    """Devuelve solo las filas cuya clave (id_cliente, fecha, document_number, item) no existe en la tabla."""
+    print(f"\nVerificando registros duplicados en la tabla '{TABLE_NAME}'...")
+    if not all(col in df_para_sql.columns for col in unique_cols_for_deduplication):
+        print(f"¡ERROR! Las columnas para detección de duplicados no están todas presentes en df_para_sql: {unique_cols_for_deduplication}")
+        print(f"Columnas disponibles: {df_para_sql.columns.tolist()}")
+        raise Exception(f"Faltan columnas para la detección de duplicados en {TABLE_NAME}.")
+
+    # --- LÓGICA DE DEDUPLICACIÓN (ver transformaciones.py) ---
+    df_to_insert = filtrar_claves_existentes(df_para_sql, existing_records_df)
+
+    print(f"Total de filas en el nuevo DataFrame (antes de filtrar): {len(df_para_sql)}")
+    print(f"Filas a insertar (nuevas y no duplicadas): {len(df_to_insert)}")
+    metricas.contar(TABLE_NAME, 'deduplicadas', len(df_to_insert))
+    return df_to_insert
+
+# --- Resumen mensual incremental (id_cliente, clase, item, año, mes) ---
+LARGO_CLAVE_RESUMEN = 150 # clase e item son NVARCHAR(150) en el resumen
+
+def asegurar_resumen_mensual(connection):
+    """Crea la tabla de resumen si no existe y la inicializa con el histórico de la tabla de ventas."""
+    connection.execute(text(f"""
+        IF OBJECT_ID(N'{RESUMEN_TABLE_NAME}', N'U') IS NULL
+        BEGIN
+            CREATE TABLE {RESUMEN_TABLE_NAME} (
+                id_cliente INT NOT NULL,
+                clase NVARCHAR(150) NOT NULL,
+                item NVARCHAR(150) NOT NULL,
+                año INT NOT NULL,
+                mes INT NOT NULL,
+                amount DECIMAL(19, 4) NOT NULL,
+                cantidad_producto DECIMAL(19, 4) NOT NULL,
+                filas INT NOT NULL,
+                CONSTRAINT PK_{RESUMEN_TABLE_NAME} PRIMARY KEY (id_cliente, clase, item, año, mes)
+            );
+            INSERT INTO {RESUMEN_TABLE_NAME} (id_cliente, clase, item, año, mes, amount, cantidad_producto, filas)
+            SELECT id_cliente, ISNULL(CAST(clase AS NVARCHAR(150)), ''), CAST(item AS NVARCHAR(150)),
+                   YEAR(fecha), MONTH(fecha),
+                   ISNULL(SUM(TRY_CAST(amount AS DECIMAL(19, 4))), 0),
+                   ISNULL(SUM(TRY_CAST(cantidad_producto AS DECIMAL(19, 4))), 0),
+                   COUNT(*)
+            FROM {TABLE_NAME}
+            GROUP BY id_cliente, ISNULL(CAST(clase AS NVARCHAR(150)), ''), CAST(item AS NVARCHAR(150)), YEAR(fecha), MONTH(fecha);
+        END
+    """))
+
+def clave_resumen(serie):
+    """clase / item como los compara la clave primaria del resumen: cortados a 150 y sin espacios al final."""
+    return serie.astype(str).str[:LARGO_CLAVE_RESUMEN].str.rstrip()
+
+def calcular_deltas_mensuales(df):
+    """
+    Agrupa las filas nuevas por cliente, clase, item, año y mes. La clave primaria del resumen no distingue
+    mayúsculas ni espacios finales, así que se agrupa sin distinguirlos ('ABC' y 'abc ' son la misma fila);
+    de cada grupo se guarda el primer valor tal como vino.
+    """
+    fechas = pd.to_datetime(df['fecha'])
+    df_deltas = pd.DataFrame({
+        'id_cliente': df['id_cliente'].astype(int),
+        'clase': clave_resumen(df['clase'].fillna('')) if 'clase' in df.columns else '',
+        'item': clave_resumen(df['item']),
+        'año': fechas.dt.year,
+        'mes': fechas.dt.month,
+        'amount': pd.to_numeric(df['amount'], errors='coerce').fillna(0),
+        'cantidad_producto': pd.to_numeric(df['cantidad_producto'], errors='coerce').fillna(0) if 'cantidad_producto' in df.columns else 0,
+    }, index=df.index)
+    grupos = [df_deltas['id_cliente'], df_deltas['clase'].str.casefold(), df_deltas['item'].str.casefold(),
+              df_deltas['año'], df_deltas['mes']]
+    return df_deltas.groupby(grupos).agg(
+        id_cliente=('id_cliente', 'first'),
+        clase=('clase', 'first'),
+        item=('item', 'first'),
+        año=('año', 'first'),
+        mes=('mes', 'first'),
+        amount=('amount', 'sum'),
+        cantidad_producto=('cantidad_producto', 'sum'),
+        filas=('amount', 'size')
+    ).reset_index(drop=True)
+
+def aplicar_deltas_mensuales(connection, deltas):
+    """
+    Suma los deltas al resumen mensual con un MERGE desde una tabla temporal. Los deltas se vuelven a agrupar
+    en SQL con la intercalación de la base (la misma de la clave primaria): el MERGE no puede recibir dos filas
+    de origen para una misma fila del resumen.
+    """
+    connection.execute(text("""
+        CREATE TABLE #deltas_mensuales (
+            id_cliente INT, clase NVARCHAR(150) COLLATE DATABASE_DEFAULT, item NVARCHAR(150) COLLATE DATABASE_DEFAULT,
+            año INT, mes INT, amount DECIMAL(19, 4), cantidad_producto DECIMAL(19, 4), filas INT
+        );
+    """))
+    connection.execute(
+        text("INSERT INTO #deltas_mensuales VALUES (:id_cliente, :clase, :item, :anio, :mes, :amount, :cantidad_producto, :filas);"),
+        deltas.rename(columns={'año': 'anio'}).to_dict('records')
+    )
+    connection.execute(text(f"""
+        MERGE {RESUMEN_TABLE_NAME} AS destino
+        USING (
+            SELECT id_cliente, clase, item, año, mes,
+                   SUM(amount) AS amount, SUM(cantidad_producto) AS cantidad_producto, SUM(filas) AS filas
+            FROM #deltas_mensuales
+            GROUP BY id_cliente, clase, item, año, mes
+        ) AS delta
+            ON destino.id_cliente = delta.id_cliente AND destino.clase = delta.clase AND destino.item = delta.item
+           AND destino.año = delta.año AND destino.mes = delta.mes
+        WHEN MATCHED THEN UPDATE SET
+            amount = destino.amount + delta.amount,
+            cantidad_producto = destino.cantidad_producto + delta.cantidad_producto,
+            filas = destino.filas + delta.filas
+        WHEN NOT MATCHED THEN
+            INSERT (id_cliente, clase, item, año, mes, amount, cantidad_producto, filas)
+            VALUES (delta.id_cliente, delta.clase, delta.item, delta.año, delta.mes, delta.amount, delta.cantidad_producto, delta.filas);
+    """))
+    connection.execute(text("DROP TABLE #deltas_mensuales;"))
+
+def cargar_registros_nuevos(df_to_insert, df_cuarentena, parte_parquet=None):
+    """
+    Inserta las filas nuevas, actualiza el resumen mensual, guarda las filas sin cliente en la cuarentena
+    (todo en una transacción) y escribe la copia en Parquet.
+    """
+    def guardar_cuarentena(connection):
+        guardar_en_cuarentena(connection, df_cuarentena, TABLE_NAME, input_file_path, ID_CARGA)
+
+    if len(df_to_insert) == 0:
+        print(f"No hay nuevos registros para insertar en la tabla '{TABLE_NAME}'.")
+        if not df_cuarentena.empty:
+            with engine.begin() as connection:
+                guardar_cuarentena(connection)
+        return 0
 
-df_para_sql_processed_for_dedup['fecha'] = pd.to_datetime(df_para_sql_processed_for_dedup['fecha']).dt.normalize()
-if not existing_records_df_processed_for_dedup.empty:
-    existing_records_df_processed_for_dedup['fecha'] = pd.to_datetime(existing_records_df_processed_for_dedup['fecha']).dt.normalize()
-
-df_para_sql_processed_for_dedup['item'] = df_para_sql_processed_for_dedup['item'].astype(str).str.strip()
-if not existing_records_df_processed_for_dedup.empty:
-    existing_records_df_processed_for_dedup['item'] = existing_records_df_processed_for_dedup['item'].astype(str).str.strip()
-
-existing_records_set = set(existing_records_df_processed_for_dedup[unique_cols_for_deduplication].apply(tuple, axis=1))
-new_records_fingerprint = df_para_sql_processed_for_dedup[unique_cols_for_deduplication].apply(tuple, axis=1)
-
-is_new_record = ~new_records_fingerprint.isin(existing_records_set)
-df_to_insert = df_para_sql[is_new_record]
-# --- FIN DE LA LÓGICA DE DEDUPLICACIÓN ---
-
-columns_to_drop = ['nombre_cliente', 'nombre_cliente_lower']
-df_to_insert = df_to_insert.drop(columns=columns_to_drop, errors='ignore')
-
-print(f"Total de filas en el nuevo DataFrame (antes de filtrar): {len(df_para_sql)}")
-print(f"Filas a insertar (nuevas y no duplicadas): {len(df_to_insert)}")
-if len(df_to_insert) == 0:
-    print(f"No hay nuevos registros para insertar en la tabla '{TABLE_NAME}'. Proceso completado.")
-else:
     # --- 10. Insertar el DataFrame en SQL Server por lotes ---
     df_to_insert['item'] = df_to_insert['item'].astype(str)
     print(f"\nIniciando inserción por lotes de solo los datos nuevos en la tabla '{TABLE_NAME}'...")
-    BATCH_SIZE = 1000 # Define el tamaño del lote
-    rows_inserted_count = 0
-
-    with engine.connect() as connection_insert_records:
-        with connection_insert_records.begin(): # Usar una transacción para todo el lote
-            for i in range(0, len(df_to_insert), BATCH_SIZE):
-                batch_df = df_to_insert.iloc[i : i + BATCH_SIZE].copy()
-
-                try:
-                    batch_df.to_sql(TABLE_NAME, con=connection_insert_records, if_exists='append', index=False, chunksize=None)
-                    rows_inserted_count += len(batch_df)
-                    print(f"Lote insertado exitosamente: filas {i} a {min(i + BATCH_SIZE, len(df_to_insert))} (Total insertado: {rows_inserted_count})")
-
-                except ProgrammingError as pe:
-                    print(f"\n¡ERROR DE BASE DE DATOS en el lote de filas {i} a {min(i + BATCH_SIZE, len(df_to_insert))}!")
-                    print(f"Tipo de error: {type(pe).__name__}")
-                    print(f"Mensaje de error: {pe}")
-                    if hasattr(pe.orig, 'args') and len(pe.orig.args) > 1:
-                        print(f"    > Mensaje de SQL Server: {pe.orig.args[1]}")
-                    print(f"Probable fila inicial del problema en el CSV original (aproximado): {i + 1 + 6}") # +6 por skiprows
-                    print("Inspecciona los datos en tu archivo CSV cerca de esa fila o revisa tus restricciones de DB.")
-                    connection_insert_records.rollback()
-                    raise
-                except IntegrityError as ie:
-                    print(f"\n¡ERROR DE INTEGRIDAD (DUPLICADO/FK) en el lote de filas {i} a {min(i + BATCH_SIZE, len(df_to_insert))}!")
-                    print(f"Tipo de error: {type(ie).__name__}")
-                    print(f"Mensaje de error: {ie}")
-                    if hasattr(ie.orig, 'args') and len(ie.orig.args) > 1:
-                        print(f"    > Mensaje de SQL Server: {ie.orig.args[1]}")
-                    print(f"Probable fila inicial del problema en el CSV original (aproximado): {i + 1 + 6}")
-                    print("Esto podría indicar que un duplicado aún se está intentando insertar a pesar de la deduplicación previa, o un problema de FK.")
-                    connection_insert_records.rollback()
-                    raise
-                except Exception as e:
-                    print(f"\n¡ERROR INESPERADO en el lote de filas {i} a {min(i + BATCH_SIZE, len(df_to_insert))}!")
-                    print(f"Tipo de error: {type(e).__name__}")
-                    print(f"Mensaje de error: {e}")
-                    print(f"Probable fila inicial del problema en el CSV original (aproximado): {i + 1 + 6}")
-                    connection_insert_records.rollback()
-                    raise
-
-    print(f"\nProceso de carga de '{TABLE_NAME}' finalizado. Total de filas insertadas: {rows_inserted_count}.")
\ No newline at end of file
+
+    def actualizar_resumen_mensual(connection):
+        # --- 10b. Actualizar el resumen mensual en la misma transacción que la inserción ---
+        deltas_mensuales = calcular_deltas_mensuales(df_to_insert)
+        aplicar_deltas_mensuales(connection, deltas_mensuales)
+        print(f"Resumen mensual '{RESUMEN_TABLE_NAME}' actualizado con {len(deltas_mensuales)} combinaciones cliente/clase/item/mes.")
+
+    # --- 10c. Conciliación por cliente (la tabla no tiene zona ni id de carga) ---
+    # Un agregado sobre los clientes y el rango de fechas de la carga antes y otro después de insertar, en la
+    # misma transacción: la diferencia debe coincidir con los totales de las filas nuevas.
+    fechas = pd.to_datetime(df_to_insert['fecha'])
+    antes_conciliacion, verificar_conciliacion = ganchos_conciliacion(
+        TABLE_NAME, df_to_insert, 'amount', 'id_cliente',
+        "JOIN OPENJSON(:clientes) WITH (id_cliente INT '$') c ON c.id_cliente = t.id_cliente "
+        "WHERE CAST(t.fecha AS DATE) BETWEEN :desde AND :hasta",
+        {'clientes': df_to_insert['id_cliente'].astype(int).drop_duplicates().to_json(orient='values'),
+         'desde': fechas.min().date(), 'hasta': fechas.max().date()},
+        incremental=True)
+
+    def antes_de_insertar(connection):
+        asegurar_resumen_mensual(connection)
+        antes_conciliacion(connection)
+
+    def despues_de_insertar(connection):
+        verificar_conciliacion(connection)
+        actualizar_resumen_mensual(connection)
+        guardar_cuarentena(connection)
+
+    # Una sola transacción: el resumen mensual debe existir (con el histórico) antes de insertar las filas nuevas
+    rows_inserted_count = insertar_por_lotes(engine, df_to_insert, TABLE_NAME,
+                                             antes=antes_de_insertar, despues=despues_de_insertar)
+
+    # --- 11. Copia en Parquet particionada por año/mes de la fecha de venta ---
+    escribir_parquet(df_to_insert, TABLE_NAME, ID_CARGA, columna_fecha_mensual='fecha', parte=parte_parquet)
+    return rows_inserted_count
+
+def descartar_pendientes(df_to_insert, pendientes):
+    """Quita del bloque las filas cuya clave ya está en los bloques acumulados (todavía no están en la tabla)."""
+    pendientes = [df for df in pendientes if not df.empty]
+    if not pendientes or df_to_insert.empty:
+        return df_to_insert
+    claves_pendientes = pd.MultiIndex.from_frame(pd.concat([normalizar_claves(df) for df in pendientes], ignore_index=True))
+    repetidas = pd.MultiIndex.from_frame(normalizar_claves(df_to_insert)).isin(claves_pendientes)
+    return df_to_insert[~repetidas]
+
+def procesar_en_bloques(input_file_path):
+    """
+    Modo por bloques: lee el CSV en bloques de FILAS_POR_BLOQUE filas y aplica a cada uno el mapeo y la
+    deduplicación contra las claves existentes. Las filas nuevas se acumulan hasta MIN_FILAS_ROWGROUP y se
+    insertan juntas, cada grupo en su propia transacción. La memoria queda acotada por el tamaño del bloque
+    y del grupo, no del archivo.
+    """
+    print(f"\nProcesando '{os.path.basename(input_file_path)}' por bloques de {FILAS_POR_BLOQUE} filas...")
+    cache_clientes = esperar(clientes_future, "Error al revalidar el cache de Clientes")
+    total_leidas = 0
+    total_insertadas = 0
+    pendientes, cuarentena_pendiente = [], []
+    numero_grupo = 0
+
+    def cargar_pendientes():
+        nonlocal numero_grupo
+        numero_grupo += 1
+        # Los bloques vacíos se omiten: sus columnas (las de un DataFrame sin filas) no deben sumarse a las demás
+        df_to_insert = pd.concat([df for df in pendientes if not df.empty] or pendientes[:1], ignore_index=True)
+        df_cuarentena = pd.concat([df for df in cuarentena_pendiente if not df.empty] or cuarentena_pendiente[:1], ignore_index=True)
+        pendientes.clear()
+        cuarentena_pendiente.clear()
+        return cargar_registros_nuevos(df_to_insert, df_cuarentena, parte_parquet=f"{numero_grupo:05d}")
+
+    for numero_bloque, df_bloque in enumerate(leer_con_contrato(input_file_path, 'ventas_totales', chunksize=FILAS_POR_BLOQUE), start=1):
+        total_leidas += len(df_bloque)
+        metricas.contar(TABLE_NAME, 'leidas', len(df_bloque))
+        print(f"\n--- Bloque {numero_bloque}: {len(df_bloque)} filas (total leído: {total_leidas}) ---")
+        df_bloque, df_cuarentena = mapear_clientes(df_bloque, cache_clientes)
+        df_to_insert = filtrar_registros_nuevos(df_bloque, leer_registros_existentes(df_bloque)) if not df_bloque.empty else df_bloque
+        pendientes.append(descartar_pendientes(df_to_insert, pendientes))
+        cuarentena_pendiente.append(df_cuarentena)
+        if sum(len(df) for df in pendientes) >= MIN_FILAS_ROWGROUP:
+            total_insertadas += cargar_pendientes()
+    if pendientes:
+        total_insertadas += cargar_pendientes()
+    print(f"\nProceso de carga de '{TABLE_NAME}' finalizado. Filas leídas: {total_leidas}. Total de filas insertadas: {total_insertadas}.")
+
+if modo_streaming:
+    try:
+        procesar_en_bloques(input_file_path)
+    except pd.errors.ParserError as e:
+        print(f"¡ATENCIÓN! Error de parsing al cargar el archivo: {e}")
+        print(f"Por favor, revisa el archivo de entrada '{input_file_path}'.")
+        sys.exit()
+    except ErrorConciliacion as e:
+        # Solo se revirtió el grupo de bloques que no concilió; los anteriores ya quedaron confirmados
+        metricas.registrar_error(TABLE_NAME, e)
+        sys.exit(1)
+else:
+    # Las columnas ya vienen renombradas y tipadas por el contrato (ver contratos.py)
+    print(df[['amount']].head())
+    print(f"Tipo de datos de 'amount': {df['amount'].dtype}")
+    print(f"Cantidad de valores no numéricos (quedaron como NaN) en 'amount': {df['amount'].isna().sum()}")
+    metricas.contar(TABLE_NAME, 'leidas', len(df))
+
+    df_para_sql, df_cuarentena = mapear_clientes(df, esperar(clientes_future, "Error al revalidar el cache de Clientes"))
+    df_to_insert = filtrar_registros_nuevos(df_para_sql, leer_registros_existentes(df_para_sql))
+    try:
+        rows_inserted_count = cargar_registros_nuevos(df_to_insert, df_cuarentena)
+    except ErrorConciliacion as e:
+        metricas.registrar_error(TABLE_NAME, e)
+        sys.exit(1)
+    if rows_inserted_count:
+        print(f"\nProceso de carga de '{TABLE_NAME}' finalizado. Total de filas insertadas: {rows_inserted_count}.")
+    else:
+        print("Proceso completado.")
+
+metricas.finalizar()
\ No newline at end of file
@@ -1,15 +1,19 @@
 # Librerias usadas
-import pandas as pd
-from openpyxl import load_workbook
+# Los módulos pesados (pandas, openpyxl, sqlalchemy) se importan en segundo plano mientras se elige el archivo.
 import datetime
 import re
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import ProgrammingError, IntegrityError
-import pyodbc
-from tkinter import Tk, filedialog
+import json
+import hashlib
 import sys
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from arranque import (precargar_modulos, conectar_en_segundo_plano, revalidar_clientes_en_segundo_plano,
+                      en_segundo_plano, esperar, esperar_pandas)
+import metricas
+
+precargar_modulos('pandas', 'openpyxl', 'sqlalchemy')
 
 def get_env_path():
     """Obtiene la ruta correcta del archivo .env."""
@@ -31,35 +35,18 @@ DATABASE_NAME = os.environ.get("DATABASE_NAME")
 USERNAME = os.environ.get("DB_USERNAME")
 PASSWORD = os.environ.get("DB_PASSWORD")
 SERVER_AND_PORT = f"{SERVER_NAME}:{PORT}"
-
-# --- Mapeos Estáticos ---
-PRODUCTO_MAPPING = {
-    'Ricky Joy Yogurt': 1,
-    'Mellow Cones': 2,
-    'Crazy Legs': 3,
-    'Ricky Joy Gels': 4,
-    'Jelly Fruits': 5,
-    'Plis': 6,
-    'SSC Roll On': 7,
-    'Freeze Dried': 8,
-    '3D Gummies': 9,
-    'SC Gel': 10,
-    'Cotton Candy': 11
-}
-
-ZONE_MAPPING = {
-    'Zone 1': 1,
-    'Zone 2': 2,
-    'Zone 3': 3,
-    'Zone 4': 4,
-    'Zone 5': 5,
-    'Zone 6': 6,
-    'Zone 7': 7,
-    'KamCentral': 8,
-    'KamEast': 9,
-    'E-Commerce': 10,
-    'Outlet & Donation': 11
-}
+ID_CARGA = uuid.uuid4().hex # Identificador de esta ejecución
+# Las tablas del WOR se cargan en paralelo; este es el máximo de cargas (y conexiones) simultáneas
+MAX_CONEXIONES_WOR = int(os.environ.get("WOR_MAX_CONEXIONES", "3"))
+# Huellas del contenido de cada tabla del libro: las tablas que no cambiaron desde la última carga se omiten.
+# WOR_FORZAR_CARGA=1 procesa todas las tablas aunque no hayan cambiado.
+HUELLAS_DIR = os.environ.get("CACHE_DIR", "cache")
+FORZAR_CARGA = os.environ.get("WOR_FORZAR_CARGA", "0").lower() in ('1', 'si', 'sí', 'true')
+connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
+
+# Mientras el usuario elige el archivo se abre la conexión y se revalida el cache de Clientes.
+engine_future = conectar_en_segundo_plano(connection_string)
+clientes_future = revalidar_clientes_en_segundo_plano(engine_future)
 
 # --- Diccionarios de Meses y Año Actual ---
 meses_en_a_es = {
@@ -77,13 +64,30 @@ meses_es_a_en = {v: k for k, v in meses_en_a_es.items()}
 
 año_actual = datetime.datetime.now().year
 
+def cargar_libro(file_path):
+    """
+    Abre el libro de Excel con los valores calculados de las celdas. Acepta también el libro dentro de un
+    .zip o un .gz, que se descomprime en memoria sin escribir archivos temporales.
+    """
+    from openpyxl import load_workbook
+    from comprimidos import fuentes_reporte, como_archivo_excel
+    fuentes = fuentes_reporte(file_path, ('.xlsx', '.xlsm'), patron=r'wor')
+    if len(fuentes) > 1:
+        raise ValueError(f"El archivo contiene varios libros del WOR: {', '.join(nombre for nombre, _ in fuentes)}. Deja solo uno.")
+    nombre, abrir = fuentes[0]
+    with abrir() as fuente:
+        workbook = load_workbook(como_archivo_excel(fuente), data_only=True)
+    print("Archivo de Excel cargado exitosamente.")
+    return workbook
+
 # --- Selección de Archivo ---
+from tkinter import Tk, filedialog
 root = Tk()
 root.withdraw()
 print("Por favor, selecciona el archivo 'WOR Ventas.xlsx'...")
 file_path = filedialog.askopenfilename(
     title="Selecciona el archivo 'WOR Ventas.xlsx'",
-    filetypes=[("Archivos de Excel", "*.xlsx *.xls")]
+    filetypes=[("Archivos de Excel o comprimidos", "*.xlsx *.xls *.zip *.gz"), ("Archivos de Excel", "*.xlsx *.xls"), ("Archivos comprimidos", "*.zip *.gz")]
 )
 
 if not file_path:
@@ -91,9 +95,22 @@ if not file_path:
     exit()
 
 print(f"Archivo seleccionado: {file_path}")
+metricas.iniciar('wor', ID_CARGA)
+# La lectura del libro corre en paralelo con la conexión y el cache de Clientes
+libro_future = en_segundo_plano(cargar_libro, file_path)
+
+esperar_pandas()
+import pandas as pd
+from clientes_cache import obtener_clientes
+from parquet_sink import escribir_parquet
+from insercion import insertar_por_lotes
+from reglas_remapeo import cargar_reglas, aplicar_reglas
+from cuarentena import guardar_en_cuarentena
+from transformaciones import (limpiar_dataframe, ids_cliente_por_nombre, preparar_forecast, preparar_cuota_forecast,
+                              preparar_cuotas_zona, preparar_cuotas, filas_nuevas)
+
 try:
-    workbook = load_workbook(file_path, data_only=True)
-    print("Archivo de Excel cargado exitosamente.")
+    workbook = libro_future.result()
 except Exception as e:
     print(f"Error al cargar el archivo de Excel: {e}")
     exit()
@@ -114,6 +131,47 @@ tablas_extraidas = {
     'zone_quotas': {}
 }
 
+# --- Detección de cambios por tabla ---
+def ruta_huellas():
+    """Archivo de huellas del servidor y base de datos de destino."""
+    destino = re.sub(r'[^A-Za-z0-9_.-]', '_', f"{SERVER_NAME}_{DATABASE_NAME}")
+    return os.path.join(HUELLAS_DIR, f"wor_huellas_{destino}.json")
+
+def leer_huellas():
+    """Huellas guardadas en la última carga exitosa: {'<año>:<tabla>': sha256}."""
+    try:
+        with open(ruta_huellas(), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Advertencia: No se pudo leer el archivo de huellas '{ruta_huellas()}'. Se procesarán todas las tablas. Error: {e}")
+        return {}
+
+def guardar_huellas(huellas):
+    """Agrega las huellas de las tablas cargadas. Se reescribe en un temporal para no dejar el archivo a medias."""
+    if not huellas:
+        return
+    try:
+        os.makedirs(HUELLAS_DIR, exist_ok=True)
+        todas = leer_huellas()
+        todas.update(huellas)
+        ruta_tmp = ruta_huellas() + '.tmp'
+        with open(ruta_tmp, 'w', encoding='utf-8') as f:
+            json.dump(todas, f, indent=2, sort_keys=True)
+        os.replace(ruta_tmp, ruta_huellas())
+    except OSError as e:
+        print(f"Advertencia: No se pudieron guardar las huellas de las tablas del WOR. Error: {e}")
+
+def huella_tabla(rows):
+    """Huella (sha256) del contenido de las celdas de una tabla, incluido el encabezado."""
+    return hashlib.sha256(json.dumps(rows, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+huellas_anteriores = {} if FORZAR_CARGA else leer_huellas()
+# Huellas de las tablas que cambiaron, por tipo; se guardan solo si la carga de ese tipo termina bien
+huellas_nuevas = {'category': {}, 'forecast': {}, 'zone_quotas': {}}
+tablas_sin_cambios = []
+
 # --- Bucle de Extracción Mejorado y CORREGIDO ---
 print("\nBuscando y extrayendo tablas de todos los meses...")
 for sheet_name in workbook.sheetnames:
@@ -141,6 +199,21 @@ for sheet_name in workbook.sheetnames:
                 
                 data = sheet[table_ref]
                 rows = [[cell.value for cell in row] for row in data]
+
+                # Clasificar la tabla y omitirla si su contenido no cambió desde la última carga
+                if 'Avancedeventa_Category' in table_name:
+                    tipo_tabla = 'category'
+                elif 'Forecast' in table_name:
+                    tipo_tabla = 'forecast'
+                else:
+                    tipo_tabla = None
+                clave_huella = f"{año_encontrado}:{table_name}"
+                huella = huella_tabla(rows)
+                if tipo_tabla and huellas_anteriores.get(clave_huella) == huella:
+                    tablas_sin_cambios.append(table_name)
+                    print(f" -> Sin cambios desde la última carga: {table_name}")
+                    break
+
                 df = pd.DataFrame(rows[1:], columns=rows[0])
 
                 # Añadir el nombre del mes en INGLÉS
@@ -148,23 +221,25 @@ for sheet_name in workbook.sheetnames:
                 df['mes'] = numero_mes_encontrado
                 df['año'] = año_encontrado
                 
-                # Clasificar el DataFrame
-                if 'Avancedeventa_Category' in table_name:
-                    tablas_extraidas['category'][table_name] = df
-                elif 'Forecast' in table_name:
-                    tablas_extraidas['forecast'][table_name] = df
+                if tipo_tabla:
+                    tablas_extraidas[tipo_tabla][table_name] = df
+                    huellas_nuevas[tipo_tabla][clave_huella] = huella
                 
                 print(f" -> Encontrada: {table_name}")
                 # --- MENSAJE DE VERIFICACIÓN ---
                 print(f"   -> Traduciendo mes: '{nombre_mes_espanol}' -> '{nombre_mes_ingles}'")
                 break
 
+if tablas_sin_cambios:
+    print(f"Se omiten {len(tablas_sin_cambios)} tablas sin cambios; se procesan "
+          f"{len(tablas_extraidas['category']) + len(tablas_extraidas['forecast'])} tablas.")
+
 # --- Funciones de Procesamiento y Limpieza ---
 def procesar_cuotas_zona(df, nombre_tabla):
     """
     Procesa la primera fila de las tablas de forecast para extraer cuotas por zona
     """
-    df_clean = df.copy()
+    df_clean = df.copy(deep=False) # Sin copia de datos (copy-on-write)
     
     # Verificar que existe la columna TOTAL
     if 'TOTAL' not in df_clean.columns:
@@ -191,7 +266,37 @@ if not total_zone_quotas.empty:
     total_zone_quotas = total_zone_quotas.rename(columns={"TOTAL": "cuota"}, errors='ignore')
     print(f"Se procesaron {len(total_zone_quotas)} cuotas de zona")
 
-def ingest_zone_quotas_data(df_to_ingest):
+def resultado_carga(table_name, estado, filas_insertadas=0, error=None):
+    """Resultado de la carga de una tabla del WOR: 'ok', 'sin cambios', 'vacía' o 'error'."""
+    return {'tabla': table_name, 'estado': estado, 'filas_insertadas': filas_insertadas, 'error': error}
+
+def filtro_periodos(df):
+    """
+    Condición SQL con los años y meses del libro, para que la deduplicación no lea la tabla completa. Con los
+    índices (año, mes, ...) que declara esquema.py la consulta es un seek.
+    """
+    if df.empty:
+        return "1 = 0"
+    años = ', '.join(str(int(año)) for año in sorted(df['año'].unique()))
+    meses = ', '.join(str(int(mes)) for mes in sorted(df['mes'].unique()))
+    return f"año IN ({años}) AND mes IN ({meses})"
+
+def insertar_con_cuarentena(engine, df_to_insert, table_name, df_sin_cliente):
+    """
+    Inserta las filas nuevas y guarda las filas sin cliente en la cuarentena en la misma transacción: si la carga
+    falla no queda cuarentena huérfana. Sin filas nuevas la cuarentena se guarda sola. Devuelve las filas insertadas.
+    """
+    def guardar_cuarentena(connection):
+        guardar_en_cuarentena(connection, df_sin_cliente, table_name, file_path, ID_CARGA)
+
+    if df_to_insert.empty:
+        if not df_sin_cliente.empty:
+            with engine.begin() as connection:
+                guardar_cuarentena(connection)
+        return 0
+    return insertar_por_lotes(engine, df_to_insert, table_name, despues=guardar_cuarentena)
+
+def ingest_zone_quotas_data(df_to_ingest, engine):
     """
     Carga las cuotas generales por zona en la tabla Cuota_forecast
     """
@@ -199,59 +304,44 @@ def ingest_zone_quotas_data(df_to_ingest):
     
     if df_to_ingest.empty:
         print(f"\nDataFrame para cuotas de zona está vacío.")
-        return
+        return resultado_carga(table_name, 'vacía')
     
-    engine = None
     try:
-        connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
-        engine = create_engine(connection_string)
         print(f"\n--- Iniciando proceso de CUOTAS DE ZONA para '{table_name}' ---")
         
-        df = df_to_ingest.copy()
+        # Copia superficial: con copy-on-write no copia datos y los cambios no afectan al DataFrame original
+        df = df_to_ingest.copy(deep=False)
+        metricas.contar(table_name, 'leidas', len(df))
         
         # Mapeo de Zonas (no necesita clientes para cuotas de zona)
-        df['id_zone'] = df['Zone'].map(ZONE_MAPPING).fillna(1).astype(int)
-        
-        # Para cuotas de zona, el id_cliente será NULL o un valor especial (ej: 0)
-        df['id_cliente'] = 0  # O puedes usar NULL si tu BD lo permite
-        
-        # Limpieza y preparación
-        if 'cuota' not in df.columns and 'TOTAL' in df.columns:
-            df = df.rename(columns={"TOTAL": "cuota"})
+        df['id_zone'] = aplicar_reglas(df, reglas_zonas, columna_zona='Zone').fillna(1).astype(int)
         
-        df['cuota'] = pd.to_numeric(df['cuota'], errors='coerce').fillna(0).astype(float)
-        
-        # Filtrar solo cuotas válidas (mayor a 0)
-        df = df[df['cuota'] > 0]
-        
-        cols_finales = ['id_zone', 'id_cliente', 'cuota', 'nombre_mes', 'mes', 'año']
-        df = df.filter(items=cols_finales)
+        # Limpieza y preparación: para cuotas de zona el id_cliente es 0 y solo valen las cuotas mayores a 0
+        df = preparar_cuotas_zona(df)
+        metricas.contar(table_name, 'mapeadas', len(df))
         
         # Lógica de Deduplicación específica para cuotas de zona
         unique_cols = ['id_zone', 'mes', 'año']
-        query = f"SELECT {', '.join(unique_cols)} FROM {table_name} WHERE id_cliente = 0"
-        existing_records_df = pd.read_sql_query(query, engine)
-        
-        if not existing_records_df.empty:
-            merged = df.merge(existing_records_df, on=unique_cols, how='left', indicator=True)
-            df_to_insert = merged[merged['_merge'] == 'left_only'].drop(columns=['_merge'])
-        else:
-            df_to_insert = df
+        query = f"SELECT {', '.join(unique_cols)} FROM {table_name} WHERE id_cliente = 0 AND {filtro_periodos(df)}"
+        df_to_insert = filas_nuevas(df, pd.read_sql_query(query, engine), unique_cols)
             
         print(f"Total de cuotas de zona encontradas: {len(df)}")
         print(f"Cuotas de zona a insertar (nuevas): {len(df_to_insert)}")
+        metricas.contar(table_name, 'deduplicadas', len(df_to_insert))
         
         if not df_to_insert.empty:
-            df_to_insert.to_sql(table_name, con=engine, if_exists='append', index=False)
+            filas_insertadas = insertar_por_lotes(engine, df_to_insert, table_name)
             print(f"Se insertaron {len(df_to_insert)} cuotas de zona en '{table_name}'.")
+            escribir_parquet(df_to_insert, table_name, ID_CARGA, columnas_particion=['año', 'mes'])
+            return resultado_carga(table_name, 'ok', filas_insertadas)
         else:
             print("No hay cuotas de zona nuevas para insertar.")
-            
+        return resultado_carga(table_name, 'sin cambios')
+
     except Exception as e:
         print(f"\n¡ERROR en el proceso de cuotas de zona: {e}")
-    finally:
-        if engine: 
-            engine.dispose()
+        metricas.registrar_error(table_name, e)
+        return resultado_carga(table_name, 'error', error=e)
 
 def procesar_tabla(df, renombres_por_posicion):
     columnas = list(df.columns)
@@ -261,21 +351,11 @@ def procesar_tabla(df, renombres_por_posicion):
     df.columns = columnas
     return df
 
-def limpiar_dataframe(df, tipo_tabla):
-    df_clean = df.copy().fillna(0)
-    if tipo_tabla == 'forecast':
-        df_clean = df_clean.drop(columns=['Py %'], errors='ignore')
-        df_clean = df_clean.drop(index=df_clean.index[0], errors='ignore')
-        df_clean = df_clean[~df_clean.apply(lambda row: row.astype(str).str.contains('Total').any(), axis=1)]
-        columna_1 = df_clean.columns[0]
-        df_clean = df_clean[df_clean[columna_1] != 0]
-    return df_clean
-
 def agregar_columna_zona(df, nombre_tabla):
     match = re.search(r'(Zone\s*\d+|KamEast|KamCentral)', nombre_tabla, re.IGNORECASE)
     if match:
         zona_encontrada = match.group(0).replace(" ", "") # Ej: "Zone1", "KamEast"
-        # Normalizar a formato del ZONE_MAPPING
+        # Normalizar al formato de las reglas de zonas (ej. 'Zone 1')
         if 'zone' in zona_encontrada.lower():
             df["Zone"] = f"Zone {zona_encontrada[-1]}"
         else:
@@ -307,169 +387,187 @@ if not total_category.empty:
 
 # --- FUNCIONES DE CARGA A BASE DE DATOS ---
 
-def ingest_forecast_data(df_to_ingest):
+def ingest_forecast_data(df_to_ingest, engine):
     table_name = 'Forecast'
     if df_to_ingest.empty:
         print(f"\nDataFrame para la tabla '{table_name}' está vacío. No hay nada que insertar.")
-        return
+        return resultado_carga(table_name, 'vacía')
 
-    engine = None
     try:
-        connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
-        engine = create_engine(connection_string)
         print(f"\n--- Iniciando proceso para la tabla '{table_name}' ---")
 
-        df = df_to_ingest.copy()
+        # Copia superficial: con copy-on-write no copia datos y los cambios no afectan al DataFrame original
+        df = df_to_ingest.copy(deep=False)
+        metricas.contar(table_name, 'leidas', len(df))
         
         # Mapeo de Clientes y Zonas
-        with engine.connect() as connection:
-            clientes_result = connection.execute(text("SELECT id_cliente, nombre_cliente FROM Clientes"))
-            clientes_map = {str(row.nombre_cliente).strip().upper(): row.id_cliente for row in clientes_result}
-        
-        df['id_cliente'] = df['nombre_cliente'].str.strip().str.upper().map(clientes_map)
-        df['id_zone'] = df['Zone'].map(ZONE_MAPPING).fillna(1).astype(int)
-        df = df.dropna(subset=['id_cliente']).copy()
-        df['id_cliente'] = df['id_cliente'].astype(int)
-
-        # Limpieza y preparación
-        cols_to_keep = ['semana_1', 'semana_2', 'semana_3', 'semana_4', 'semana_5', 'mes', 'año', 'id_cliente', 'id_zone', 'nombre_mes']
-        df = df.filter(items=cols_to_keep)
-        for col in ['semana_1', 'semana_2', 'semana_3', 'semana_4', 'semana_5']:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(float)
+        clientes_db = obtener_clientes(engine, df['nombre_cliente'].unique(), cache=clientes_future.result())
+        df['id_cliente'] = ids_cliente_por_nombre(df['nombre_cliente'], clientes_db)
+        metricas.clientes_no_mapeados(df.loc[df['id_cliente'].isna(), 'nombre_cliente'].unique())
+        df['id_zone'] = aplicar_reglas(df, reglas_zonas, columna_zona='Zone').fillna(1).astype(int)
+
+        # Limpieza y preparación; las filas sin cliente se apartan para la cuarentena
+        df, df_sin_cliente = preparar_forecast(df)
+        metricas.contar(table_name, 'mapeadas', len(df))
         
         # Lógica de Deduplicación
         unique_cols = ['id_cliente', 'id_zone', 'mes', 'año']
-        existing_records_df = pd.read_sql_query(f"SELECT {', '.join(unique_cols)} FROM {table_name}", engine)
-        
-        if not existing_records_df.empty:
-            merged = df.merge(existing_records_df, on=unique_cols, how='left', indicator=True)
-            df_to_insert = merged[merged['_merge'] == 'left_only'].drop(columns=['_merge'])
-        else:
-            df_to_insert = df
+        existing_records_df = pd.read_sql_query(f"SELECT {', '.join(unique_cols)} FROM {table_name} WHERE {filtro_periodos(df)}", engine)
+        df_to_insert = filas_nuevas(df, existing_records_df, unique_cols)
 
         print(f"Total de filas encontradas: {len(df)}")
         print(f"Filas a insertar (nuevas): {len(df_to_insert)}")
+        metricas.contar(table_name, 'deduplicadas', len(df_to_insert))
 
+        filas_insertadas = insertar_con_cuarentena(engine, df_to_insert, table_name, df_sin_cliente)
         if not df_to_insert.empty:
-            df_to_insert.to_sql(table_name, con=engine, if_exists='append', index=False, chunksize=1000)
             print(f"Se insertaron {len(df_to_insert)} registros en '{table_name}'.")
+            escribir_parquet(df_to_insert, table_name, ID_CARGA, columnas_particion=['año', 'mes'])
+            return resultado_carga(table_name, 'ok', filas_insertadas)
+        return resultado_carga(table_name, 'sin cambios')
 
     except Exception as e:
         print(f"\n¡ERROR en el proceso para la tabla '{table_name}': {e}")
-    finally:
-        if engine: engine.dispose()
+        metricas.registrar_error(table_name, e)
+        return resultado_carga(table_name, 'error', error=e)
 
-def ingest_cuotas_data(df_to_ingest):
+def ingest_cuotas_data(df_to_ingest, engine):
     table_name = 'Cuotas_Avance_Categoria'
     if df_to_ingest.empty:
         print(f"\nDataFrame para la tabla '{table_name}' está vacío.")
-        return
+        return resultado_carga(table_name, 'vacía')
 
-    engine = None
     try:
-        connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
-        engine = create_engine(connection_string)
         print(f"\n--- Iniciando proceso para la tabla '{table_name}' ---")
 
-        df = df_to_ingest.copy()
+        # Copia superficial: con copy-on-write no copia datos y los cambios no afectan al DataFrame original
+        df = df_to_ingest.copy(deep=False)
+        metricas.contar(table_name, 'leidas', len(df))
         
         # Mapeo de Productos y Zonas
-        df['id_producto'] = df['nombre_producto'].str.strip().map(PRODUCTO_MAPPING)
-        df['id_zone'] = df['Zone'].map(ZONE_MAPPING).fillna(1).astype(int)
-        df = df.dropna(subset=['id_producto']).copy()
-        df['id_producto'] = df['id_producto'].astype(int)
-        
+        df['id_producto'] = aplicar_reglas(df, reglas_productos, columna_nombre='nombre_producto')
+        df['id_zone'] = aplicar_reglas(df, reglas_zonas, columna_zona='Zone').fillna(1).astype(int)
+
         # Limpieza y preparación
-        cols_to_keep = ['cuota_dinero', 'cuota_volumen', 'id_producto', 'id_zone', 'nombre_mes', 'mes', 'año']
-        df = df.filter(items=cols_to_keep)
-        df['cuota_dinero'] = pd.to_numeric(df['cuota_dinero'], errors='coerce').fillna(0).astype(float)
-        df['cuota_volumen'] = pd.to_numeric(df['cuota_volumen'], errors='coerce').fillna(0).astype(int)
+        df = preparar_cuotas(df)
+        metricas.contar(table_name, 'mapeadas', len(df))
 
         # Lógica de Deduplicación
         unique_cols = ['id_producto', 'id_zone', 'mes', 'año']
-        existing_records_df = pd.read_sql_query(f"SELECT {', '.join(unique_cols)} FROM {table_name}", engine)
-        
-        if not existing_records_df.empty:
-            merged = df.merge(existing_records_df, on=unique_cols, how='left', indicator=True)
-            df_to_insert = merged[merged['_merge'] == 'left_only'].drop(columns=['_merge'])
-        else:
-            df_to_insert = df
+        existing_records_df = pd.read_sql_query(f"SELECT {', '.join(unique_cols)} FROM {table_name} WHERE {filtro_periodos(df)}", engine)
+        df_to_insert = filas_nuevas(df, existing_records_df, unique_cols)
 
         print(f"Total de filas encontradas: {len(df)}")
         print(f"Filas a insertar (nuevas): {len(df_to_insert)}")
+        metricas.contar(table_name, 'deduplicadas', len(df_to_insert))
 
         if not df_to_insert.empty:
-            df_to_insert.to_sql(table_name, con=engine, if_exists='append', index=False, chunksize=1000)
+            filas_insertadas = insertar_por_lotes(engine, df_to_insert, table_name)
             print(f"Se insertaron {len(df_to_insert)} registros en '{table_name}'.")
+            escribir_parquet(df_to_insert, table_name, ID_CARGA, columnas_particion=['año', 'mes'])
+            return resultado_carga(table_name, 'ok', filas_insertadas)
+        return resultado_carga(table_name, 'sin cambios')
 
     except Exception as e:
         print(f"\n¡ERROR en el proceso para la tabla '{table_name}': {e}")
-    finally:
-        if engine: engine.dispose()
+        metricas.registrar_error(table_name, e)
+        return resultado_carga(table_name, 'error', error=e)
 
-def ingest_cuota_forecast_data(df_to_ingest):
+def ingest_cuota_forecast_data(df_to_ingest, engine):
     table_name = 'Cuota_forecast'
     if df_to_ingest.empty or 'TOTAL' not in df_to_ingest.columns:
         print(f"\nDataFrame para '{table_name}' está vacío o no contiene la columna 'TOTAL'.")
-        return
+        return resultado_carga(table_name, 'vacía')
 
-    engine = None
     try:
-        connection_string = f"mssql+pymssql://{USERNAME}:{PASSWORD}@{SERVER_AND_PORT}/{DATABASE_NAME}"
-        engine = create_engine(connection_string)
         print(f"\n--- Iniciando proceso para la tabla '{table_name}' ---")
 
-        df = df_to_ingest.copy()
+        # Copia superficial: con copy-on-write no copia datos y los cambios no afectan al DataFrame original
+        df = df_to_ingest.copy(deep=False)
+        metricas.contar(table_name, 'leidas', len(df))
 
         # Mapeo de Clientes y Zonas
-        with engine.connect() as connection:
-            clientes_result = connection.execute(text("SELECT id_cliente, nombre_cliente FROM Clientes"))
-            clientes_map = {str(row.nombre_cliente).strip().upper(): row.id_cliente for row in clientes_result}
-
-        df['id_cliente'] = df['nombre_cliente'].str.strip().str.upper().map(clientes_map)
-        df['id_zone'] = df['Zone'].map(ZONE_MAPPING).fillna(1).astype(int)
-        df = df.dropna(subset=['id_cliente']).copy()
-        df['id_cliente'] = df['id_cliente'].astype(int)
-        
-        # Limpieza y preparación
-        df = df.rename(columns={"TOTAL": "cuota"})
-        df['cuota'] = pd.to_numeric(df['cuota'], errors='coerce').fillna(0).astype(float)
-        cols_finales = ['id_zone', 'id_cliente', 'cuota', 'nombre_mes', 'mes', 'año']
-        df = df.filter(items=cols_finales)
+        clientes_db = obtener_clientes(engine, df['nombre_cliente'].unique(), cache=clientes_future.result())
+        df['id_cliente'] = ids_cliente_por_nombre(df['nombre_cliente'], clientes_db)
+        metricas.clientes_no_mapeados(df.loc[df['id_cliente'].isna(), 'nombre_cliente'].unique())
+        df['id_zone'] = aplicar_reglas(df, reglas_zonas, columna_zona='Zone').fillna(1).astype(int)
+
+        # Limpieza y preparación; las filas sin cliente se apartan para la cuarentena
+        df, df_sin_cliente = preparar_cuota_forecast(df)
+        metricas.contar(table_name, 'mapeadas', len(df))
 
         # Lógica de Deduplicación
         unique_cols = ['id_cliente', 'id_zone', 'mes', 'año']
-        existing_records_df = pd.read_sql_query(f"SELECT {', '.join(unique_cols)} FROM {table_name}", engine)
-        
-        if not existing_records_df.empty:
-            merged = df.merge(existing_records_df, on=unique_cols, how='left', indicator=True)
-            df_to_insert = merged[merged['_merge'] == 'left_only'].drop(columns=['_merge'])
-        else:
-            df_to_insert = df
+        existing_records_df = pd.read_sql_query(f"SELECT {', '.join(unique_cols)} FROM {table_name} WHERE {filtro_periodos(df)}", engine)
+        df_to_insert = filas_nuevas(df, existing_records_df, unique_cols)
 
         print(f"Total de filas encontradas: {len(df)}")
         print(f"Filas a insertar (nuevas): {len(df_to_insert)}")
+        metricas.contar(table_name, 'deduplicadas', len(df_to_insert))
 
+        filas_insertadas = insertar_con_cuarentena(engine, df_to_insert, table_name, df_sin_cliente)
         if not df_to_insert.empty:
-            df_to_insert.to_sql(table_name, con=engine, if_exists='append', index=False)
             print(f"Se insertaron {len(df_to_insert)} registros en '{table_name}'.")
+            escribir_parquet(df_to_insert, table_name, ID_CARGA, columnas_particion=['año', 'mes'])
+            return resultado_carga(table_name, 'ok', filas_insertadas)
+        return resultado_carga(table_name, 'sin cambios')
 
     except Exception as e:
         print(f"\n¡ERROR en el proceso para la tabla '{table_name}': {e}")
-    finally:
-        if engine: engine.dispose()
+        metricas.registrar_error(table_name, e)
+        return resultado_carga(table_name, 'error', error=e)
 
 # --- Ejecución del Proceso de Carga ---
 print("\n" + "="*50)
 print("INICIANDO PROCESO DE CARGA DE DATOS")
 print("="*50)
 
+engine = esperar(engine_future, "Error de conexión a la base de datos")
+print(f"Conexión a SQL Server '{DATABASE_NAME}' en '{SERVER_NAME}' establecida.")
 
-ingest_zone_quotas_data(total_zone_quotas)
-#ingest_cuota_forecast_data(total_Forecast)
-ingest_forecast_data(total_Forecast)
-ingest_cuotas_data(total_category)
+# Zonas y productos se mapean con las reglas de remapeo (reglas_remapeo.json o tabla Reglas_Remapeo)
+reglas_zonas = cargar_reglas('wor_zonas', engine)
+reglas_productos = cargar_reglas('wor_productos', engine)
+
+
+# Las tablas no comparten filas, así que se cargan en paralelo: cada carga usa su propia conexión
+# del pool del engine y el total de conexiones simultáneas queda acotado por MAX_CONEXIONES_WOR.
+# Dos cargas sobre la misma tabla (ej. cuotas de zona y cuota_forecast) no deben correr a la vez.
+# Cada carga indica de qué tipo de tabla del libro viene, para guardar sus huellas solo si terminó bien.
+CARGAS_WOR = [
+    (ingest_zone_quotas_data, total_zone_quotas, 'zone_quotas'),
+    #(ingest_cuota_forecast_data, total_Forecast, 'forecast'),
+    (ingest_forecast_data, total_Forecast, 'forecast'),
+    (ingest_cuotas_data, total_category, 'category'),
+]
+with ThreadPoolExecutor(max_workers=MAX_CONEXIONES_WOR, thread_name_prefix='wor') as executor:
+    futures = [executor.submit(ingest, df_to_ingest, engine) for ingest, df_to_ingest, _ in CARGAS_WOR]
+    resultados = [future.result() for future in futures]
+engine.dispose()
+
+# --- Huellas de las tablas cargadas ---
+# Una tabla cuya carga falló conserva la huella anterior, así que se vuelve a procesar en la próxima ejecución.
+tipos_con_error = {tipo for (_, _, tipo), resultado in zip(CARGAS_WOR, resultados) if resultado['estado'] == 'error'}
+guardar_huellas({clave: huella for tipo, huellas in huellas_nuevas.items() if tipo not in tipos_con_error
+                 for clave, huella in huellas.items()})
+
+# --- Resultado combinado de las cargas ---
+print("\nResumen de la carga del WOR:")
+for resultado in resultados:
+    detalle = f" ({resultado['error']})" if resultado['error'] else ""
+    print(f" -> {resultado['tabla']}: {resultado['estado']}, {resultado['filas_insertadas']} filas insertadas{detalle}")
+total_insertadas = sum(resultado['filas_insertadas'] for resultado in resultados)
+cargas_con_error = [resultado['tabla'] for resultado in resultados if resultado['estado'] == 'error']
+print(f"Total de filas insertadas: {total_insertadas}.")
+metricas.finalizar()
+
+if cargas_con_error:
+    print(f"\nLas siguientes tablas no se cargaron: {', '.join(cargas_con_error)}")
 
 print("\n" + "="*50)
 print("PROCESO DE CARGA FINALIZADO")
 print("="*50 + "\n")
+
+# Para las ejecuciones programadas: código de salida distinto de 0 si alguna tabla falló
+if cargas_con_error:
+    sys.exit(1)
\ No newline at end of file